@@ -1,97 +1,318 @@
 from __future__ import division
+import io
 import logging
 import gzip
+import shutil
+import subprocess
 import mimetypes
+from itertools import islice
 # from memory_profiler import memory_usage
 
+# size of the binary blocks read from the file handle
+BLOCK_SIZE = 1 << 20
+
+# external tools decompressing gzip files faster than the gzip module, the
+# first one found is used
+DECOMPRESSORS = ('pigz', 'igzip')
+
+
+def _find_tool(tools):
+    for tool in tools:
+        path = shutil.which(tool)
+        if path:
+            return path
+    return None
+
+
+class _ProcessReader(io.RawIOBase):
+    '''
+    Binary file handle reading the output of a decompression process
+    '''
+
+    def __init__(self, cmd):
+        self._cmd = cmd
+        self._process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self._process.stdout.readinto(b)
+        if not n:
+            self._eof = True
+        return n
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self._process.stdout.close()
+        stderr = self._process.stderr.read()
+        self._process.stderr.close()
+        returncode = self._process.wait()
+        # a process stopped before the end of the output only fails by
+        # writing to the closed pipe
+        if self._eof and returncode != 0:
+            raise OSError('{} failed with exit code {}: {}'
+                          .format(' '.join(self._cmd), returncode,
+                                  stderr.decode(errors='replace').strip()))
+
+
+class _ProcessWriter(io.RawIOBase):
+    '''
+    Binary file handle compressing its input with a process writing the file
+    '''
+
+    def __init__(self, cmd, file):
+        self._cmd = cmd
+        with open(file, 'wb') as out:
+            self._process = subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                             stdout=out,
+                                             stderr=subprocess.PIPE)
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._process.stdin.write(b)
+        return len(b)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        self._process.stdin.close()
+        stderr = self._process.stderr.read()
+        self._process.stderr.close()
+        if self._process.wait() != 0:
+            raise OSError('{} failed with exit code {}: {}'
+                          .format(' '.join(self._cmd),
+                                  self._process.returncode,
+                                  stderr.decode(errors='replace').strip()))
+
+
+def open_gzip_writer(file, threads=1):
+    '''
+    Open a gzip compressed file for writing text. The compression is done
+    by pigz with the given number of threads if it is available and with the
+    gzip module otherwise.
+    :param file: file name of the compressed file
+    :param threads: number of compression threads
+    :return: text file handle
+    '''
+    pigz = _find_tool(('pigz',))
+    if pigz:
+        return io.TextIOWrapper(io.BufferedWriter(_ProcessWriter(
+            [pigz, '-1', '-c', '-p', str(max(1, threads))], file),
+            BLOCK_SIZE))
+    return gzip.open(file, 'wt', compresslevel=1)
+
+
+class _ChainReader(io.RawIOBase):
+    '''
+    Binary file handle reading several files one after the other, a line
+    break is added after each file such that their records stay separated
+    '''
+
+    def __init__(self, open_files):
+        self._open_files = iter(open_files)
+        self._handle = None
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while True:
+            if self._handle is None:
+                open_file = next(self._open_files, None)
+                if open_file is None:
+                    return 0
+                self._handle = open_file()
+            n = self._handle.readinto(b)
+            if n:
+                return n
+            self._handle.close()
+            self._handle = None
+            b[0:1] = b'\n'
+            return 1
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        if self._handle is not None:
+            self._handle.close()
+
+
 class FastxReader(object):
 
-    def __init__(self, file):
+    def __init__(self, file, mate=None):
+        '''
 
+        :param file: read file or comma separated read files (e.g. of several
+                     sequencing lanes), which are read one after the other
+        :param mate: 1 or 2 to read only the first or second mates of
+                     interleaved paired reads
+        '''
         self._file = file
-        guessed_type = mimetypes.guess_type(file)[1]
+        self._files = file.split(',')
+        self._mate = mate
+        self._file_handle = 'txt'
+        guessed_type = mimetypes.guess_type(self._files[0])[1]
         if guessed_type:
             if 'gzip' in guessed_type:
                 self._file_handle = 'gzip'
-        else:
-            self._file_handle = 'txt'
 
     def open_fastx(self):
+        '''
+        Open the file as binary handle, the records are parsed from blocks
+        of bytes and only decoded by the str based readers. Gzip compressed
+        files are decompressed by pigz or igzip in a separate process if
+        available, such that decompression and parsing run in parallel.
+        Several files are chained into a single handle.
+        '''
+        if len(self._files) > 1:
+            return io.BufferedReader(_ChainReader(
+                FastxReader(file).open_fastx for file in self._files),
+                BLOCK_SIZE)
         if self._file_handle in 'gzip':
-            return gzip.open(self._file, 'rt')
+            decompressor = _find_tool(DECOMPRESSORS)
+            if decompressor:
+                return io.BufferedReader(
+                    _ProcessReader([decompressor, '-d', '-c', self._file]),
+                    BLOCK_SIZE)
+            return gzip.open(self._file, 'rb')
         else:
-            return open(self._file, 'rt')
+            return open(self._file, 'rb')
+
+    def _read_line_blocks(self, file_handle):
+        '''
+        Split blocks read from the binary file handle into lines
+        :param file_handle: binary file handle
+        :return: generator of lists of lines without line ending
+        '''
+        rest = b''
+        while True:
+            block = file_handle.read(BLOCK_SIZE)
+            if not block:
+                break
+            lines = (rest + block).split(b'\n')
+            rest = lines.pop()
+            if b'\r' in block:
+                lines = [l.rstrip(b'\r') for l in lines]
+            yield lines
+        if rest:
+            yield [rest.rstrip(b'\r')]
+
+    def readfx_bytes(self, file_handle):
+        '''
+        Parse the records of the file, for interleaved paired reads only the
+        records of the selected mate
+        :param file_handle: binary file handle as returned by open_fastx
+        :return: generator of name, seq and quality (None for fasta) as bytes
+        '''
+        records = self._readfx_bytes(file_handle)
+        if self._mate:
+            return islice(records, self._mate - 1, None, 2)
+        return records
+
+    def _readfx_bytes(self, file_handle):
+        '''
+        This function is based on https://github.com/lh3/readfq and parses
+        fasta and fastq records with sequences and qualities spread over
+        multiple lines. Records on 2 (fasta) or 4 (fastq) lines are taken
+        directly from the lines of a block.
+        :param file_handle: binary file handle as returned by open_fastx
+        :return: generator of name, seq and quality (None for fasta) as bytes
+        '''
+        blocks = self._read_line_blocks(file_handle)
+        lines = []
+        i = 0
+        eof = False
+
+        def peek():
+            nonlocal lines, i, eof
+            while i >= len(lines):
+                block = None if eof else next(blocks, None)
+                if block is None:
+                    eof = True
+                    return None
+                lines, i = block, 0
+            return lines[i]
+
+        while True:
+            if len(lines) - i < 4 and not eof:
+                block = next(blocks, None)
+                if block is None:
+                    eof = True
+                else:
+                    lines, i = lines[i:] + block, 0
+                    continue
+            n = len(lines)
+            while i + 3 < n:
+                name, seq, sep = lines[i], lines[i + 1], lines[i + 2]
+                if seq[:1] in (b'@', b'+', b'>'):
+                    break
+                if name[:1] == b'@' and sep[:1] == b'+' and \
+                        len(lines[i + 3]) == len(seq):
+                    yield name, seq, lines[i + 3]
+                    i += 4
+                elif name[:1] == b'>' and sep[:1] in (b'>', b'@'):
+                    yield name, seq, None
+                    i += 2
+                else:
+                    break
+            if i + 3 >= n and not eof:
+                continue
+
+            # any other record is parsed line by line
+            name = peek()
+            if name is None:
+                break
+            i += 1
+            if name[:1] not in (b'>', b'@'):  # search for the next header
+                continue
+            seqs = []
+            l = peek()
+            while l is not None and l[:1] not in (b'@', b'+', b'>'):
+                seqs.append(l)
+                i += 1
+                l = peek()
+            seq = b''.join(seqs)
+            if l is None or l[:1] != b'+':  # this is a fasta record
+                yield name, seq, None
+                continue
+            i += 1
+            quals, leng = [], 0
+            while True:  # read the quality
+                l = peek()
+                if l is None:  # reach EOF before reading enough quality
+                    break
+                quals.append(l)
+                i += 1
+                leng += len(l)
+                if leng >= len(seq):  # have read enough quality
+                    break
+            if leng >= len(seq) and quals:
+                yield name, seq, b''.join(quals)
+            else:
+                yield name, seq, None  # yield a fasta record instead
+                break
 
     def readfq_id(self, file_handle):
-        for l in file_handle:
-            name = l.rstrip()
-            seq = next(file_handle).rstrip()
-            tmp = next(file_handle).rstrip()
-            qual = next(file_handle).rstrip()
-            yield name.split(' ')[0]
+        for name, _, _ in self.readfx_bytes(file_handle):
+            yield name.split(b' ', 1)[0].decode()
 
     def readfq(self, file_handle):
-        for l in file_handle:
-            name = l.rstrip()
-            seq = next(file_handle).rstrip()
-            tmp = next(file_handle).rstrip()
-            qual = next(file_handle).rstrip()
-            yield name, seq, qual
+        return self.readfx(file_handle)
 
     def readfa(self, file_handle):
-        for l in file_handle:
-            name = l.rstrip()
-            seq = next(file_handle).rstrip()
-            yield name, seq
+        for name, seq, _ in self.readfx_bytes(file_handle):
+            yield name.decode(), seq.decode('latin-1')
 
     def readfx(self, file_handle):
-        for l in file_handle:
-            name = l.rstrip()
-            seq = next(file_handle).rstrip()
-            if '@' in name[0]:
-                tmp = next(file_handle).rstrip()
-                qual = next(file_handle).rstrip()
-            elif '>' in name[0]:
-                qual = None
-            yield name, seq, qual
-
-    # def readfx(self, file_handle):  # this is a generator function
-    #     '''
-    #     This function was copy and pasted from https://github.com/lh3/readfq
-    #     Readfq is a fast implementation of a read iterator and provides a
-    #     massive spead up compared to regular
-    #     implementations
-    #     :param file_handle: is a filehandle
-    #     :return: name, seq, quality
-    #     '''
-    #     last = None  # this is a buffer keeping the last unprocessed line
-    #     while True:  # mimic closure; is it a bad idea?
-    #         if not last:  # the first record or a record following a fastq
-    #             for l in file_handle:  # search for the start of the next record
-    #                 if l[0] in '>@':  # fasta/q header line
-    #                     last = l[:-1]  # save this line
-    #                     break
-    #         if not last:
-    #             break
-    #         name, seqs, last = last, [], None
-    #         for l in file_handle:  # read the sequence
-    #             if l[0] in '@+>':
-    #                 last = l[:-1]
-    #                 break
-    #             seqs.append(l[:-1])
-    #         if not last or last[0] != '+':  # this is a fasta record
-    #             yield name, ''.join(seqs), None  # yield a fasta record
-    #             if not last:
-    #                 break
-    #         else:  # this is a fastq record
-    #             seq, leng, seqs = ''.join(seqs), 0, []
-    #             for l in file_handle:  # read the quality
-    #                 seqs.append(l[:-1])
-    #                 leng += len(l) - 1
-    #                 if leng >= len(seq):  # have read enough quality
-    #                     last = None
-    #                     yield name, seq, ''.join(seqs)  # yield a fastq record
-    #                     break
-    #             if last:  # reach EOF before reading enough quality
-    #                 yield name, seq, None  # yield a fasta record instead
-    #                 break
+        for name, seq, qual in self.readfx_bytes(file_handle):
+            yield name.decode(), seq.decode('latin-1'), \
+                None if qual is None else qual.decode('latin-1')
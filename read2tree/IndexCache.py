@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+'''
+    This file contains the definition of a cache that keeps the reference
+    files together with the hash table indices built by ngm / ngmlr. The
+    entries are keyed by the content of the reference and the mapper
+    parameters, such that the index of a reference set is built only once
+    and reused across samples and runs.
+'''
+
+import os
+import glob
+import fcntl
+import shutil
+import hashlib
+import logging
+from contextlib import contextmanager
+from filelock import FileLock, Timeout
+
+COMPLETE_MARKER = '.complete'
+
+# file holding the shared lock of the jobs using an entry
+USE_LOCK = '.use'
+
+
+class IndexCache(object):
+
+    def __init__(self, cache_dir, max_entries=200):
+        """
+
+        :param cache_dir: folder holding the cached references and indices
+        :param max_entries: maximum number of cached references, the least
+                            recently used ones are evicted
+        """
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+
+        self.logger = logging.getLogger(__name__)
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, ref_file, mapper_signature):
+        """
+        Compute the cache key of a reference
+        :param ref_file: reference fasta file
+        :param mapper_signature: string describing mapper and its parameters
+        :return: hex digest of reference content and mapper parameters
+        """
+        key = hashlib.sha1(mapper_signature.encode())
+        with open(ref_file, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                key.update(block)
+        return key.hexdigest()
+
+    @contextmanager
+    def reference(self, ref_file, mapper_signature, build_index=None):
+        """
+        Context manager providing the cached copy of a reference. The index
+        of a new entry is built by build_index under an exclusive lock, such
+        that concurrent jobs wait instead of building it twice, and the lock
+        is released as soon as the index exists. During the whole use of an
+        entry a shared lock is held, which prevents its eviction.
+        :param ref_file: reference fasta file
+        :param mapper_signature: string describing mapper and its parameters
+        :param build_index: function building the index next to the cached
+                            reference and returning whether it succeeded. If
+                            it is missing or returns False, the mapper builds
+                            the index on first use while the exclusive lock
+                            is held.
+        :return: path of the cached reference
+        """
+        entry = os.path.join(self.cache_dir,
+                             self.get_key(ref_file, mapper_signature))
+        cached_ref = os.path.join(entry, os.path.basename(ref_file))
+        marker = os.path.join(entry, COMPLETE_MARKER)
+
+        built_by_mapping = False
+        with self._use(entry):
+            if os.path.exists(marker):
+                self.logger.debug('Re-using cached index of {}'
+                                  .format(os.path.basename(ref_file)))
+            else:
+                with FileLock(entry + '.lock'):
+                    if not os.path.exists(marker) and \
+                            not self._build(ref_file, cached_ref, build_index):
+                        # the index is built by the mapping itself
+                        with self._remove_on_error(entry):
+                            yield cached_ref
+                        open(marker, 'w').close()
+                        self.logger.debug('Cached index of {}'.format(
+                            os.path.basename(ref_file)))
+                        built_by_mapping = True
+            if not built_by_mapping:
+                os.utime(marker)
+                yield cached_ref
+        self._evict()
+
+    def _build(self, ref_file, cached_ref, build_index):
+        """
+        Create a cache entry and build the index of the reference, must be
+        called while holding the exclusive lock of the entry
+        :param ref_file: reference fasta file
+        :param cached_ref: path of the cached reference
+        :param build_index: function building the index or None
+        :return: whether the entry is complete
+        """
+        entry = os.path.dirname(cached_ref)
+        if os.path.exists(entry):  # left over from an interrupted run
+            shutil.rmtree(entry)
+        os.makedirs(entry)
+        shutil.copy(ref_file, cached_ref)
+        if build_index is None:
+            return False
+        with self._remove_on_error(entry):
+            built = build_index(cached_ref)
+        if built:
+            open(os.path.join(entry, COMPLETE_MARKER), 'w').close()
+            self.logger.debug('Cached index of {}'
+                              .format(os.path.basename(ref_file)))
+        return built
+
+    @contextmanager
+    def _remove_on_error(self, entry):
+        try:
+            yield
+        except BaseException:
+            shutil.rmtree(entry, ignore_errors=True)
+            raise
+
+    @contextmanager
+    def _use(self, entry):
+        """
+        Hold a shared lock on the entry while it is in use
+        :param entry: folder of the cache entry
+        """
+        with open(entry + USE_LOCK, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _evict(self):
+        """
+        Remove the least recently used entries exceeding the maximum number
+        of cached references. Entries that are built or in use by another
+        job are skipped.
+        """
+        markers = sorted(glob.glob(os.path.join(self.cache_dir, '*',
+                                                COMPLETE_MARKER)),
+                         key=os.path.getmtime)
+        for marker in markers[:max(0, len(markers) - self.max_entries)]:
+            entry = os.path.dirname(marker)
+            try:
+                with FileLock(entry + '.lock', timeout=0), \
+                        open(entry + USE_LOCK, 'a') as f:
+                    try:
+                        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        continue
+                    try:
+                        shutil.rmtree(entry, ignore_errors=True)
+                    finally:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+                    self.logger.debug('Evicted {} from index cache'
+                                      .format(os.path.basename(entry)))
+            except Timeout:
+                pass
@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+'''
+    This file contains the definition of a pre-filter that discards all the
+    reads which do not share k-mers with the reference DNA sequences. The
+    reference only covers the marker genes, such that most reads of a sample
+    can not map to it and need not to be handed to the read mapper.
+'''
+
+import time
+import logging
+import numpy as np
+
+from tqdm import tqdm
+
+from read2tree.FastxReader import FastxReader
+
+# 2-bit code of the nucleotides, any other character is 4 and breaks a k-mer
+NUCLEOTIDE_CODE = np.full(256, 4, dtype=np.uint8)
+for _i, _nucleotide in enumerate('ACGT'):
+    NUCLEOTIDE_CODE[ord(_nucleotide)] = _i
+    NUCLEOTIDE_CODE[ord(_nucleotide.lower())] = _i
+
+# number of nucleotides that are encoded and looked up together
+CHUNK_BASES = 1 << 22
+
+
+def chunk_by_bases(items, get_len):
+    """
+    Group items into chunks of about CHUNK_BASES nucleotides
+    :param items: iterable of sequences or records
+    :param get_len: function returning the length of an item
+    :return: generator of lists of items
+    """
+    chunk = []
+    chunk_bases = 0
+    for item in items:
+        chunk.append(item)
+        chunk_bases += get_len(item)
+        if chunk_bases >= CHUNK_BASES:
+            yield chunk
+            chunk = []
+            chunk_bases = 0
+    if chunk:
+        yield chunk
+
+
+def encode_sequences(seqs):
+    """
+    Concatenate sequences into one array of nucleotide codes, each sequence
+    is followed by a separator such that no k-mer spans two sequences
+    :param seqs: list of sequence strings
+    :return: array of codes and the start offset of each sequence
+    """
+    lengths = np.fromiter((len(seq) + 1 for seq in seqs), dtype=np.int64,
+                          count=len(seqs))
+    starts = np.zeros(len(seqs), dtype=np.int64)
+    np.cumsum(lengths[:-1], out=starts[1:])
+    data = '\n'.join(seqs).encode('ascii', 'replace') + b'\n'
+    return NUCLEOTIDE_CODE[np.frombuffer(data, dtype=np.uint8)], starts
+
+
+def canonical_kmers(codes, k):
+    """
+    Compute the canonical k-mer starting at every position of the code array
+    :param codes: array of nucleotide codes as returned by encode_sequences
+    :param k: k-mer size, at most 31
+    :return: array of canonical k-mers and mask of valid k-mers, both with
+             one entry per start position
+    """
+    num_kmers = max(0, codes.size - k + 1)
+    forward = np.zeros(num_kmers, dtype=np.uint64)
+    reverse = np.zeros(num_kmers, dtype=np.uint64)
+    for i in range(k):
+        window = codes[i:i + num_kmers].astype(np.uint64)
+        forward = (forward << np.uint64(2)) | (window & np.uint64(3))
+        reverse |= (np.uint64(3) - (window & np.uint64(3))) << \
+            np.uint64(2 * i)
+    invalid = np.concatenate(([0], np.cumsum(codes == 4)))
+    valid = invalid[k:k + num_kmers] == invalid[:num_kmers]
+    return np.minimum(forward, reverse), valid
+
+
+class KmerFilter(object):
+
+    def __init__(self, args, records):
+        """
+
+        :param args: list of arguments from command line
+        :param records: reference DNA records the reads are compared to
+        """
+        self.args = args
+        self.k = args.kmer_size
+        self.min_shared_kmers = args.min_shared_kmers
+        self.elapsed_time = 0
+
+        self.logger = logging.getLogger(__name__)
+        self._species_name = self.args.species_name
+
+        self.kmers = self._get_reference_kmers(records)
+
+    def _get_reference_kmers(self, records):
+        """
+        Build the sorted set of canonical k-mers of all reference records
+        :param records: list of SeqRecords
+        :return: sorted array of unique k-mers
+        """
+        kmers = [np.zeros(0, dtype=np.uint64)]
+        for chunk in chunk_by_bases((str(record.seq) for record in records),
+                                    len):
+            codes, _ = encode_sequences(chunk)
+            chunk_kmers, valid = canonical_kmers(codes, self.k)
+            kmers.append(np.unique(chunk_kmers[valid]))
+        kmers = np.unique(np.concatenate(kmers))
+        self.logger.info('{}: Reference for read filtering contains {} '
+                         'distinct {}-mers.'
+                         .format(self._species_name, kmers.size, self.k))
+        return kmers
+
+    def count_shared_kmers(self, seqs):
+        """
+        Count for each sequence the number of its k-mers found in the
+        reference
+        :param seqs: list of sequence strings
+        :return: array with the number of shared k-mers of each sequence
+        """
+        if not seqs:
+            return np.zeros(0, dtype=np.int64)
+        codes, starts = encode_sequences(seqs)
+        kmers, valid = canonical_kmers(codes, self.k)
+        shared = np.zeros(codes.size, dtype=np.int64)
+        if self.kmers.size:
+            idx = np.searchsorted(self.kmers, kmers)
+            idx[idx == self.kmers.size] = 0
+            shared[:kmers.size] = valid & (self.kmers[idx] == kmers)
+        return np.add.reduceat(shared, starts)
+
+    def filter_reads(self, reads, read_container):
+        """
+        Stream once through the reads and keep only those sharing at least
+        --min_shared_kmers k-mers with the reference. Paired reads are kept
+        as long as one of the mates passes.
+        :param reads: read file or list of two paired read files
+        :param read_container: Reads object whose temporary read files, which
+                               are compressed with --compress_tmp_reads and
+                               removed by its cleanup, hold the filtered reads
+        :return: filtered read file or list of two filtered read files
+        """
+        start = time.time()
+        print('--- Filtering reads by {}-mers shared with reference ---'
+              .format(self.k))
+        paired = isinstance(reads, list) and len(reads) == 2
+        files = reads if paired else [reads]
+
+        readers = [FastxReader(file) for file in files]
+        handles = [reader.open_fastx() for reader in readers]
+        out_files, out_file_names = zip(*[
+            read_container._open_tmp_reads_file() for _ in files])
+        total_reads = 0
+        kept_reads = 0
+        try:
+            records = zip(*[reader.readfx(handle) for reader, handle
+                            in zip(readers, handles)])
+            records = tqdm(records, desc='Filtering reads', unit=' reads')
+            for chunk in chunk_by_bases(records, lambda record: sum(
+                    len(mate[1]) for mate in record)):
+                kept_reads += self._write_chunk(chunk, out_files)
+                total_reads += len(chunk)
+        finally:
+            for handle in handles:
+                handle.close()
+            for out_file in out_files:
+                out_file.close()
+
+        self.elapsed_time = time.time() - start
+        self.logger.info('{}: {} of {} reads ({:.2f}%) share at least {} '
+                         '{}-mers with the reference and are kept for '
+                         'mapping.'
+                         .format(self._species_name, kept_reads, total_reads,
+                                 100 * kept_reads / max(1, total_reads),
+                                 self.min_shared_kmers, self.k))
+        self.logger.info('{}: Filtering of reads took {}.'
+                         .format(self._species_name, self.elapsed_time))
+        if paired:
+            return list(out_file_names)
+        return out_file_names[0]
+
+    def _write_chunk(self, chunk, out_files):
+        """
+        Write the reads of a chunk that pass the filter
+        :param chunk: list of tuples with one record per read file
+        :param out_files: output file per read file
+        :return: number of reads kept
+        """
+        keep = np.zeros(len(chunk), dtype=bool)
+        for mate in range(len(out_files)):
+            shared = self.count_shared_kmers([record[mate][1]
+                                              for record in chunk])
+            keep |= shared >= self.min_shared_kmers
+        for mate, out_file in enumerate(out_files):
+            out_file.write(''.join('>{}\n{}\n'.format(record[mate][0][1:],
+                                                      record[mate][1])
+                                   for record, passed in zip(chunk, keep)
+                                   if passed))
+        return int(np.count_nonzero(keep))
@@ -21,9 +21,11 @@ import glob
 import subprocess
 import logging
 import time
+from multiprocessing import Pool
 from tqdm import tqdm
 
 import functools
+from contextlib import contextmanager
 from Bio import SeqIO, SeqRecord, Seq
 try:
     from Bio.Alphabet import generic_dna
@@ -31,13 +33,21 @@ except ImportError:
     generic_dna = None
 from Bio.SeqIO.FastaIO import FastaWriter
 from read2tree.OGSet import OG
-from read2tree.Reads import Reads
+from read2tree.Reads import Reads, open_reads
 from read2tree.ReferenceSet import Reference
 from read2tree.wrappers.read_mappers import NGM
 from read2tree.wrappers.read_mappers import NGMLR
 from read2tree.stats.Coverage import Coverage
+from read2tree.stats.Consensus import Consensus
 from read2tree.stats.SeqCompleteness import SeqCompleteness
 from read2tree.FastxReader import FastxReader
+from read2tree.IndexCache import IndexCache
+from read2tree.KmerFilter import KmerFilter
+from read2tree.Sketch import Sketch
+from read2tree.MappingManifest import MappingManifest
+
+# separates the species code from the sequence id in the combined reference
+COMBINED_REF_SEP = '|'
 
 
 class Mapper(object):
@@ -46,7 +56,7 @@ class Mapper(object):
     """
 
     def __init__(self, args, ref_set=None, og_set=None, species_name=None, progress=None,
-                 load=True):
+                 load=True, mapping_name=None):
         self.args = args
         self.elapsed_time = 0
 
@@ -62,15 +72,36 @@ class Mapper(object):
         # #------- uncomment this for species removal test ---------
         if args.reads:
             if len(args.reads) == 2:
-                self._mapping_name = os.path.basename(self._reads[0]).split(".")[0]
+                self._mapping_name = os.path.basename(
+                    self._reads[0].split(",")[0]).split(".")[0]
             else:
-                self._mapping_name = os.path.basename(self._reads).split(".")[0]
+                self._mapping_name = os.path.basename(
+                    self._reads.split(",")[0]).split(".")[0]
         else:
             self._mapping_name = self._species_name
+        # mapping folder to load from, e.g. the one written by the
+        # --single_mapping jobs of --parallel_mapping
+        if mapping_name:
+            self._mapping_name = mapping_name
 
         self.progress = progress
         self.all_cov = {}
         self.all_sc = {}
+        self._consensus_missing = {}
+
+        # number of species mapped concurrently, which share the threads
+        self._mapping_jobs = max(1, self.args.mapping_jobs)
+        if self.args.combined_mapping:
+            self._mapping_jobs = 1
+
+        if self.args.index_cache:
+            cache_dir = self.args.index_cache_dir or \
+                os.path.join(self.args.output_path, 'ngm_index_cache')
+            self._index_cache = IndexCache(cache_dir,
+                                           self.args.index_cache_size)
+        else:
+            self._index_cache = None
+        self._threads_per_job = max(1, self.args.threads)
 
         self.read_og_set = {}
 
@@ -92,27 +123,42 @@ class Mapper(object):
                     self._read_mapping_from_folder(mapping_name=self._mapping_name, ref_records=ref_set)
                 self.og_records = self._sort_by_og()
 
-    def _call_wrapper(self, ref_file_handle, reads, tmp_output_folder):
+    def _call_wrapper(self, ref_file_handle, reads, tmp_output_folder,
+                      references=None):
+        """
+        Map the reads with ngm / ngmlr and post-process the mapping
+        :param ref_file_handle: reference file used for mapping
+        :param reads: read file(s) used for mapping
+        :param tmp_output_folder: path of temporary folder used for mapping
+        :param references: list of species contained in a combined
+                           reference, None for a single species reference
+        :return: consensus file or, for a combined reference, dictionary with
+                 species as key and consensus file as value
+        """
         start = time.time()
         output_folder = os.path.join(self.args.output_path,
                                      "04_mapping_" + self._species_name)
 
         if len(self._reads) == 2:
-            ngm_wrapper = NGM(ref_file_handle, reads, tmp_output_folder.name)
+            ngm_wrapper = NGM(ref_file_handle, reads, tmp_output_folder)
             if self.args.threads != None:
-                ngm_wrapper.options.options['-t'].set_value(self.args.threads)
+                ngm_wrapper.options.options['-t'].set_value(self._threads_per_job)
+            if references:
+                ngm_wrapper.options.options['--topn'].set_value(len(references))
             ngm = ngm_wrapper()
             bam_file = ngm['file']
         elif len(self._reads) != 2 and 'short' in self.args.read_type:
-            ngm_wrapper = NGM(ref_file_handle, reads, tmp_output_folder.name)
+            ngm_wrapper = NGM(ref_file_handle, reads, tmp_output_folder)
             if self.args.threads != None:
-                ngm_wrapper.options.options['-t'].set_value(self.args.threads)
+                ngm_wrapper.options.options['-t'].set_value(self._threads_per_job)
+            if references:
+                ngm_wrapper.options.options['--topn'].set_value(len(references))
             ngm = ngm_wrapper()
             bam_file = ngm['file']
         elif len(self._reads) != 2 and 'long' in self.args.read_type:
-            ngm_wrapper = NGMLR(ref_file_handle, reads, tmp_output_folder.name)
+            ngm_wrapper = NGMLR(ref_file_handle, reads, tmp_output_folder)
             if self.args.threads != None:
-                ngm_wrapper.options.options['-t'].set_value(self.args.threads)
+                ngm_wrapper.options.options['-t'].set_value(self._threads_per_job)
             if self.args.ngmlr_parameters != None:
                 par = self.args.ngmlr_parameters.split(',')
                 ngm_wrapper.options.options['-x'].set_value(str(par[0]))
@@ -123,9 +169,10 @@ class Mapper(object):
             bam_file = ngm['file']
         self.logger.info('{}: Mapped {} / {} reads to {}'.format(self._species_name, ngm['reads_mapped'],
                          ngm['total_reads']+ngm['reads_mapped'], os.path.basename(ref_file_handle)))
-        self._rm_file(ref_file_handle + "-enc.2.ngm", ignore_error=True)
-        self._rm_file(ref_file_handle + "-ht-13-2.2.ngm", ignore_error=True)
-        self._rm_file(ref_file_handle + "-ht-13-2.3.ngm", ignore_error=True)
+        if not self._index_cache:
+            self._rm_file(ref_file_handle + "-enc.2.ngm", ignore_error=True)
+            self._rm_file(ref_file_handle + "-ht-13-2.2.ngm", ignore_error=True)
+            self._rm_file(ref_file_handle + "-ht-13-2.3.ngm", ignore_error=True)
 
         end = time.time()
         self.elapsed_time = end - start
@@ -134,10 +181,15 @@ class Mapper(object):
                                  self.elapsed_time))
 
         if ngm['reads_mapped'] > 0 and os.path.exists(bam_file) and os.path.getsize(bam_file) > 0:
-            shutil.copy(bam_file, os.path.join(output_folder, os.path.basename(bam_file)))
-            return self._post_process_read_mapping(ref_file_handle, bam_file)
+            return self._post_process_read_mapping(ref_file_handle, bam_file,
+                                                   references=references)
         else:
-            open(os.path.join(output_folder, os.path.basename(ref_file_handle).split('.')[0]+'_cov.txt'), 'a').close()
+            if references:
+                cov_files = [species + '_OGs_cov.txt' for species in references]
+            else:
+                cov_files = [os.path.basename(ref_file_handle).split('.')[0]+'_cov.txt']
+            for cov_file in cov_files:
+                open(os.path.join(output_folder, cov_file), 'a').close()
             return None
 
     def _read_mapping_from_folder(self, mapping_name=None, ref_records=None):
@@ -153,33 +205,27 @@ class Mapper(object):
             mapping_name = self._mapping_name
         in_folder = os.path.join(self.args.output_path,
                                  "04_mapping_"+mapping_name)
-        bam_files = glob.glob(os.path.join(in_folder, "*.bam"))
+        bam_files = glob.glob(os.path.join(in_folder, "*_OGs.fa.bam"))
         if self.args.min_cons_coverage >= 2 and bam_files:
             for file in tqdm(bam_files, desc='Generating consensus from bam files ', unit=' species'):
                 species = file.split("/")[-1].split("_")[0]
                 ref_file = os.path.join(self.args.output_path, '02_ref_dna',
                                  species+'_OGs.fa')
                 map_reads_species[species] = Reference()
-                self._output_shell(
-                    'samtools index -@ ' + str(self.args.threads) + ' ' +
-                    file)
-                consensus = self._build_consensus_seq_v2(ref_file, file)
+                pysam.index('-@', str(self.args.threads), file)
+                consensus = self._get_bam_statistics(
+                    file, os.path.join(in_folder, ref_file.split('/')[-1]
+                                       .split('.')[0] + "_cov.txt"))
                 records = []
 
-                for name, seqstr in consensus.items():
+                for name, seqstr in consensus.consensus.items():
                     seq = Seq.Seq(seqstr, generic_dna)
                     records.append(SeqRecord.SeqRecord(seq, id=name, description='', name=''))
                 map_reads_species[species].dna = records
 
-
-                cov = Coverage(self.args)
-                cov.get_coverage_bam(file)
-                cov.write_coverage_bam(os.path.join(
-                    in_folder, ref_file.split('/')[-1].split('.')[0] + "_cov.txt"))
-                self.all_cov.update(cov.coverage)
-
                 seqC = SeqCompleteness(mapped_ref=ref_records[species].dna)
-                seqC.get_seq_completeness(map_reads_species[species].dna)
+                seqC.get_seq_completeness(map_reads_species[species].dna,
+                                          missing=consensus.missing)
                 seqC.write_seq_completeness(os
                                             .path.join(in_folder,
                                                        species + "_OGs_sc.txt"))
@@ -189,40 +235,66 @@ class Mapper(object):
                              desc='Loading consensus read mappings ',
                              unit=' species'):
                 species = file.split("/")[-1].split("_")[0]
+                records, cov, sc = self._load_species_mapping(species,
+                                                              in_folder)
                 map_reads_species[species] = Reference()
-                fasta_reader = FastxReader(file)
-                records = []
-
-                with fasta_reader.open_fastx() as f:
-                    for name, seqstr in fasta_reader.readfa(f):
-                        seq = Seq.Seq(seqstr, generic_dna)
-                        records.append(SeqRecord.SeqRecord(seq, id=name.lstrip(">"), description='', name=''))
-                        map_reads_species[species].dna = records
-                cov = Coverage(self.args)
-                cov_file_name = os.path.join(in_folder, species + "_OGs_cov.txt")
-                for line in open(cov_file_name, "r"):
-                    if "#" not in line:
-                        values = line.split(",")
-                        cov.add_coverage(values[2]+"_"+values[1],
-                                         [float(values[3]),
-                                          float(values[4].replace("\n", ""))])
-                self.all_cov.update(cov.coverage)
-
-                seqC = SeqCompleteness()
-                seqC_file_name = os.path.join(in_folder, species + "_OGs_sc.txt")
-                for line in open(seqC_file_name, "r"):
-                    if "#" not in line:
-                        values = line.split(",")
-                        seqC.add_seq_completeness(values[2] + "_" + values[1],
-                                                  [float(values[3]),
-                                                   float(values[4]),
-                                                   int(values[5]),
-                                                   int(values[6]),
-                                                   int(values[7].replace("\n",
-                                                                         ""))])
-                self.all_sc.update(seqC.seq_completeness)
+                map_reads_species[species].dna = records
+                self.all_cov.update(cov)
+                self.all_sc.update(sc)
         return map_reads_species
 
+    def _load_species_mapping(self, species, in_folder):
+        """
+        Load the consensus sequences, coverage and sequence completeness of a
+        species from the mapping folder
+        :param species: reference species that was mapped against
+        :param in_folder: mapping folder
+        :return: tuple of list of consensus records (None if no consensus
+                 was built), coverage and sequence completeness dictionaries
+        """
+        records = None
+        consensus_file = os.path.join(in_folder, species + "_OGs_consensus.fa")
+        if os.path.exists(consensus_file):
+            fasta_reader = FastxReader(consensus_file)
+            records = []
+            with fasta_reader.open_fastx() as f:
+                for name, seqstr in fasta_reader.readfa(f):
+                    seq = Seq.Seq(seqstr, generic_dna)
+                    records.append(SeqRecord.SeqRecord(seq, id=name.lstrip(">"), description='', name=''))
+
+        cov = Coverage(self.args)
+        cov_file_name = os.path.join(in_folder, species + "_OGs_cov.txt")
+        for line in open(cov_file_name, "r"):
+            if "#" not in line:
+                values = line.split(",")
+                cov.add_coverage(values[2]+"_"+values[1],
+                                 [float(values[3]),
+                                  float(values[4].replace("\n", ""))])
+
+        seqC = SeqCompleteness()
+        seqC_file_name = os.path.join(in_folder, species + "_OGs_sc.txt")
+        if records is not None and os.path.exists(seqC_file_name):
+            for line in open(seqC_file_name, "r"):
+                if "#" not in line:
+                    values = line.split(",")
+                    seqC.add_seq_completeness(values[2] + "_" + values[1],
+                                              [float(values[3]),
+                                               float(values[4]),
+                                               int(values[5]),
+                                               int(values[6]),
+                                               int(values[7].replace("\n",
+                                                                     ""))])
+        return records, cov.coverage, seqC.seq_completeness
+
+    def _get_species_output_files(self, species):
+        """
+        Output files written to the mapping folder for a reference species
+        :param species: reference species
+        :return: list of file names
+        """
+        return [species + "_OGs_consensus.fa", species + "_OGs_cov.txt",
+                species + "_OGs_sc.txt"]
+
     def _make_tmpdir(self):
         '''
         Make tmpdir for analysis. This is important to run the code on the
@@ -252,7 +324,6 @@ class Mapper(object):
         start = time.time()
         print('--- Mapping of reads to reference sequences ---')
         mapped_reads_species = {}
-        reference_path = os.path.join(self.args.output_path, "02_ref_dna")
 
         output_folder = os.path.join(self.args.output_path,
                                      "04_mapping_"+self._species_name)
@@ -272,58 +343,91 @@ class Mapper(object):
         else:
             references = list(ref.keys())
 
-        # Going through provided references and starting mapping
-        for species in tqdm(references,
-                            desc='Mapping reads to species',
-                            unit=' species'):
-            self.logger.info('{}: --- Mapping of reads to {} reference species '
-                        '---'.format(self._species_name, species))
-
-            # write reference into temporary file
-            ref_file_handle = os.path.join(reference_path, species+'_OGs.fa')
-            ref_tmp_file_handle = os.path.join(tmp_output_folder.name,
-                                               species + '_OGs.fa')
-            shutil.copy(ref_file_handle, ref_tmp_file_handle)
-
-            # call the WRAPPER here
-            processed_reads = self._call_wrapper(ref_tmp_file_handle, reads,
-                                                 tmp_output_folder)
+        # Map only to the reference species closest to the reads, the others
+        # get an empty coverage file such that the mapping counts as finished
+        if self.args.max_ref_species and \
+                len(references) > self.args.max_ref_species:
+            sketch = Sketch(self.args)
+            with open_reads(reads) as read_files:
+                selected = sketch.select_species(ref, references, read_files,
+                                                 self.args.max_ref_species)
+            for species in references:
+                if species not in selected:
+                    open(os.path.join(output_folder,
+                                      species + '_OGs_cov.txt'), 'a').close()
+            references = selected
+
+        # Resume an interrupted mapping, the species recorded as completed
+        # in the manifest are loaded from the mapping folder
+        manifest = MappingManifest(output_folder)
+        completed = manifest.completed()
+        for species in [x for x in references if x in completed]:
+            mapped_reads, cov, sc = self._load_species_mapping(species,
+                                                               output_folder)
+            if mapped_reads is not None:
+                mapped_reads_species[species] = Reference()
+                mapped_reads_species[species].dna = mapped_reads
+            self.all_cov.update(cov)
+            self.all_sc.update(sc)
+        if completed.intersection(references):
+            self.logger.info('{}: Resuming mapping, {} of {} reference species '
+                             'were already completed.'
+                             .format(self._species_name,
+                                     len(completed.intersection(references)),
+                                     len(references)))
+            references = [x for x in references if x not in completed]
+
+        # Discard the reads that can not map to any of the references such
+        # that all mapping passes only see the reduced read set
+        if self.args.kmer_filter and references:
+            kmer_filter = KmerFilter(self.args,
+                                     [record for species in references
+                                      for record in ref[species].dna])
+            with open_reads(reads) as read_files:
+                reads = kmer_filter.filter_reads(read_files, read_container)
+
+        # ngm and ngmlr open their read input several times, streamed reads
+        # are written once and shared by all mapping jobs
+        if references:
+            reads = read_container.write_stream(reads)
+
+        # Going through provided references and starting mapping; with
+        # --mapping_jobs > 1 the species are mapped concurrently such that
+        # the mapping of one species overlaps the post-processing of another
+        jobs = [(species, self._get_species_ref(ref, species), reads,
+                 tmp_output_folder.name) for species in references]
+        # the threads are shared by the jobs that actually run concurrently
+        self._threads_per_job = max(1, self.args.threads // max(
+            1, min(self._mapping_jobs, len(jobs))))
+        if self.args.combined_mapping and len(references) > 1:
+            pool = None
+            results = self._map_combined_worker(references, ref, reads,
+                                                tmp_output_folder.name)
+        elif self._mapping_jobs > 1 and len(jobs) > 1:
+            pool = Pool(min(self._mapping_jobs, len(jobs)))
+            results = pool.imap_unordered(self._map_species_job, jobs)
+        else:
+            pool = None
+            results = (self._map_species_job(job) for job in jobs)
 
-            # postprocess mapping and build consensus
-            if processed_reads:
-                try:
-                    mapped_reads = list(SeqIO.parse(processed_reads, 'fasta'))
+        try:
+            for species, mapped_reads, cov, sc in tqdm(
+                    results, total=len(references),
+                    desc='Mapping reads to species', unit=' species'):
+                if mapped_reads is not None:
                     mapped_reads_species[species] = Reference()
                     mapped_reads_species[species].dna = mapped_reads
-
-
-                    # save some general statistics for mapped gene
-                    if self.args.remove_species_ogs:
-                        seqC = SeqCompleteness(mapped_ref=ref[species].dna,
-                                               tested_ref=ref[self.args.remove_species_ogs].dna)
-                    else:
-                        seqC = SeqCompleteness(mapped_ref=ref[species].dna)
-                    seqC.get_seq_completeness(mapped_reads)
-                    seqC.write_seq_completeness(os
-                                                .path.join(output_folder,
-                                                           species+"_OGs_sc.txt"))
-                    self.all_sc.update(seqC.seq_completeness)
-                except AttributeError as a:
-                    self.logger.debug('Reads not properly processed for further steps.')
-                    self.logger.debug('AttributeError: {}'.format(a))
-                except ValueError as v:
-                    self.logger.debug('Reads not properly processed for further steps.')
-                    self.logger.debug('ValueError: {}'.format(v))
-                except TypeError as t:
-                    self.logger.debug('Reads not properly processed for further steps.')
-                    self.logger.debug('TypeError: {}'.format(t))
-                else:
-                    mapped_reads = []
-
-                # self.progress.set_status('single_map', ref=species)
-                self._rm_file(ref_file_handle+".fai", ignore_error=True)
+                self.all_cov.update(cov)
+                self.all_sc.update(sc)
+                manifest.record(species,
+                                self._get_species_output_files(species))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
 
         tmp_output_folder.cleanup()
+        read_container.cleanup()
         end = time.time()
         self.elapsed_time = end - start
         if len(references) > 1:
@@ -332,6 +436,217 @@ class Mapper(object):
                                 self.elapsed_time))
         return mapped_reads_species
 
+    def _get_mapper_signature(self):
+        """
+        :return: string describing the mapper and the parameters that
+                 determine its reference index
+        """
+        if len(self._reads) != 2 and 'long' in self.args.read_type:
+            return 'ngmlr:{}'.format(self.args.ngmlr_parameters)
+        return 'ngm'
+
+    @contextmanager
+    def _reference_for_mapping(self, ref_file, tmp_folder):
+        """
+        Provide the reference file the mapper is run on. This is either a
+        copy in the temporary folder or, if --index_cache is set, the cached
+        copy next to which the mapper index is kept.
+        :param ref_file: reference fasta file
+        :param tmp_folder: path of temporary folder used for mapping
+        :return: path of the reference file to map against
+        """
+        if self._index_cache:
+            with self._index_cache.reference(
+                    ref_file, self._get_mapper_signature(),
+                    build_index=self._build_index) as cached_ref:
+                yield cached_ref
+        else:
+            ref_tmp_file = os.path.join(tmp_folder, os.path.basename(ref_file))
+            if ref_tmp_file != ref_file:
+                shutil.copy(ref_file, ref_tmp_file)
+            yield ref_tmp_file
+
+    def _build_index(self, ref_file):
+        """
+        Build the ngm / ngmlr index next to a reference by mapping an empty
+        read file against it
+        :param ref_file: reference fasta file
+        :return: whether the index files were written
+        """
+        with tempfile.TemporaryDirectory(
+                prefix='ngm_index_', dir=os.environ.get("TMPDIR")) as tmp_folder:
+            reads = os.path.join(tmp_folder, 'empty.fq')
+            open(reads, 'w').close()
+            if len(self._reads) != 2 and 'long' in self.args.read_type:
+                ngm_wrapper = NGMLR(ref_file, reads, tmp_folder)
+                if self.args.ngmlr_parameters != None:
+                    par = self.args.ngmlr_parameters.split(',')
+                    ngm_wrapper.options.options['-x'].set_value(str(par[0]))
+                    ngm_wrapper.options \
+                               .options['--subread-length'].set_value(int(par[1]))
+                    ngm_wrapper.options.options['-R'].set_value(float(par[2]))
+            else:
+                ngm_wrapper = NGM(ref_file, reads, tmp_folder)
+            ngm_wrapper.options.options['-t'].set_value(self._threads_per_job)
+            try:
+                ngm_wrapper()
+            except Exception as e:
+                self.logger.debug('{}: Building the index of {} failed: {}'
+                                  .format(self._species_name,
+                                          os.path.basename(ref_file), e))
+        return bool(glob.glob(ref_file + '-enc.*.ngm')) and \
+            bool(glob.glob(ref_file + '-ht-*.ngm'))
+
+    def _get_species_ref(self, ref, species):
+        """
+        Select the references needed to map to a single species, such that
+        only these have to be passed to a worker process
+        :param ref: dictionary with all reference species
+        :param species: reference species to map against
+        :return: dictionary with the required reference species
+        """
+        return {key: ref[key] for key in (species, self.args.remove_species_ogs)
+                if key in ref}
+
+    def _map_species_job(self, job):
+        return self._map_species_worker(*job)
+
+    def _map_species_worker(self, species, ref, reads, tmp_folder):
+        """
+        Map the reads to a single reference species and build the consensus
+        sequences. This is run either sequentially or in a worker process
+        of the mapping pool.
+        :param species: reference species to map against
+        :param ref: dictionary with the reference species
+        :param reads: read file(s) used for mapping
+        :param tmp_folder: path of temporary folder used for mapping
+        :return: tuple of species, list of consensus records, coverage and
+                 sequence completeness dictionaries of this species
+        """
+        self.logger.info('{}: --- Mapping of reads to {} reference species '
+                    '---'.format(self._species_name, species))
+        reference_path = os.path.join(self.args.output_path, "02_ref_dna")
+
+        # collect the statistics of this species only, such that they can
+        # be merged by the scheduler
+        all_cov, all_sc = self.all_cov, self.all_sc
+        self.all_cov, self.all_sc = {}, {}
+        mapped_reads = None
+        try:
+            # write reference into temporary file or get it from the cache
+            ref_file_handle = os.path.join(reference_path, species+'_OGs.fa')
+            with self._reference_for_mapping(ref_file_handle,
+                                             tmp_folder) as ref_tmp_file_handle, \
+                    open_reads(reads) as read_files:
+                # call the WRAPPER here
+                processed_reads = self._call_wrapper(ref_tmp_file_handle,
+                                                     read_files, tmp_folder)
+
+            # postprocess mapping and build consensus
+            if processed_reads:
+                mapped_reads = self._get_mapped_records(species, ref,
+                                                        processed_reads)
+                # self.progress.set_status('single_map', ref=species)
+                self._rm_file(ref_file_handle+".fai", ignore_error=True)
+            return species, mapped_reads, self.all_cov, self.all_sc
+        finally:
+            self.all_cov, self.all_sc = all_cov, all_sc
+
+    def _map_combined_worker(self, references, ref, reads, tmp_folder):
+        """
+        Map the reads in a single pass against one reference that combines
+        all reference species. The contigs are prefixed by their species
+        such that the mapping can be split by species afterwards. ngm reports
+        the --topn best alignments of every read across all species, with n
+        the number of species, and the best of them within each species is
+        kept. This only approximates the mapping per species: hits to
+        paralogs or to a closely related species can take the place of the
+        alignment to another species, which then misses the read. ngmlr has
+        no such option, long reads are only assigned to their best hit
+        across all species.
+        :param references: list of reference species to map against
+        :param ref: dictionary with the reference species
+        :param reads: read file(s) used for mapping
+        :param tmp_folder: path of temporary folder used for mapping
+        :return: list of tuples of species, list of consensus records,
+                 coverage and sequence completeness dictionaries
+        """
+        self.logger.info('{}: --- Mapping of reads to combined reference of {} '
+                         'species ---'.format(self._species_name, len(references)))
+        if len(self._reads) != 2 and 'long' in self.args.read_type:
+            self.logger.warning('{}: Long reads are only assigned to their '
+                                'best hit across all species, the coverage of '
+                                'closely related species is lower than with '
+                                'a mapping per species.'
+                                .format(self._species_name))
+        ref_tmp_file_handle = os.path.join(tmp_folder, 'combined_OGs.fa')
+        with open(ref_tmp_file_handle, 'w') as handle:
+            writer = FastaWriter(handle, wrap=None)
+            writer.write_file(
+                SeqRecord.SeqRecord(record.seq,
+                                    id=species + COMBINED_REF_SEP + record.id,
+                                    description='')
+                for species in references for record in ref[species].dna)
+
+        with self._reference_for_mapping(ref_tmp_file_handle,
+                                         tmp_folder) as ref_file_handle, \
+                open_reads(reads) as read_files:
+            processed_reads = self._call_wrapper(ref_file_handle, read_files,
+                                                 tmp_folder,
+                                                 references=references)
+        results = []
+        for species in references:
+            all_cov, all_sc = self.all_cov, self.all_sc
+            self.all_cov, self.all_sc = {}, {}
+            try:
+                mapped_reads = None
+                if processed_reads and processed_reads.get(species):
+                    mapped_reads = self._get_mapped_records(
+                        species, ref, processed_reads[species])
+                results.append((species, mapped_reads, self.all_cov,
+                                self.all_sc))
+            finally:
+                self.all_cov, self.all_sc = all_cov, all_sc
+        return results
+
+    def _get_mapped_records(self, species, ref, processed_reads):
+        """
+        Load the consensus sequences of a species and compute their sequence
+        completeness
+        :param species: reference species that was mapped against
+        :param ref: dictionary with the reference species
+        :param processed_reads: consensus file of this species
+        :return: list of consensus records
+        """
+        output_folder = os.path.join(self.args.output_path,
+                                     "04_mapping_"+self._species_name)
+        mapped_reads = None
+        try:
+            mapped_reads = list(SeqIO.parse(processed_reads, 'fasta'))
+
+            # save some general statistics for mapped gene
+            if self.args.remove_species_ogs:
+                seqC = SeqCompleteness(mapped_ref=ref[species].dna,
+                                       tested_ref=ref[self.args.remove_species_ogs].dna)
+            else:
+                seqC = SeqCompleteness(mapped_ref=ref[species].dna)
+            seqC.get_seq_completeness(mapped_reads,
+                                      missing=self._consensus_missing)
+            seqC.write_seq_completeness(os
+                                        .path.join(output_folder,
+                                                   species+"_OGs_sc.txt"))
+            self.all_sc.update(seqC.seq_completeness)
+        except AttributeError as a:
+            self.logger.debug('Reads not properly processed for further steps.')
+            self.logger.debug('AttributeError: {}'.format(a))
+        except ValueError as v:
+            self.logger.debug('Reads not properly processed for further steps.')
+            self.logger.debug('ValueError: {}'.format(v))
+        except TypeError as t:
+            self.logger.debug('Reads not properly processed for further steps.')
+            self.logger.debug('TypeError: {}'.format(t))
+        return mapped_reads
+
     def _write_read_query_aling(self, read, og_name_file, write_mode):
         """
 
@@ -495,34 +810,20 @@ class Mapper(object):
         :param bam_file:
         :return:
         """
-        bam = pysam.AlignmentFile(bam_file)
-        references = list(set([read.reference_name for read in bam.fetch()]))
-        records = {rec.id: rec for rec in list(SeqIO.parse(ref_file, "fasta"))}
-        new_records = {}
-        for ref in references:
-            #     self.logger.info(read.qual)
-            seq = list('N' * len(records[ref]))
-            for pileup_column in bam.pileup(ref, 0, 10000000):
-                # TODO: improve the selection of a column by its quality
-                # qualities = [pileupread.alignment.query_alignment_qualities[pileupread.query_position] for pileupread in
-                #        pileupcolumn.pileups if not pileupread.is_del and not pileupread.is_refskip]
-                bases = [pileupread.alignment.query_sequence
-                     [pileupread.query_position] for pileupread in
-                     pileup_column.pileups if not pileupread.is_del and
-                     not pileupread.is_refskip and pileup_column.n >= self.args.min_cons_coverage]
-                if bases:
-                    seq[pileup_column.pos] = self._most_common(bases)
-            if len(set(seq)) > 1:  # make sure that mapped sequence contains not only N
-                new_records[ref] = ("").join(seq)
-        return new_records
+        consensus = Consensus(self.args)
+        consensus.get_consensus_bam(bam_file)
+        return consensus.consensus
 
-    def _post_process_read_mapping(self, ref_file, bam_file):
+    def _post_process_read_mapping(self, ref_file, bam_file, references=None):
         """
         Function that will perform postprocessing of finished read mapping
         using the pysam functionality
-        :param ngm:
-        :param reference_file_handle:
-        :return:
+        :param ref_file: reference file used for mapping
+        :param bam_file: bam / sam file produced by the mapper
+        :param references: list of species contained in a combined
+                           reference, None for a single species reference
+        :return: consensus file or, for a combined reference, dictionary with
+                 species as key and consensus file as value
         """
         # self.logger.info("--- Postprocessing reads to {} ---".format(self._species_name))
         output_folder = os.path.join(self.args.output_path,
@@ -535,45 +836,279 @@ class Mapper(object):
             self.logger.debug("{}: --- POSTPROCESSING MAPPING "
                          "---".format(self._species_name))
 
-        # ngmlr doesn't have the option to write in bam file directly
-        if 'sam' in bam_file.split(".")[-1]:
-            sam_file = bam_file
-            bam_file = sam_file.replace(".sam", ".bam")
-            if os.path.exists(sam_file):
-                self._output_shell(
-                    'samtools view -F 4 -bh -S -@ ' + str(self.args.threads) +
-                    ' -o ' + bam_file + " " + sam_file)
+        sorted_bam = outfile_name + "_sorted.bam"
+        self._sort_and_index_bam(bam_file, sorted_bam)
         if self.args.single_mapping:
-            self.logger.debug("{}: ---- Samtools view completed"
+            self.logger.debug("{}: ---- Samtools sort and index completed"
                          .format(self._species_name))
+        if not references:
+            shutil.copy(sorted_bam, os.path.join(
+                output_folder, os.path.basename(ref_file) + '.bam'))
 
-        if os.path.exists(bam_file):
-            self._output_shell(
-                'samtools sort -m 2G  -@ ' + str(self.args.threads) +
-                ' -o ' + outfile_name + "_sorted.bam " + bam_file)
-        if self.args.single_mapping:
-            self.logger.debug("{}: ---- Samtools sort completed"
-                         .format(self._species_name))
+        # self._rm_file(bam_file, ignore_error=True)
+        if references:
+            out_files = {}
+            species_bams = self._split_bam_by_species(
+                sorted_bam, references)
+            for species, species_bam in species_bams.items():
+                if species_bam:
+                    shutil.copy(species_bam, os.path.join(
+                        output_folder, species + '_OGs.fa.bam'))
+                    out_files[species] = self._build_consensus_and_coverage(
+                        os.path.join(self.args.output_path, '02_ref_dna',
+                                     species + '_OGs.fa'), species_bam)
+                else:
+                    open(os.path.join(output_folder, species + '_OGs_cov.txt'),
+                         'a').close()
+                    out_files[species] = None
+            return out_files
 
-        if os.path.exists(outfile_name + "_sorted.bam"):
-            self._output_shell(
-                'samtools index -@ ' + str(self.args.threads) + ' ' +
-                outfile_name + "_sorted.bam")
-        if self.args.single_mapping:
-            self.logger.debug("{}: ---- Samtools index completed"
-                         .format(self._species_name))
+        return self._build_consensus_and_coverage(ref_file, sorted_bam)
 
-        # self._rm_file(bam_file, ignore_error=True)
+    def _sort_and_index_bam(self, bam_file, sorted_bam):
+        """
+        Sort the mapping in memory bounded chunks and index it. The sam file
+        written by ngmlr is piped through samtools view, which removes the
+        unmapped reads, directly into samtools sort such that no intermediate
+        bam file is written. The temporary chunks of the sort are written
+        next to the sorted bam file in the tmp folder on the local node.
+        :param bam_file: bam / sam file produced by the mapper
+        :param sorted_bam: file name of the sorted bam file
+        """
+        sort_args = ['-m', '2G', '-@', str(self._threads_per_job),
+                     '-T', sorted_bam + '.tmp', '-o', sorted_bam]
+        # ngmlr doesn't have the option to write in bam file directly
+        if 'sam' in bam_file.split(".")[-1]:
+            with tempfile.TemporaryFile() as view_err:
+                view = subprocess.Popen(
+                    ['samtools', 'view', '-u', '-F', '4', bam_file],
+                    stdout=subprocess.PIPE, stderr=view_err)
+                sort = subprocess.Popen(['samtools', 'sort'] + sort_args +
+                                        ['-'], stdin=view.stdout,
+                                        stdout=subprocess.PIPE,
+                                        stderr=subprocess.PIPE)
+                view.stdout.close()
+                sort_err = sort.communicate()[1]
+                view.wait()
+                view_err.seek(0)
+                for name, process, err in \
+                        (('view', view, view_err.read()),
+                         ('sort', sort, sort_err)):
+                    if process.returncode != 0:
+                        raise pysam.utils.SamtoolsError(
+                            'samtools {} of {} returned with error {}: {}'
+                            .format(name, bam_file, process.returncode,
+                                    err.decode(errors='replace')))
+        else:
+            pysam.sort(*(sort_args + [bam_file]))
+        pysam.index('-@', str(self._threads_per_job), sorted_bam)
+
+    def _split_bam_by_species(self, bam_file, references):
+        """
+        Split the sorted mapping to a combined reference into one sorted and
+        indexed bam file per species. The species prefix is removed from the
+        contig names and only the best reported alignment of every read
+        within the species is kept as primary alignment. Reads without a
+        reported alignment to a species are missing from its file.
+        :param bam_file: sorted and indexed bam file of the combined mapping
+        :param references: list of species contained in the combined reference
+        :return: dictionary with species as key and bam file as value, None
+                 if no read was mapped to this species
+        """
+        species_bams = {}
+        with pysam.AlignmentFile(bam_file, 'rb') as bam:
+            contigs = {}
+            for name, length in zip(bam.references, bam.lengths):
+                species = name.split(COMBINED_REF_SEP, 1)[0]
+                contigs.setdefault(species, []).append((name, length))
+            selected = {species: self._select_best_alignments(
+                bam, [name for name, _ in contigs.get(species, [])])
+                for species in references}
+            # secondary alignments may be stored without their sequence
+            missing = {key[0] for best in selected.values()
+                       for key, alignment in best.items() if not alignment[5]}
+            sequences = self._get_primary_sequences(bam, missing)
+            for species in references:
+                prefix = species + COMBINED_REF_SEP
+                header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+                          'SQ': [{'SN': name[len(prefix):], 'LN': length}
+                                 for name, length in contigs.get(species, [])]}
+                species_bam = os.path.join(os.path.dirname(bam_file),
+                                           species + '_OGs_post_sorted.bam')
+                num_reads = 0
+                with pysam.AlignmentFile(species_bam, 'wb',
+                                         header=header) as out_bam:
+                    for name, _ in contigs.get(species, []):
+                        for read in bam.fetch(name):
+                            read = self._move_to_species(
+                                read, prefix, out_bam.header,
+                                selected[species], sequences)
+                            if read is not None:
+                                out_bam.write(read)
+                                num_reads += 1
+                if num_reads > 0:
+                    pysam.index(species_bam)
+                    species_bams[species] = species_bam
+                else:
+                    self._rm_file(species_bam, ignore_error=True)
+                    species_bams[species] = None
+        return species_bams
+
+    def _get_alignment_key(self, read):
+        """
+        :param read: pysam read object
+        :return: tuple of read name and mate flags identifying the read
+        """
+        return read.query_name, read.flag & 0xC0
+
+    def _select_best_alignments(self, bam, contigs):
+        """
+        Find the best alignment of every read to the contigs of a species,
+        which is the one with the highest alignment score, preferring the
+        primary alignment on ties
+        :param bam: pysam AlignmentFile of the combined mapping
+        :param contigs: names of the contigs of the species
+        :return: dictionary with the alignment key as value and tuple of
+                 score, primary flag, contig, start, reverse flag, whether
+                 the sequence is stored and end as value
+        """
+        best = {}
+        for name in contigs:
+            for read in bam.fetch(name):
+                if read.is_unmapped or read.is_supplementary:
+                    continue
+                score = read.get_tag('AS') if read.has_tag('AS') else \
+                    -read.get_tag('NM') if read.has_tag('NM') else 0
+                alignment = (score, not read.is_secondary, name,
+                             read.reference_start, read.is_reverse,
+                             read.query_sequence is not None,
+                             read.reference_end)
+                key = self._get_alignment_key(read)
+                if key not in best or alignment[:2] > best[key][:2]:
+                    best[key] = alignment
+        return best
+
+    def _get_primary_sequences(self, bam, read_names):
+        """
+        Collect the sequence of the primary alignment of reads
+        :param bam: pysam AlignmentFile of the combined mapping
+        :param read_names: set of read names
+        :return: dictionary with the alignment key as key and tuple of
+                 sequence, qualities and reverse flag as value
+        """
+        sequences = {}
+        if not read_names:
+            return sequences
+        for read in bam.fetch():
+            if read.is_secondary or read.is_supplementary or \
+                    read.query_name not in read_names or \
+                    read.query_sequence is None:
+                continue
+            sequences[self._get_alignment_key(read)] = \
+                (read.query_sequence, read.query_qualities, read.is_reverse)
+        return sequences
+
+    def _move_to_species(self, read, prefix, header, selected, sequences):
+        """
+        Move the best alignment of a read within a species to the header of
+        this species as its primary alignment. The mate information is set
+        from the best alignment of the mate within the same species.
+        :param read: pysam read object of the combined mapping
+        :param prefix: species prefix of the contig names
+        :param header: header of the species bam file
+        :param selected: best alignments of the species
+        :param sequences: sequences of the primary alignments of reads whose
+                          selected alignment is stored without sequence
+        :return: pysam read object or None if it is not the best alignment of
+                 the read within the species
+        """
+        if read.is_unmapped:
+            return None
+        key = self._get_alignment_key(read)
+        ref_name = read.reference_name
+        if not read.is_supplementary:
+            alignment = selected.get(key)
+            if alignment is None or \
+                    alignment[2:5] != (ref_name, read.reference_start,
+                                       read.is_reverse):
+                return None
+        read_dict = read.to_dict()
+        read_dict['ref_name'] = ref_name[len(prefix):]
+        flag = read.flag & ~0x100
+        if read.query_sequence is None and key in sequences:
+            seq, qual, is_reverse = sequences[key]
+            if is_reverse != read.is_reverse:
+                seq = str(Seq.Seq(seq).reverse_complement())
+                qual = qual[::-1] if qual is not None else None
+            if len(seq) == read.infer_read_length():
+                read_dict['seq'] = seq
+                read_dict['qual'] = pysam.array_to_qualitystring(qual) \
+                    if qual is not None else '*'
+        if read.is_paired:
+            mate = selected.get((read.query_name, 0xC0 - (read.flag & 0xC0)))
+            if mate is None:
+                # mate not mapped to this species
+                flag = (flag | 0x8) & ~0x22
+                read_dict['next_ref_name'] = '*'
+                read_dict['next_ref_pos'] = '0'
+                read_dict['length'] = '0'
+            else:
+                flag = (flag & ~0x28) | (0x20 if mate[4] else 0)
+                read_dict['next_ref_pos'] = str(mate[3] + 1)
+                if mate[2] == ref_name:
+                    read_dict['next_ref_name'] = '='
+                    both_primary = mate[1] and not read.is_secondary
+                    if not both_primary and mate[4] != read.is_reverse:
+                        flag |= 0x2
+                    elif not both_primary:
+                        flag &= ~0x2
+                    if not both_primary:
+                        read_dict['length'] = str(self._get_template_length(
+                            read, mate[3], mate[6]))
+                else:
+                    # mate mapped to another contig of this species
+                    read_dict['next_ref_name'] = mate[2][len(prefix):]
+                    read_dict['length'] = '0'
+                    flag &= ~0x2
+        read_dict['flag'] = str(flag)
+        return pysam.AlignedSegment.from_dict(read_dict, header)
+
+    def _get_template_length(self, read, mate_start, mate_end):
+        """
+        Template length of a read and its mate aligned to the same contig
+        :param read: pysam read object
+        :param mate_start: 0-based start of the mate
+        :param mate_end: 0-based end of the mate
+        :return: template length, negative for the rightmost mate
+        """
+        length = max(read.reference_end, mate_end) - \
+            min(read.reference_start, mate_start)
+        if read.reference_start < mate_start or \
+                (read.reference_start == mate_start and read.is_read1):
+            return length
+        return -length
+
+    def _build_consensus_and_coverage(self, ref_file, sorted_bam):
+        """
+        Build the consensus sequences and the coverage of a sorted and
+        indexed mapping to the reference of a single species
+        :param ref_file: reference file of the species
+        :param sorted_bam: sorted and indexed bam file
+        :return: consensus file or None if no consensus was built
+        """
+        output_folder = os.path.join(self.args.output_path,
+                                     "04_mapping_"+self._species_name)
         if self.args.debug:
-            self._bin_reads(ref_file, outfile_name + '_sorted.bam')
+            self._bin_reads(ref_file, sorted_bam)
 
-        consensus = self._build_consensus_seq_v2(ref_file, outfile_name +
-                                                 '_sorted.bam')
+        consensus = self._get_bam_statistics(
+            sorted_bam, os.path.join(output_folder, ref_file.split('/')[-1]
+                                     .split('.')[0] + "_cov.txt"))
 
         all_consensus = []
-        if consensus:
+        if consensus.consensus:
             try:
-                for key, value in consensus.items():
+                for key, value in consensus.consensus.items():
                     seq = Seq.Seq(value, generic_dna)
                     record = SeqRecord.SeqRecord(seq, id=key, description='')
                     all_consensus.append(record)
@@ -594,14 +1129,26 @@ class Mapper(object):
         else:
             out_file = None
 
+        return out_file
+
+    def _get_bam_statistics(self, sorted_bam, cov_file):
+        """
+        Read a sorted bam file once to build the consensus sequences, the
+        coverage and the number of uncalled positions of every reference
+        :param sorted_bam: sorted bam file
+        :param cov_file: file the coverage is written to
+        :return: Consensus object
+        """
+        consensus = Consensus(self.args)
+        consensus.get_consensus_bam(sorted_bam)
+        self._consensus_missing.update(consensus.missing)
+
         # Get effective coverage of each mapped sequence
         cov = Coverage(self.args)
-        cov.get_coverage_bam(outfile_name + "_sorted.bam")
-        cov.write_coverage_bam(os.path.join(
-            output_folder, ref_file.split('/')[-1].split('.')[0] + "_cov.txt"))
+        cov.get_coverage_consensus(consensus)
+        cov.write_coverage_bam(cov_file)
         self.all_cov.update(cov.coverage)
-
-        return out_file
+        return consensus
 
     def _rm_file(self, *fns, ignore_error=False):
         for fn in fns:
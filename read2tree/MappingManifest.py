@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+    This file contains the definition of an append-only manifest that records
+    the reference species whose mapping has been completed together with the
+    checksums of their output files. An interrupted mapping stage can thereby
+    be resumed by mapping only the species missing from the manifest.
+'''
+
+import os
+import hashlib
+import logging
+
+MANIFEST_FILE = 'mapping_manifest.txt'
+
+
+class MappingManifest(object):
+
+    def __init__(self, folder):
+        """
+
+        :param folder: mapping folder holding the output files of the species
+        """
+        self.folder = folder
+        self.manifest_file = os.path.join(self.folder, MANIFEST_FILE)
+
+        self.logger = logging.getLogger(__name__)
+
+    def _get_md5(self, file):
+        md5 = hashlib.md5()
+        with open(os.path.join(self.folder, file), 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                md5.update(block)
+        return md5.hexdigest()
+
+    def record(self, species, files):
+        """
+        Append a completed species to the manifest. The entry is written
+        with a single write to a file opened in append mode and synced to
+        disk, such that concurrent jobs do not interleave and an interrupted
+        write leaves at most an incomplete last line behind.
+        :param species: reference species whose mapping is completed
+        :param files: output files of this species within the folder, the
+                      ones that do not exist are skipped
+        """
+        entries = ['{}:{}'.format(file, self._get_md5(file)) for file in files
+                   if os.path.exists(os.path.join(self.folder, file))]
+        line = '\t'.join([species] + entries) + '\n'
+        fd = os.open(self.manifest_file,
+                     os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def completed(self):
+        """
+        Get the species recorded in the manifest whose output files are
+        still present and unchanged
+        :return: set of completed species
+        """
+        if not os.path.exists(self.manifest_file):
+            return set()
+        entries = {}
+        with open(self.manifest_file, 'r') as f:
+            for line in f:
+                if not line.endswith('\n'):  # interrupted write
+                    break
+                values = line.rstrip('\n').split('\t')
+                entries[values[0]] = [value.rsplit(':', 1)
+                                      for value in values[1:]]
+
+        completed = set()
+        for species, files in entries.items():
+            try:
+                if all(self._get_md5(file) == md5 for file, md5 in files):
+                    completed.add(species)
+                    continue
+            except (OSError, ValueError):
+                pass
+            self.logger.debug('Output files of {} changed since the '
+                              'mapping was completed.'.format(species))
+        return completed
@@ -7,13 +7,12 @@
 import glob
 import os
 import re
-import pyham
-import requests
 import logging
 import random
 import time
 import numpy as np
-import gzip
+import pysam
+import tempfile
 
 from tqdm import tqdm
 from collections import OrderedDict
@@ -26,10 +25,11 @@ from Bio.SeqIO.FastaIO import FastaWriter
 from read2tree.stats.Coverage import Coverage
 from read2tree.stats.SeqCompleteness import SeqCompleteness
 from read2tree.FastxReader import FastxReader
+from read2tree.parser import OrthoXMLParser
+from read2tree.OMARestClient import OMARestClient, get_protein_id
 
 OMA_STANDALONE_OUTPUT = 'Output'
 OMA_MARKER_GENE_EXPORT = 'marker_genes'
-API_URL = 'http://omabrowser.org/api'
 
 
 class OGSet(object):
@@ -48,7 +48,8 @@ class OGSet(object):
         self._reads = self.args.reads
         self._species_name = self.args.species_name
 
-        self._ham_analysis = None
+        self._prot_id_index = {}
+        self._rest_client = None
 
         self.progress = progress
         # self.progress.get_status(species_name=self._species_name)
@@ -119,24 +120,31 @@ class OGSet(object):
         if self.oma.mode == 'standalone':
             og_orthoxml = os.path.join(self.oma_output_path,
                                        'OrthologousGroups.orthoxml')
-            tree_str = os.path.join(self.oma_output_path,
-                                    'EstimatedSpeciesTree.nwk')
-            self._ham_analysis = pyham.Ham(tree_str, og_orthoxml,
-                                     use_internal_name=False)
+            orthoxml = OrthoXMLParser(og_orthoxml,
+                                      og_ids=[name[2:] for name in self.ogs])
+            self._prot_id_index = {
+                name: self._get_prot_id_index(orthoxml.get_prot_ids(name[2:]))
+                for name in self.ogs}
+
+    def _get_prot_id_index(self, prot_ids):
+        """
+        Index the protein IDs of the genes of an OG by their species code,
+        for a species with several genes the first one is indexed
+        :param prot_ids: protein IDs of the genes of the OG
+        :return: dictionary with the first 5 characters of the protein IDs
+                 as key and protein ID as value
+        """
+        index = {}
+        for prot_id in prot_ids:
+            index.setdefault(prot_id[0:5], prot_id)
+        return index
 
     def _load_dna_db(self):
         if '.fa' in self.args.dna_reference or \
            '.fasta' in self.args.dna_reference:
-            db = {}
             self.logger.info('--- Load ogs and find their corresponding '
                   'DNA seq from {} ---'.format(self.args.dna_reference))
-            self.logger.info('Loading {} into memory. This might take a '
-                'while . . . '.format(self.args.dna_reference.split("/")[-1]))
-
-            open_ = gzip.open if self.args.dna_reference.endswith('.gz') else open
-            with open_(self.args.dna_reference, 'rt') as f:
-                for rec in SeqIO.parse(f, 'fasta'):
-                    db[rec.id.strip()] = str(rec.seq)
+            db = self._open_dna_index(self.args.dna_reference)
             source = 'fa'
             return db, source
         # ---------------- only to be used internally ----------------------
@@ -156,6 +164,100 @@ class OGSet(object):
             source = 'REST_api'
             return None, source
 
+    def _open_dna_index(self, dna_reference):
+        """
+        Open the DNA reference as indexed fasta file, such that sequences
+        are read from disk on lookup instead of keeping the whole reference
+        in memory. The faidx index of an uncompressed or bgzip compressed
+        reference is built once next to it, or in the output path if its
+        folder is not writable. A gzip compressed reference is first
+        re-compressed with bgzip into such an indexed store.
+        :param dna_reference: fasta file with the DNA sequences
+        :return: pysam.FastaFile
+        """
+        store = self._get_dna_store_path(
+            re.sub(r'\.gz$', '', dna_reference) + '.bgz')
+        if not dna_reference.endswith('.gz') or \
+                self._is_bgzf(dna_reference):
+            try:
+                return self._open_fasta_index(dna_reference)
+            except (pysam.SamtoolsError, OSError):
+                # e.g. sequences on lines of different length
+                self.logger.info('{}: {} can not be indexed directly.'
+                                 .format(self._species_name, dna_reference))
+        if not self._is_up_to_date(store, dna_reference):
+            self._build_dna_store(dna_reference, store)
+        return self._open_fasta_index(store)
+
+    def _open_fasta_index(self, fasta):
+        """
+        Open an uncompressed or bgzip compressed fasta file with its faidx
+        index, which is built if it is missing or older than the file
+        :param fasta: fasta file
+        :return: pysam.FastaFile
+        """
+        index = self._get_dna_store_path(fasta + '.fai')
+        gzindex = self._get_dna_store_path(fasta + '.gzi') \
+            if self._is_bgzf(fasta) else None
+        if not self._is_up_to_date(index, fasta):
+            self.logger.info('{}: Indexing {}. This is done only once.'
+                             .format(self._species_name, fasta))
+            faidx_args = [fasta, '--fai-idx', index]
+            if gzindex:
+                faidx_args += ['--gzi-idx', gzindex]
+            pysam.faidx(*faidx_args)
+        return pysam.FastaFile(fasta, filepath_index=index,
+                               filepath_index_compressed=gzindex)
+
+    def _get_dna_store_path(self, file):
+        """
+        :param file: file to be written next to the DNA reference
+        :return: the file or, if its folder is not writable, the file of the
+                 same name in the output path
+        """
+        if os.access(os.path.dirname(os.path.abspath(file)), os.W_OK) or \
+                os.path.exists(file):
+            return file
+        return os.path.join(self._make_output_path('dna_reference'),
+                            os.path.basename(file))
+
+    def _is_up_to_date(self, file, source):
+        return os.path.exists(file) and \
+            os.path.getmtime(file) >= os.path.getmtime(source)
+
+    def _is_bgzf(self, file):
+        # bgzip blocks are gzip members with the extra subfield BC
+        with open(file, 'rb') as f:
+            header = f.read(14)
+        return len(header) == 14 and header[:2] == b'\x1f\x8b' and \
+            header[3] & 4 and header[12:14] == b'BC'
+
+    def _build_dna_store(self, dna_reference, store):
+        """
+        Re-compress a gzip compressed fasta file with bgzip, writing each
+        sequence on a single line
+        :param dna_reference: gzip compressed fasta file
+        :param store: bgzip compressed fasta file to write
+        """
+        self.logger.info('{}: Writing indexed copy of {} to {}. This is done '
+                         'only once.'.format(self._species_name,
+                                             dna_reference, store))
+        fastx_reader = FastxReader(dna_reference)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(store),
+                                         suffix='.bgz', delete=False) as tmp:
+            pass
+        try:
+            with fastx_reader.open_fastx() as f, \
+                    pysam.BGZFile(tmp.name, 'wb') as out:
+                for name, seq, _ in tqdm(fastx_reader.readfx_bytes(f),
+                                         desc='Writing DNA store',
+                                         unit=' sequences'):
+                    out.write(name.split(None, 1)[0] + b'\n' + seq + b'\n')
+            os.replace(tmp.name, store)
+        finally:
+            if os.path.exists(tmp.name):
+                os.remove(tmp.name)
+
     def _load_ogs(self):
         """
         Using the orthoxml file select only the OGs of interest
@@ -172,11 +274,21 @@ class OGSet(object):
 
         names_og = self.ogs
 
-        for name, records in tqdm(names_og.items(), desc='Loading OGs',
-                                  unit=' OGs'):
-            # name = file.split("/")[-1].split(".")[0]
+        for name, records in names_og.items():
             ogs[name] = OG()
             ogs[name].aa = self._get_aa_records(name, records)
+
+        # the DNA missing from the reference is retrieved from the REST api
+        # in bulk for all OGs at once
+        protein_ids = [record.id for og in ogs.values() for record in og.aa]
+        if db is not None:
+            protein_ids = [x for x in protein_ids if x.split("_")[0] not in db]
+        if protein_ids:
+            self._get_rest_client().prefetch(
+                get_protein_id(x) for x in protein_ids)
+
+        for name in tqdm(names_og, desc='Loading OGs', unit=' OGs'):
+            # name = file.split("/")[-1].split(".")[0]
             output_file_aa = os.path.join(orthologous_groups_aa,
                                           name + ".fa")
             output_file_dna = os.path.join(orthologous_groups_dna,
@@ -202,10 +314,12 @@ class OGSet(object):
         self.elapsed_time = end-start
         self.logger.info('{}: Gathering of DNA seq for {} OGs took {}.'
                          .format(self._species_name, len(names_og.keys()), self.elapsed_time))
-        if db:
-            db.clear()
-        if self._ham_analysis:
-            self._ham_analysis = None
+        if db is not None:
+            db.close()
+        if self._rest_client is not None:
+            self._rest_client.close()
+            self._rest_client = None
+        self._prot_id_index = {}
         return ogs
 
     def _get_aa_records(self, name, records):
@@ -216,13 +330,15 @@ class OGSet(object):
         :return:
         """
         if self.oma.mode == 'standalone':
-            og_ham = self._ham_analysis.get_hog_by_id(name[2:])
-            prot_ids = [gene.prot_id.split(" | ")[0]
-                        for gene in og_ham.get_all_descendant_genes()]
+            prot_id_index = self._prot_id_index[name]
             for record in records:
                 mystr = record.description
-                record.id = [x for x in prot_ids if mystr[mystr.find(
-                    "[") + 1:mystr.find("]")] in x[0:5]][0]+"_"+name
+                species = mystr[mystr.find("[") + 1:mystr.find("]")]
+                prot_id = prot_id_index.get(species)
+                if prot_id is None:  # species code shorter than 5 letters
+                    prot_id = [x for k, x in prot_id_index.items()
+                               if species in k][0]
+                record.id = prot_id+"_"+name
                 # Remove of stop codon
                 if 'X' in record.seq[-1]:
                     tmp_seq = record.seq[0:-1]
@@ -259,63 +375,55 @@ class OGSet(object):
                                        id=record.id,
                                        description="")
 
+    def _get_rest_client(self):
+        if self._rest_client is None:
+            self._rest_client = OMARestClient(self.args)
+        return self._rest_client
+
     def _get_dna_from_REST(self, record):
         """
-
-        :param record:
-        :param name:
-        :return:
+        Get the DNA of a record from the REST api cache, the record is
+        retrieved if it is not cached yet
+        :param record: amino acid record
+        :return: DNA record or None if the DNA was not found
         """
-        tmp_id = re.sub(r'\..*', '', record.id.split("_")[0])
-        use_id = re.sub(r'\W+', '', tmp_id)
-        try:
-            oma_record = requests.get(API_URL + "/protein/" + use_id + "/")
-        except requests.exceptions.RequestException:
+        use_id = get_protein_id(record.id)
+        cdna = self._get_rest_client().get_cdna([use_id])
+        if use_id not in cdna:
             self.logger.debug('DNA not found for {}.'.format(use_id))
-            pass
-        else:
-            seq = oma_record.json()['cdna']
-            rec_id = oma_record.json()['omaid']
-
-            cleaned_seq = self._clean_DNA_seq(seq)
-            # else:
-            #     cleaned_seq = dna_record.seq
-            return SeqRecord.SeqRecord(cleaned_seq, record.id,
-                                       description="", name="")
+            return None
+        cleaned_seq = self._clean_DNA_seq(cdna[use_id][1])
+        return SeqRecord.SeqRecord(cleaned_seq, record.id,
+                                   description="", name="")
 
     def _get_dna_from_REST_bulk(self, records, og_name):
         """
-
-        :param record:
-        :param name:
-        :return:
+        Get the DNA of the records of an OG from the REST api cache
+        :param records: amino acid records
+        :param og_name: name of the OG
+        :return: list of DNA records that were found
         """
-        record_ids = [r.id for r in records]
+        protein_ids = {record.id: get_protein_id(record.id)
+                       for record in records}
+        cdna = self._get_rest_client().get_cdna(list(protein_ids.values()))
         dna_records = []
-        try:
-            reply = requests.post('https://omabrowser.org/api/protein/bulk_retrieve/',
-                                  json={"ids": record_ids})
-        except requests.exceptions.RequestException:
-            self.logger.debug('DNA not found for {}.'.format(record.id))
-            pass
-        else:
-            group_members = reply.json()
-            for memb in group_members:
-                # print(">{}\n{}\n\n".format(memb['omaid'], memb['cdna']))
-                seq = memb['cdna']
-                rec_id = memb['omaid']+"_"+og_name
-                cleaned_seq = self._clean_DNA_seq(seq)
-                # print(cleaned_seq)
-                dna_records.append(SeqRecord.SeqRecord(cleaned_seq, id=rec_id,
-                                       description="", name=""))
+        for record in records:
+            if protein_ids[record.id] not in cdna:
+                self.logger.debug('DNA not found for {}.'.format(record.id))
+                continue
+            omaid, seq = cdna[protein_ids[record.id]]
+            rec_id = omaid+"_"+og_name
+            cleaned_seq = self._clean_DNA_seq(seq)
+            dna_records.append(SeqRecord.SeqRecord(cleaned_seq, id=rec_id,
+                                   description="", name=""))
         return dna_records
 
     def _get_dna_from_fasta(self, record, db):
         try:
-            if record.id.split("_")[0] not in db.keys():
+            if record.id.split("_")[0] not in db:
                 return self._get_dna_from_REST(record)
             else:
-                dna = db[record.id.split("_")[0]]
+                dna = db.fetch(record.id.split("_")[0])
         except ValueError:
             self.logger.debug('DNA not found for {}.'.format(record.id))
             pass
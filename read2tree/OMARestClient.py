@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+'''
+    This file contains the definition of the client retrieving the cDNA of
+    proteins from the OMA browser REST api. The protein IDs are batched up
+    to the limit of the bulk retrieval, the batches are sent concurrently
+    over a pooled session retrying failed requests with backoff and the
+    replies are persisted in a sqlite cache keyed by api url, OMA release
+    and protein ID, such that they are reused across runs and output
+    folders but never across releases.
+'''
+
+import os
+import re
+import time
+import sqlite3
+import logging
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+API_URL = 'https://omabrowser.org/api'
+
+# maximal number of IDs of a bulk retrieval request
+BULK_SIZE = 100
+
+# number of concurrent requests
+MAX_WORKERS = 8
+
+# retries of a failed request, waiting backoff_factor * 2^retry seconds
+MAX_RETRIES = 5
+BACKOFF_FACTOR = 1
+
+# number of IDs looked up in the cache by a single query
+CACHE_QUERY_SIZE = 500
+
+# seconds after which IDs unknown to the REST api are queried again
+NEGATIVE_CACHE_TTL = 7 * 24 * 3600
+
+
+def get_protein_id(record_id):
+    """
+    :param record_id: ID of a reference record, e.g. HUMAN12345_OG1
+    :return: protein ID used to query the REST api
+    """
+    tmp_id = re.sub(r'\..*', '', record_id.split("_")[0])
+    return re.sub(r'\W+', '', tmp_id)
+
+
+class OMARestClient(object):
+
+    def __init__(self, args, api_url=API_URL):
+        """
+
+        :param args: list of arguments from command line
+        :param api_url: url of the REST api
+        """
+        self.args = args
+        self.api_url = api_url.rstrip('/')
+        self.logger = logging.getLogger(__name__)
+        self._species_name = self.args.species_name
+
+        self._session = requests.Session()
+        retry = Retry(total=MAX_RETRIES, backoff_factor=BACKOFF_FACTOR,
+                      status_forcelist=(429, 500, 502, 503, 504),
+                      allowed_methods=None, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=MAX_WORKERS,
+                              pool_maxsize=MAX_WORKERS, max_retries=retry)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+        self._release = self._get_release()
+        if self._release is None:
+            # replies of an unknown release are only kept for this run
+            cache_file = ':memory:'
+        else:
+            cache_file = self.args.rest_cache or os.path.join(
+                os.environ.get('XDG_CACHE_HOME',
+                               os.path.join(os.path.expanduser('~'),
+                                            '.cache')),
+                'read2tree', 'oma_rest_cache.sqlite')
+            os.makedirs(os.path.dirname(os.path.abspath(cache_file)),
+                        exist_ok=True)
+        self._cache = sqlite3.connect(cache_file, timeout=60)
+        self._cache.execute('CREATE TABLE IF NOT EXISTS cdna '
+                            '(api_url TEXT, release TEXT, id TEXT, '
+                            'omaid TEXT, cdna TEXT, retrieved REAL, '
+                            'PRIMARY KEY (api_url, release, id))')
+        self._cache.commit()
+
+    def _get_release(self):
+        """
+        :return: OMA release served by the REST api or None if it could not
+                 be retrieved
+        """
+        try:
+            reply = self._session.get(self.api_url + '/version/', timeout=60)
+            reply.raise_for_status()
+            version = reply.json()
+            return str(version.get('oma_version') or version)
+        except (requests.exceptions.RequestException, ValueError,
+                AttributeError) as e:
+            self.logger.warning('{}: Retrieving the OMA release of {} failed, '
+                                'the replies are not cached: {}'
+                                .format(self._species_name, self.api_url, e))
+            return None
+
+    def close(self):
+        self._session.close()
+        self._cache.close()
+
+    def _get_cached(self, protein_ids):
+        """
+        :param protein_ids: list of protein IDs
+        :return: dictionary with the cached protein IDs as key and tuple of
+                 omaid and cdna as value, which are None for unknown IDs
+                 that were retrieved less than NEGATIVE_CACHE_TTL ago
+        """
+        cached = {}
+        expired = time.time() - NEGATIVE_CACHE_TTL
+        for i in range(0, len(protein_ids), CACHE_QUERY_SIZE):
+            chunk = protein_ids[i:i + CACHE_QUERY_SIZE]
+            for protein_id, omaid, cdna, retrieved in self._cache.execute(
+                    'SELECT id, omaid, cdna, retrieved FROM cdna '
+                    'WHERE api_url = ? AND release = ? AND id IN ({})'
+                    .format(','.join('?' * len(chunk))),
+                    [self.api_url, self._release or ''] + chunk):
+                if cdna is None and retrieved < expired:
+                    continue
+                cached[protein_id] = (omaid, cdna)
+        return cached
+
+    def prefetch(self, protein_ids):
+        """
+        Retrieve the cDNA of all the proteins missing from the cache in
+        concurrent bulk requests and store the replies in the cache
+        :param protein_ids: iterable of protein IDs
+        :return: number of retrieved proteins
+        """
+        protein_ids = sorted(set(protein_ids))
+        missing = [x for x in protein_ids
+                   if x not in self._get_cached(protein_ids)]
+        if not missing:
+            return 0
+        self.logger.info('{}: Retrieving the cDNA of {} / {} proteins from '
+                         '{}.'.format(self._species_name, len(missing),
+                                      len(protein_ids), self.api_url))
+        batches = [missing[i:i + BULK_SIZE]
+                   for i in range(0, len(missing), BULK_SIZE)]
+        num_retrieved = 0
+        with ThreadPoolExecutor(MAX_WORKERS) as executor:
+            for batch, reply in zip(batches,
+                                    executor.map(self._post_bulk, batches)):
+                if reply is None:
+                    continue
+                # IDs missing from a partial reply are queried again
+                retrieved = time.time()
+                self._cache.executemany(
+                    'INSERT OR REPLACE INTO cdna VALUES (?, ?, ?, ?, ?, ?)',
+                    [(self.api_url, self._release or '', x) + reply[x] +
+                     (retrieved,) for x in batch if x in reply])
+                self._cache.commit()
+                num_retrieved += sum(1 for x in batch
+                                     if reply.get(x, (None, None))[1])
+        return num_retrieved
+
+    def _post_bulk(self, protein_ids):
+        """
+        :param protein_ids: list of at most BULK_SIZE protein IDs
+        :return: dictionary with protein ID as key and tuple of omaid and
+                 cdna as value, which are None for the IDs the reply reports
+                 as unknown, or None if the request failed
+        """
+        try:
+            reply = self._session.post(
+                self.api_url + '/protein/bulk_retrieve/',
+                json={'ids': protein_ids}, timeout=300)
+            reply.raise_for_status()
+            members = reply.json()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            self.logger.warning('{}: Retrieving the cDNA of {} proteins '
+                                'failed: {}'.format(self._species_name,
+                                                    len(protein_ids), e))
+            return None
+        found = {}
+        for member in members:
+            target = member.get('target', member)
+            if not target:
+                if member.get('query_id') is not None:
+                    found[member['query_id']] = (None, None)
+                continue
+            query_id = member.get('query_id', target.get('omaid'))
+            found[query_id] = (target.get('omaid'), target.get('cdna'))
+        return found
+
+    def get_cdna(self, protein_ids):
+        """
+        Get the cDNA of proteins, which are retrieved if they are not cached
+        :param protein_ids: list of protein IDs
+        :return: dictionary with protein ID as key and tuple of omaid and
+                 cdna as value for the proteins known to the REST api
+        """
+        self.prefetch(protein_ids)
+        return {protein_id: value for protein_id, value
+                in self._get_cached(list(protein_ids)).items()
+                if value[1] is not None}
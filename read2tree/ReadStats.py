@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+'''
+    This file contains the definition of the read statistics sidecar. The
+    number of reads, the number of bases and the read length distribution of
+    a read file are computed in a single pass and stored as json file in
+    the read_stats folder of the output path, keyed by the path, size and
+    modification time of the read file. All the jobs working on the same
+    reads thereby reuse the statistics instead of re-scanning the file.
+'''
+
+import os
+import json
+import stat
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+from collections import Counter
+from tqdm import tqdm
+
+from read2tree.FastxReader import FastxReader
+
+# number of read lengths collected before they are added to the histogram
+LENGTHS_CHUNK_SIZE = 1 << 20
+
+
+class ReadStats(object):
+
+    def __init__(self, args):
+        """
+
+        :param args: list of arguments from command line
+        """
+        self.args = args
+        self.logger = logging.getLogger(__name__)
+        self._species_name = self.args.species_name
+
+        self._stats_folder = os.path.join(self.args.output_path, 'read_stats')
+
+    def _get_stats_file(self, file):
+        key = hashlib.sha1(os.path.abspath(file).encode()).hexdigest()
+        return os.path.join(self._stats_folder, key + '.json')
+
+    def _get_file_key(self, file):
+        """
+        Key of the read file the statistics are valid for
+        :param file: read file
+        :return: dictionary with path, size and mtime or None if the file is
+                 not a regular file, e.g. a named pipe
+        """
+        try:
+            file_stat = os.stat(file)
+        except OSError:
+            return None
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None
+        return {'path': os.path.abspath(file), 'size': file_stat.st_size,
+                'mtime': file_stat.st_mtime_ns}
+
+    def get_cached(self, file):
+        """
+        Get the statistics of a read file from the sidecar
+        :param file: read file
+        :return: dictionary of statistics or None if the sidecar is missing
+                 or the file changed since the statistics were computed
+        """
+        key = self._get_file_key(file)
+        if key is None:
+            return None
+        try:
+            with open(self._get_stats_file(file), 'r') as f:
+                stats = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if stats.get('file') != key:
+            return None
+        return stats
+
+    def get(self, file):
+        """
+        Get the statistics of a read file, which are computed and stored in
+        the sidecar if they are not yet available
+        :param file: read file
+        :return: dictionary of statistics
+        """
+        stats = self.get_cached(file)
+        if stats is None:
+            stats = self.record(file, self.compute_histogram(file))
+        return stats
+
+    def compute_histogram(self, file):
+        """
+        Compute the read length histogram of a read file in a single pass
+        :param file: read file
+        :return: Counter of the number of reads by read length
+        """
+        histogram = Counter()
+        lengths = np.zeros(LENGTHS_CHUNK_SIZE, dtype=np.int64)
+        n = 0
+        fastx_reader = FastxReader(file)
+        with fastx_reader.open_fastx() as f:
+            for _, seq, _ in tqdm(fastx_reader.readfx_bytes(f),
+                                  desc='Computing read statistics',
+                                  unit=' reads'):
+                lengths[n] = len(seq)
+                n += 1
+                if n == LENGTHS_CHUNK_SIZE:
+                    self._add_lengths(histogram, lengths[:n])
+                    n = 0
+        self._add_lengths(histogram, lengths[:n])
+        return histogram
+
+    def _add_lengths(self, histogram, lengths):
+        values, counts = np.unique(lengths, return_counts=True)
+        histogram.update(dict(zip(values.tolist(), counts.tolist())))
+
+    def record(self, file, histogram):
+        """
+        Summarize a read length histogram and store it in the sidecar of
+        the read file, which is skipped for files that are not regular files
+        :param file: read file
+        :param histogram: Counter of the number of reads by read length
+        :return: dictionary of statistics
+        """
+        stats = summarize_histogram(histogram)
+        key = self._get_file_key(file)
+        if key is None:
+            return stats
+        stats['file'] = key
+        os.makedirs(self._stats_folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', dir=self._stats_folder,
+                                         suffix='.json', delete=False) as f:
+            json.dump(stats, f)
+        os.replace(f.name, self._get_stats_file(file))
+        self.logger.debug('{}: Stored statistics of {} reads from {}.'
+                          .format(self._species_name, stats['num_reads'],
+                                  file))
+        return stats
+
+
+def summarize_histogram(histogram):
+    """
+    Summarize a read length histogram
+    :param histogram: Counter of the number of reads by read length
+    :return: dictionary with number of reads, number of bases, mean, median
+             and N50 read length and the histogram as sorted list of
+             read length and count pairs
+    """
+    lengths = sorted(length for length, count in histogram.items() if count)
+    num_reads = sum(histogram[length] for length in lengths)
+    num_bases = sum(length * histogram[length] for length in lengths)
+    median_len = 0
+    n50 = 0
+    seen_reads = 0
+    for length in lengths:
+        seen_reads += histogram[length]
+        if 2 * seen_reads >= num_reads:
+            median_len = length
+            break
+    seen_bases = 0
+    for length in reversed(lengths):
+        seen_bases += length * histogram[length]
+        if 2 * seen_bases >= num_bases:
+            n50 = length
+            break
+    return {'num_reads': num_reads,
+            'num_bases': num_bases,
+            'mean_len': num_bases / num_reads if num_reads else 0,
+            'median_len': median_len,
+            'n50': n50,
+            'length_histogram': [[length, histogram[length]]
+                                 for length in lengths]}
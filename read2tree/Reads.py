@@ -8,13 +8,41 @@ import random
 import sys
 import os
 import shutil
+import hashlib
+import threading
 import numpy as np
 
+from multiprocessing import Pool
+from contextlib import contextmanager
+from array import array
+from collections import Counter
+from itertools import zip_longest
 from math import ceil
 from tqdm import tqdm
 from natsort import natsorted
 
-from read2tree.FastxReader import FastxReader
+from read2tree.FastxReader import FastxReader, open_gzip_writer
+from read2tree.KmerFilter import chunk_by_bases
+from read2tree.ReadStats import ReadStats, summarize_histogram
+from read2tree._utils import HashSet
+
+# number of reads used to estimate the read length
+READ_LEN_SAMPLES = 100000
+
+# number of reads whose mate pairing is looked up together
+MATES_CHUNK_SIZE = 100000
+
+# Reads object used by the processes of the read splitting pool
+_split_reads = None
+
+
+def _init_split_worker(reads):
+    global _split_reads
+    _split_reads = reads
+
+
+def _split_chunk(records):
+    return _split_reads._split_records(records)
 
 
 class Reads(object):
@@ -43,85 +71,154 @@ class Reads(object):
 
         self._reads = self.args.reads
         self._species_name = self.args.species_name
+        self._tmp_files = []
+        self.read_stats = ReadStats(self.args)
+
+        if self._reads and self._is_merged_input(self._reads):
+            # the lanes are concatenated and interleaved mates separated
+            # while the reads are read through named pipes
+            self._reads = ReadStream(self, self._reads,
+                                     interleaved=self.args.interleaved)
 
         if load:
+            mate_pairs = None
             if len(self.args.reads) == 2 and self.args.check_mate_pairing:
                 mate_pairs = self.check_read_consistency(self._reads)
-                if mate_pairs:
+                if mate_pairs is not None and not self.args.stream_reads:
                     tmp = self.select_mates_from_reads(self._reads,
                                                        mate_pairs)
                     self._reads = tmp
 
-            if self.args.split_reads:
-                print('--- Splitting reads from {} ---'.format(self._reads))
-                self.logger.info('{}: --- Splitting reads from {} ---'
-                            .format(self._species_name, self._reads))
-                # print(memory_usage(self.process_reads))
-                # self.split_reads = self._write_to_tmp_file(self\
-                #       .process_reads())
-                self.reads = self.process_reads()
+            if self.args.dedup_reads:
+                print('--- Removing duplicate reads from {} ---'
+                      .format(self._reads))
+                self.logger.info('{}: --- Removing duplicate reads from {} ---'
+                                 .format(self._species_name, self._reads))
+                reads = self._reads
+                if mate_pairs is not None and self.args.stream_reads:
+                    # the selected mates are only streamed into the
+                    # de-duplication, whose reads are written
+                    reads = ReadStream(self, self._reads, mates=mate_pairs)
+                self._reads = self.deduplicate_reads(reads)
+                mate_pairs = None
+
+            if self.args.stream_reads and (mate_pairs is not None or
+                                           self.args.split_reads):
+                # the selected mates and split reads are only produced
+                # into pipes while being read, the sample is written
+                self.reads = ReadStream(self, self._reads, mates=mate_pairs,
+                                        split=self.args.split_reads)
+                if self.args.sample_reads:
+                    print('--- Sampling reads from {} ---'.format(self._reads))
+                    self.logger.info('{}: --- Sampling reads from {} ---'
+                                .format(self._species_name, self._reads))
+                    self.reads = self.sample_from_reads(self.reads)
             else:
-                self.reads = self._reads
+                if self.args.split_reads:
+                    print('--- Splitting reads from {} ---'.format(self._reads))
+                    self.logger.info('{}: --- Splitting reads from {} ---'
+                                .format(self._species_name, self._reads))
+                    # print(memory_usage(self.process_reads))
+                    # self.split_reads = self._write_to_tmp_file(self\
+                    #       .process_reads())
+                    self.reads = self.process_reads()
+                else:
+                    self.reads = self._reads
 
-            if self.args.sample_reads:
-                print('--- Sampling reads from {} ---'.format(self.reads))
-                self.logger.info('{}: --- Sampling reads from {} ---'
-                            .format(self._species_name, self.reads))
-                self.reads = self.sample_from_reads(self.reads)
-            else:
-                self.reads = self.reads
+                if self.args.sample_reads:
+                    print('--- Sampling reads from {} ---'.format(self.reads))
+                    self.logger.info('{}: --- Sampling reads from {} ---'
+                                .format(self._species_name, self.reads))
+                    self.reads = self.sample_from_reads(self.reads)
+                else:
+                    self.reads = self.reads
         else:
             self.reads = self._reads
 
+    def _is_merged_input(self, reads):
+        '''
+        Whether the reads are given as several files per mate or as
+        interleaved paired reads, which are merged while being read
+        '''
+        files = reads if isinstance(reads, list) else [reads]
+        return self.args.interleaved or any(',' in file for file in files)
+
+    def write_stream(self, reads):
+        '''
+        Write streamed reads to temporary read files. ngm and ngmlr open
+        their read input several times, e.g. to detect the format before
+        mapping, which a named pipe fed once can not serve.
+        :param reads: read file(s) or ReadStream
+        :return: read file or list of two paired read files
+        '''
+        if not isinstance(reads, ReadStream):
+            return reads
+        out_file_names = []
+        with reads.open() as fifos:
+            for fifo in fifos if isinstance(fifos, list) else [fifos]:
+                out_file, out_file_name = self._open_tmp_reads_file()
+                with open(fifo, 'r') as f:
+                    shutil.copyfileobj(f, out_file)
+                out_file.close()
+                out_file_names.append(out_file_name)
+        if isinstance(fifos, list):
+            return out_file_names
+        return out_file_names[0]
+
+    def cleanup(self):
+        '''
+        Remove the temporary read files written by this object
+        '''
+        for file in self._tmp_files:
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+        self._tmp_files = []
+
     def process_reads(self):
         '''
         Function taking in the reads of the object and processing it
-        given the provided parameters
-        :return: string that contains all the read sequences separated by '\n'
+        given the provided parameters. The reads are split in chunks by
+        --threads worker processes and the chunks are written in input order.
+        :return: file that contains all the split read sequences
         '''
-        # out = ''
         total_new_reads = 0
         total_reads = 0
         start = time.time()
-        out_file = tempfile.NamedTemporaryFile(mode='at', suffix='.fq',
-                                               delete=False)
-        fastq_reader = FastxReader(self._reads)
-        with fastq_reader.open_fastx() as f:
-            for name, seq, qual in tqdm(fastq_reader.readfx(f),
-                                        desc='Splitting reads',
-                                        unit=' reads'):
-                total_reads = total_reads + 1
-                read_id = name[1:].split(" ")[0]
-                # self.logger.debug("Process read {}".format(read_id))
-                if len(seq) > self.split_min_read_len:
-                    x = 0
-                    try:
-                        new_seq, new_qual = \
-                            self._split_len_overlap(seq, self.split_len,
-                                                    self.split_overlap), \
-                            self._split_len_overlap(qual, self.split_len,
-                                                    self.split_overlap)
-                    except ValueError:
-                        self.logger.debug('Reads were not split properly!')
-                    for i in zip(new_seq, new_qual):
-                        # out += self._get_4_line_fastq_string(read_id, x,
-                        #                                      i[0],
-                        #                                      i[1])
-                        # write output directly to file to reduce memory
-                        # footprint
-                        out_file.write(self._get_2_line_fasta_string(read_id,
-                                                                     i[0],
-                                                                     x=x))
-                        x = x + 1
-                    total_new_reads = total_new_reads + x
-                else:
-                    # out += self._get_4_line_fastq_string(read_id, None, seq,
-                    #                                      qual)
-                    out_file.write(self._get_2_line_fasta_string(read_id,
-                                                                 seq,
-                                                                 x=None))
+        out_file, out_file_name = self._open_tmp_reads_file()
+        histogram = Counter()
 
-                    total_new_reads = total_new_reads + 1
+        def get_record(name, seq):
+            histogram[len(seq)] += 1
+            return name, seq
+
+        with open_reads(self._reads) as file:
+            fastq_reader = FastxReader(file)
+            with fastq_reader.open_fastx() as f:
+                chunks = chunk_by_bases(
+                    (get_record(name, seq) for name, seq, _ in tqdm(
+                        fastq_reader.readfx(f), desc='Splitting reads',
+                        unit=' reads')),
+                    lambda record: len(record[1]))
+                if self.args.threads > 1:
+                    pool = Pool(self.args.threads,
+                                initializer=_init_split_worker,
+                                initargs=(self,))
+                    split_chunks = pool.imap(_split_chunk, chunks)
+                else:
+                    pool = None
+                    split_chunks = map(self._split_records, chunks)
+                try:
+                    for out, num_reads, num_new_reads in split_chunks:
+                        out_file.write(out)
+                        total_reads += num_reads
+                        total_new_reads += num_new_reads
+                finally:
+                    if pool is not None:
+                        pool.close()
+                        pool.join()
+            self._record_read_stats(file, histogram)
 
         end = time.time()
         self.elapsed_time = end - start
@@ -139,11 +236,33 @@ class Reads(object):
                     .format(self._species_name, self.elapsed_time))
         out_file.close()
         self.total_reads = total_new_reads
-        self._file_handle = 'txt'
-        # shutil.move(out_file.name,
-        #             '/Users/daviddylus/Research/read2tree/tests\
-        #             /data/reads/split.fq')
-        return out_file.name
+        self._file_handle = 'gzip' if self.args.compress_tmp_reads else 'txt'
+        return out_file_name
+
+    def _split_records(self, records):
+        '''
+        Split the reads of a chunk
+        :param records: list of tuples of read name and sequence
+        :return: tuple of fasta string of the split reads, number of reads
+                 and number of split reads
+        '''
+        out = []
+        total_new_reads = 0
+        for name, seq in records:
+            read_id = name[1:].split(" ")[0]
+            if len(seq) > self.split_min_read_len:
+                x = 0
+                for new_seq in self._split_len_overlap(seq, self.split_len,
+                                                       self.split_overlap):
+                    out.append(self._get_2_line_fasta_string(read_id,
+                                                             new_seq, x=x))
+                    x = x + 1
+                total_new_reads = total_new_reads + x
+            else:
+                out.append(self._get_2_line_fasta_string(read_id, seq,
+                                                         x=None))
+                total_new_reads = total_new_reads + 1
+        return ''.join(out), len(records), total_new_reads
 
     def check_paired(self, reads):
         '''
@@ -157,48 +276,81 @@ class Reads(object):
     def check_read_consistency(self, reads):
         '''
         Function that checks whether all mate pairs are present and if not
-        uses only reads for which mate pairs exist.
+        uses only reads for which mate pairs exist. The files are first
+        compared in lockstep, which finds consistent files without holding
+        any read IDs in memory. Only otherwise the 64 bit hashes of the read
+        IDs of both files are collected and intersected.
+        :param reads: list of two paired read files or ReadStream
+        :return: None if the mate pairing is consistent, otherwise sorted
+                 array of the hashes of the read IDs having both mates
         '''
         print('--- Checking for consistent mate pairing ---')
-        left_read = FastxReader(reads[0])
-        right_read = FastxReader(reads[1])
-
-        with left_read.open_fastx() as left_input:
-            with right_read.open_fastx() as right_input:
-                with_mate_pairs = set(left_read.readfq_id(left_input)) \
-                    .intersection(right_read.readfq_id(right_input))
-                self.logger.info('Mate pairs have size: {}'.format(sys.getsizeof(with_mate_pairs)))
-
-        with left_read.open_fastx() as left_input:
-            len_left = len(set(left_read.readfq_id(left_input)))
-
-        if len_left == len(with_mate_pairs):
+        with open_reads(reads) as files:
+            left_read = FastxReader(files[0])
+            right_read = FastxReader(files[1])
+            with left_read.open_fastx() as left_input:
+                with right_read.open_fastx() as right_input:
+                    in_sync = all(
+                        left_id is not None and right_id is not None and
+                        self._get_mate_id(left_id) ==
+                        self._get_mate_id(right_id)
+                        for left_id, right_id in zip_longest(
+                            left_read.readfq_id(left_input),
+                            right_read.readfq_id(right_input)))
+        if in_sync:
             print('----> Mate pairing consitent! ---')
             self.logger.info('{}: Mate pairs are consistent.'
                         .format(self._species_name))
             return None
-        else:
-            print('----> Mate pairing not consitent! ---')
-            self.logger.info('{}: Inconsistent number of mate pairs! '
-                        'Will use only reads that have mate pair. '
-                        'Consistent {} of {} total reads.'
-                        .format(self._species_name,
-                                2*len(with_mate_pairs),
-                                len_left+len_left))
-            return with_mate_pairs
+
+        hashes = []
+        with open_reads(reads) as files:
+            for file in files:
+                fastq_reader = FastxReader(file)
+                file_hashes = array('Q')
+                with fastq_reader.open_fastx() as f:
+                    for read_id in fastq_reader.readfq_id(f):
+                        file_hashes.append(self._hash_read_id(read_id))
+                hashes.append(np.frombuffer(file_hashes, dtype=np.uint64))
+        with_mate_pairs = np.intersect1d(hashes[0], hashes[1])
+        self.logger.info('Mate pairs have size: {}'
+                         .format(with_mate_pairs.nbytes))
+
+        print('----> Mate pairing not consitent! ---')
+        self.logger.info('{}: Inconsistent number of mate pairs! '
+                    'Will use only reads that have mate pair. '
+                    'Consistent {} of {} total reads.'
+                    .format(self._species_name,
+                            2*len(with_mate_pairs),
+                            len(hashes[0])+len(hashes[1])))
+        return with_mate_pairs
+
+    def _get_mate_id(self, read_id):
+        '''
+        Read ID shared by both mates, i.e. without the /1 or /2 suffix
+        '''
+        if read_id[-2:] in ('/1', '/2'):
+            return read_id[:-2]
+        return read_id
+
+    def _hash_read_id(self, read_id):
+        return int.from_bytes(hashlib.blake2b(
+            self._get_mate_id(read_id).encode(), digest_size=8).digest(),
+            'little')
 
     def select_mates_from_reads(self, reads, mates):
         '''
         Main function taking in the reads of the object and processing it
         given the provided parameters
-        :return: string that contains all the read sequences separated by '\n'
+        :param reads: list of two paired read files or ReadStream
+        :param mates: sorted array of the hashes of the read IDs to keep
+        :return: list of the two files with the reads having both mates
         '''
         sampled_reads = []
         start = time.time()
-        sampled_reads.append(self._sample_read_file(reads[0],
-                                                    mates))
-        sampled_reads.append(self._sample_read_file(reads[1],
-                                                    mates))
+        with open_reads(reads) as files:
+            sampled_reads.append(self._select_mates_file(files[0], mates))
+            sampled_reads.append(self._select_mates_file(files[1], mates))
 
         end = time.time()
         elapsed_time = end - start
@@ -209,38 +361,125 @@ class Reads(object):
         #                 '/Volumes/Untitled/reserach/r2t/test/split.fq')
         return sampled_reads
 
+    def _select_mates_file(self, file, mates):
+        '''
+        Write the reads of a file whose read ID hash is among the mates
+        :param file: read file
+        :param mates: sorted array of the hashes of the read IDs to keep
+        :return: file with the selected reads
+        '''
+        out_file, out_file_name = self._open_tmp_reads_file()
+        fastq_reader = FastxReader(file)
+        with fastq_reader.open_fastx() as read_input:
+            chunk = []
+            for record in tqdm(fastq_reader.readfq(read_input),
+                               desc='Selecting mates from {}'
+                               .format(os.path.basename(file)),
+                               unit=' reads'):
+                chunk.append(record)
+                if len(chunk) == MATES_CHUNK_SIZE:
+                    self._write_mates_chunk(chunk, mates, out_file)
+                    chunk = []
+            self._write_mates_chunk(chunk, mates, out_file)
+        out_file.close()
+        return out_file_name
+
+    def _write_mates_chunk(self, chunk, mates, out_file):
+        out_file.write(self._get_mates_chunk(chunk, mates))
+
+    def _get_mates_chunk(self, chunk, mates):
+        '''
+        Select the reads of a chunk whose read ID hash is among the mates
+        :param chunk: list of tuples of read name, sequence and quality
+        :param mates: sorted array of the hashes of the read IDs to keep
+        :return: fasta string of the selected reads
+        '''
+        hashes = np.fromiter((self._hash_read_id(name.split(' ')[0])
+                              for name, _, _ in chunk),
+                             dtype=np.uint64, count=len(chunk))
+        idx = np.searchsorted(mates, hashes)
+        idx[idx == len(mates)] = 0
+        keep = mates[idx] == hashes if len(mates) else \
+            np.zeros(len(chunk), dtype=bool)
+        return ''.join(self._get_2_line_fasta_string(name, seq)
+                       for (name, seq, _), passed in zip(chunk, keep)
+                       if passed)
+
+    def deduplicate_reads(self, reads):
+        '''
+        Remove duplicate reads, of which only the first occurrence is kept.
+        Paired reads are only duplicates if the sequences of both mates are
+        identical. With --dedup_prefix_len only the prefix of this length of
+        the reads is compared, which also collapses duplicates differing by
+        sequencing errors towards the end of the reads.
+        :param reads: read file, list of two paired read files or ReadStream
+        :return: de-duplicated read file(s)
+        '''
+        start = time.time()
+        hash_set = HashSet()
+        num_reads = 0
+        with open_reads(reads) as read_files:
+            files = read_files if isinstance(read_files, list) \
+                else [read_files]
+            readers = [FastxReader(file) for file in files]
+            handles = [reader.open_fastx() for reader in readers]
+            out_files = [self._open_tmp_reads_file() for _ in files]
+            try:
+                records = zip(*[reader.readfx(handle) for reader, handle
+                                in zip(readers, handles)])
+                for chunk in chunk_by_bases(
+                        tqdm(records, desc='Removing duplicate reads',
+                             unit=' reads'),
+                        lambda record: sum(len(mate[1]) for mate in record)):
+                    keep = hash_set.add(np.fromiter(
+                        (self._hash_read_seqs(record) for record in chunk),
+                        dtype=np.uint64, count=len(chunk)))
+                    for i, (out_file, _) in enumerate(out_files):
+                        out_file.write(''.join(
+                            self._get_2_line_fasta_string(
+                                record[i][0][1:].split(' ')[0], record[i][1])
+                            for record, passed in zip(chunk, keep) if passed))
+                    num_reads += len(chunk)
+            finally:
+                for handle in handles:
+                    handle.close()
+                for out_file, _ in out_files:
+                    out_file.close()
+
+        num_unique = len(hash_set)
+        self.elapsed_time = time.time() - start
+        self.logger.info('{}: Kept {} / {} unique reads, the duplication rate '
+                         'is {:.2%}.'.format(self._species_name, num_unique,
+                                             num_reads,
+                                             1 - num_unique / max(1, num_reads)))
+        self.logger.info('{}: Removing duplicate reads took {}.'
+                         .format(self._species_name, self.elapsed_time))
+        if isinstance(read_files, list):
+            return [out_file_name for _, out_file_name in out_files]
+        return out_files[0][1]
+
+    def _hash_read_seqs(self, record):
+        prefix_len = self.args.dedup_prefix_len or None
+        return int.from_bytes(hashlib.blake2b(
+            '\n'.join(seq[:prefix_len] for _, seq, _ in record)
+            .encode('latin-1'), digest_size=8).digest(), 'little')
+
     def sample_from_reads(self, reads):
         '''
         Main function taking in the reads of the object and processing it
         given the provided parameters
         :return: string that contains all the read sequences separated by '\n'
         '''
-        sampled_reads = []
         start = time.time()
-        print(len(self.args.reads))
-
-        if len(self.args.reads) == 2:
-            idx_random = self._get_vector_random_reads(reads[0])
-            if idx_random:
-                sampled_reads.append(self._sample_read_file(reads[0],
-                                                            idx_random))
-                sampled_reads.append(self._sample_read_file(reads[1],
-                                                            idx_random))
-                self.logger.info('Reads can be found at: {}'.format(sampled_reads))
-                if self.args.debug:
-                    shutil.copy(sampled_reads[0], os.path.join(self.args.output_path, 'reads_1.fa'))
-                    shutil.copy(sampled_reads[1], os.path.join(self.args.output_path, 'reads_2.fa'))
-            else:
-                sampled_reads = reads
-        else:
-            idx_random = self._get_vector_random_reads(reads)
-            print(idx_random)
-            if idx_random:
-                sampled_reads = self._sample_read_file(reads,
-                                                       idx_random)
-                print(sampled_reads)
-            else:
-                sampled_reads = reads
+        with open_reads(reads) as files:
+            sampled_reads = self._sample_reads_single_pass(files)
+        if sampled_reads is None:
+            sampled_reads = reads
+        elif isinstance(sampled_reads, list):
+            self.logger.info('Reads can be found at: {}'.format(sampled_reads))
+            if self.args.debug:
+                shutil.copy(sampled_reads[0], os.path.join(self.args.output_path, 'reads_1.fa'))
+                shutil.copy(sampled_reads[1], os.path.join(self.args.output_path, 'reads_2.fa'))
 
         end = time.time()
         elapsed_time = end - start
@@ -249,38 +488,187 @@ class Reads(object):
 
         return sampled_reads
 
+    def _sample_reads_single_pass(self, reads):
+        """
+        Sample reads for the requested coverage in a single pass through the
+        read files. The number of reads to sample is derived from the read
+        statistics sidecar if available and otherwise from the length of the
+        first READ_LEN_SAMPLES reads. The reads are then sampled with
+        reservoir sampling, of which only the reads that enter the
+        reservoir are written to a candidate file. Paired reads are sampled
+        by index such that the mates stay in sync. The statistics of the
+        read files are stored in the sidecar after the pass.
+        :param reads: read file or list of two paired read files
+        :return: sampled read file(s) or None if all the reads are needed
+        """
+        files = reads if isinstance(reads, list) else [reads]
+        num_sample = None
+        stats = [self._get_cached_read_stats(file) for file in files]
+        if self.total_reads == 0 and all(stats):
+            # the number of reads to sample is known from the sidecar
+            self._log_read_len(stats[0])
+            num_sample = self._get_num_reads_by_read_len(stats[0]['mean_len'])
+            if num_sample >= stats[0]['num_reads']:
+                self.logger.info('{}: Sampling {} / {} reads for {}X coverage.'
+                                 .format(self._species_name, num_sample,
+                                         stats[0]['num_reads'], self.coverage))
+                self.logger.info("{}: Not enough reads available for "
+                                 "sampling, using them all."
+                                 .format(self._species_name))
+                return None
+        histograms = [Counter() for _ in files]
+        readers = [FastxReader(file) for file in files]
+        handles = [reader.open_fastx() for reader in readers]
+        candidate_files = [tempfile.TemporaryFile(mode='w+t') for _ in files]
+        read_lens = []
+        reservoir = array('q')
+        num_candidates = 0
+        num_reads = 0
+        initial_length = 0
+        try:
+            for record in tqdm(zip(*[reader.readfx(handle) for reader, handle
+                                     in zip(readers, handles)]),
+                               desc='Sampling reads', unit=' reads'):
+                for mate, histogram in zip(record, histograms):
+                    histogram[len(mate[1])] += 1
+                initial_length += sum(len(mate[1]) for mate in record)
+                if num_sample is None or len(reservoir) < num_sample:
+                    slot = len(reservoir)
+                else:  # replace a random read of the full reservoir
+                    slot = int(random.random() * (num_reads + 1))
+                if num_sample is None or slot < num_sample:
+                    for (name, seq, _), candidate_file in \
+                            zip(record, candidate_files):
+                        candidate_file.write(
+                            self._get_2_line_fasta_string(name, seq))
+                    if slot == len(reservoir):
+                        reservoir.append(num_candidates)
+                    else:
+                        reservoir[slot] = num_candidates
+                    num_candidates += 1
+                num_reads += 1
+                if num_sample is None:
+                    read_lens.append(len(record[0][1]))
+                    if num_reads == READ_LEN_SAMPLES:
+                        num_sample = self._init_reservoir(reservoir,
+                                                          read_lens)
+            if num_sample is None:
+                num_sample = self._init_reservoir(reservoir, read_lens)
+            for file, file_stats, histogram in zip(files, stats, histograms):
+                if file_stats is None:
+                    self._record_read_stats(file, histogram)
+
+            self.logger.info('{}: Sampling {} / {} reads for {}X coverage.'
+                             .format(self._species_name, num_sample,
+                                     num_reads, self.coverage))
+            if num_sample >= num_reads:
+                self.logger.info("{}: Not enough reads available for "
+                                 "sampling, using them all."
+                                 .format(self._species_name))
+                return None
+
+            sampled_reads, sampling_length = \
+                self._write_sampled_candidates(
+                    candidate_files,
+                    np.sort(np.frombuffer(reservoir, dtype=np.int64)))
+        finally:
+            for handle in handles:
+                handle.close()
+            for candidate_file in candidate_files:
+                candidate_file.close()
+
+        self.logger.info('{}: Cummulative length of all reads {}bp. Cummulative '
+                    'length of sampled reads {}bp'
+                    .format(self._species_name, initial_length,
+                            sampling_length))
+        if isinstance(reads, list):
+            return sampled_reads
+        return sampled_reads[0]
+
+    def _init_reservoir(self, reservoir, read_lens):
+        """
+        Derive the number of reads to sample from the length of the reads
+        seen so far and reduce the reservoir to a random sample of this size
+        :param reservoir: candidate indices of all the reads seen so far
+        :param read_lens: lengths of the reads seen so far
+        :return: number of reads to sample
+        """
+        if self.total_reads > 0:
+            read_len = self.args.split_len
+        else:
+            read_len = np.mean(read_lens) if read_lens else 0
+            self.logger.info('{}: The reads have a mean length of {} '
+                             'and a median length of {}.'
+                             .format(self._species_name, read_len,
+                                     np.median(read_lens) if read_lens else 0))
+        num_sample = self._get_num_reads_by_read_len(read_len)
+        if num_sample < len(reservoir):
+            reservoir[:] = array('q', random.sample(list(reservoir),
+                                                    num_sample))
+        return num_sample
+
+    def _write_sampled_candidates(self, candidate_files, selected):
+        """
+        Copy the selected reads from the candidate files to the output files
+        :param candidate_files: files of 2 line fasta reads
+        :param selected: sorted indices of the selected candidates
+        :return: list of output files and cumulative length of the reads
+        """
+        out_files = []
+        sampling_length = 0
+        for candidate_file in candidate_files:
+            candidate_file.seek(0)
+            out_file, out_file_name = self._open_tmp_reads_file()
+            k = 0
+            for i, name in enumerate(candidate_file):
+                seq = next(candidate_file)
+                if k < len(selected) and i == selected[k]:
+                    out_file.write(name + seq)
+                    sampling_length += len(seq) - 1
+                    k += 1
+            out_file.close()
+            out_files.append(out_file_name)
+        return out_files, sampling_length
+
+    def _get_read_stats(self, file):
+        '''
+        Get the statistics of a read file from its sidecar, which is only
+        written for input read files and not for temporary ones
+        :param file: read file
+        :return: dictionary of read statistics
+        '''
+        if file in self._tmp_files:
+            return summarize_histogram(self.read_stats.compute_histogram(file))
+        return self.read_stats.get(file)
+
+    def _get_cached_read_stats(self, file):
+        if file in self._tmp_files:
+            return None
+        return self.read_stats.get_cached(file)
+
+    def _record_read_stats(self, file, histogram):
+        if file not in self._tmp_files:
+            self.read_stats.record(file, histogram)
+
+    def _log_read_len(self, stats):
+        self.logger.info('{}: The reads have a mean length of {} '
+                         'and a median length of {}.'
+                         .format(self._species_name, stats['mean_len'],
+                                 stats['median_len']))
+
     def _get_num_reads(self, file):
         if self.total_reads > 0:
             return self.total_reads
         else:
-            fastq_reader = FastxReader(file)
-            num_lines = 0
-            with fastq_reader.open_fastx() as f:
-                for l in f: num_lines += 1
-            return int(num_lines / 4)
+            return self._get_read_stats(file)['num_reads']
 
     def _get_read_len(self, file, num_records):
         if self.total_reads > 0:
             return self.args.split_len
         else:
-            fastq_reader = FastxReader(file)
-            if num_records < 100000:
-                samples = num_records
-            else:
-                samples = 100000
-            lens = [0] * samples
-            with fastq_reader.open_fastx() as f:
-                for i, l in enumerate(fastq_reader.readfq(f)):
-                    if i < samples:
-                        lens[i] = len(l[1])
-                    else:
-                        break
-                mean_len = np.mean(lens)
-                median_len = np.median(lens)
-            self.logger.info('{}: The reads have a mean length of {} '
-                        'and a median length of {}.'
-                        .format(self._species_name, mean_len, median_len))
-            return mean_len
+            stats = self._get_read_stats(file)
+            self._log_read_len(stats)
+            return stats['mean_len']
 
     def _get_number_read_files(self, var):
         '''
@@ -295,10 +683,14 @@ class Reads(object):
 
     def _get_num_reads_by_coverage(self, file, num_records):
         read_len = self._get_read_len(file, num_records)
+        return self._get_num_reads_by_read_len(read_len)
+
+    def _get_num_reads_by_read_len(self, read_len):
         self.logger.info('{}: Average read length estimated to {}.'
                     .format(self._species_name, read_len))
         return int(ceil(self.args.genome_len * self.args.coverage /
-                        (self._get_number_read_files(self.args.reads) * read_len)))
+                        (self._get_number_read_files(self.args.reads) *
+                         max(read_len, 1))))
 
     def _get_vector_random_reads(self, file):
         total_records = self._get_num_reads(file)
@@ -318,8 +710,7 @@ class Reads(object):
         initial_length = 0
         sampling_length = 0
         select_idx = list(select_idx)
-        out_file = tempfile.NamedTemporaryFile(mode='at', suffix='.fa',
-                                               delete=False)
+        out_file, out_file_name = self._open_tmp_reads_file()
         fastq_reader = FastxReader(file)
         with fastq_reader.open_fastx() as read_input:
             k = 0
@@ -347,7 +738,25 @@ class Reads(object):
                     .format(self._species_name, initial_length,
                             sampling_length))
         out_file.close()
-        return out_file.name
+        return out_file_name
+
+    def _open_tmp_reads_file(self):
+        '''
+        Open a temporary file for pre-processed reads, which is gzip
+        compressed with --compress_tmp_reads
+        :return: tuple of text file handle and file name
+        '''
+        if self.args.compress_tmp_reads:
+            tmp_file = tempfile.NamedTemporaryFile(suffix='.fa.gz',
+                                                   delete=False)
+            tmp_file.close()
+            self._tmp_files.append(tmp_file.name)
+            return open_gzip_writer(tmp_file.name,
+                                    self.args.threads), tmp_file.name
+        out_file = tempfile.NamedTemporaryFile(mode='at', suffix='.fa',
+                                               delete=False)
+        self._tmp_files.append(out_file.name)
+        return out_file, out_file.name
 
     def _get_2_line_fasta_string(self, read_id, seq, x=None):
         '''
@@ -414,3 +823,124 @@ class Reads(object):
             filehandle.write(split_reads)
             filehandle.seek(0)
         return filehandle.name
+
+
+@contextmanager
+def open_reads(reads):
+    """
+    Provide the read files of pre-processed reads, which are named pipes
+    for a ReadStream
+    :param reads: read file(s) or ReadStream
+    :return: read file or list of two paired read files
+    """
+    if isinstance(reads, ReadStream):
+        with reads.open() as files:
+            yield files
+    else:
+        yield reads
+
+
+class ReadStream(object):
+    '''
+    Pre-processed reads that are not written to disk. Every time the reads
+    are opened, the lane concatenation, separation of interleaved mates,
+    mate selection and read splitting are run anew by threads writing into
+    named pipes, which are read by the consumer while the reads are
+    produced. Each pipe is fed once, such that only consumers reading their
+    input in a single pass (sampling, de-duplication, k-mer filter and
+    sketch) can read a stream. The read mappers get the reads written by
+    Reads.write_stream.
+    '''
+
+    def __init__(self, reads, files, mates=None, split=False,
+                 interleaved=False):
+        """
+
+        :param reads: Reads object providing the pre-processing
+        :param files: read file or list of two paired read files, each of
+                      which can be comma separated files of several lanes,
+                      or ReadStream whose reads are pre-processed further
+        :param mates: sorted array of the hashes of the read IDs to keep
+        :param split: set to True to split the reads
+        :param interleaved: set to True if the list of two paired read files
+                            refers twice to the same interleaved reads
+        """
+        self._reads = reads
+        self.files = files
+        self.mates = mates
+        self.split = split
+        self.interleaved = interleaved
+
+    def __repr__(self):
+        return 'ReadStream({})'.format(self.files)
+
+    @contextmanager
+    def open(self):
+        """
+        Provide the pre-processed reads as named pipes
+        :return: named pipe or list of two named pipes for paired reads
+        """
+        with open_reads(self.files) as input_files:
+            with self._open_fifos(input_files) as fifos:
+                yield fifos
+
+    @contextmanager
+    def _open_fifos(self, input_files):
+        files = input_files if isinstance(input_files, list) \
+            else [input_files]
+        tmp_dir = tempfile.mkdtemp(prefix='reads_')
+        fifos = [os.path.join(tmp_dir, 'reads_{}.fa'.format(i + 1))
+                 for i in range(len(files))]
+        threads = []
+        errors = []
+        try:
+            for i, (file, fifo) in enumerate(zip(files, fifos)):
+                os.mkfifo(fifo)
+                thread = threading.Thread(
+                    target=self._produce,
+                    args=(FastxReader(file, mate=i + 1 if self.interleaved
+                                      else None), fifo, errors),
+                    daemon=True)
+                thread.start()
+                threads.append(thread)
+            yield fifos if isinstance(input_files, list) else fifos[0]
+        finally:
+            for fifo, thread in zip(fifos, threads):
+                # release a producer waiting for a reader or writing to a
+                # reader that stopped early
+                while thread.is_alive():
+                    try:
+                        os.close(os.open(fifo, os.O_RDONLY | os.O_NONBLOCK))
+                    except OSError:
+                        pass
+                    thread.join(0.1)
+            shutil.rmtree(tmp_dir)
+        if errors:
+            raise errors[0]
+
+    def _produce(self, fastx_reader, fifo, errors):
+        """
+        Write the pre-processed reads of a file into a named pipe
+        :param fastx_reader: FastxReader of the read file
+        :param fifo: named pipe
+        :param errors: list collecting the exceptions of the producers
+        """
+        try:
+            with open(fifo, 'w') as out:
+                with fastx_reader.open_fastx() as f:
+                    for chunk in chunk_by_bases(fastx_reader.readfx(f),
+                                                lambda record: len(record[1])):
+                        if self.mates is not None:
+                            out.write(self._reads._get_mates_chunk(
+                                chunk, self.mates))
+                        elif self.split:
+                            out.write(self._reads._split_records(
+                                [(name, seq) for name, seq, _ in chunk])[0])
+                        else:
+                            out.write(''.join(
+                                self._reads._get_2_line_fasta_string(name, seq)
+                                for name, seq, _ in chunk))
+        except BrokenPipeError:
+            pass
+        except Exception as e:
+            errors.append(e)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+'''
+    This file contains the definition of FracMinHash sketches of the
+    reference species and the reads. The sketches are used to rank the
+    reference species by the fraction of their k-mers contained in the reads,
+    such that the reads are only mapped to the closest reference species.
+'''
+
+import os
+import time
+import logging
+import tempfile
+import numpy as np
+
+from tqdm import tqdm
+
+from read2tree.FastxReader import FastxReader
+from read2tree.KmerFilter import chunk_by_bases, encode_sequences, \
+    canonical_kmers
+
+SKETCH_KMER_SIZE = 21
+
+# number of hashes collected from the reads before they are de-duplicated
+MERGE_HASHES = 1 << 24
+
+
+def hash_kmers(kmers):
+    """
+    Hash k-mers with the 64 bit finalizer of MurmurHash3 such that the
+    hashes are uniformly distributed
+    :param kmers: array of uint64 k-mers
+    :return: array of uint64 hashes
+    """
+    h = kmers.copy()
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xff51afd7ed558ccd)
+    h ^= h >> np.uint64(33)
+    h *= np.uint64(0xc4ceb9fe1a85ec53)
+    h ^= h >> np.uint64(33)
+    return h
+
+
+class Sketch(object):
+
+    def __init__(self, args):
+        """
+
+        :param args: list of arguments from command line
+        """
+        self.args = args
+        self.k = SKETCH_KMER_SIZE
+        self.scaled = args.sketch_scaled
+        self.max_hash = np.uint64((1 << 64) // self.scaled)
+        self.elapsed_time = 0
+
+        self.logger = logging.getLogger(__name__)
+        self._species_name = self.args.species_name
+
+        self._sketch_folder = os.path.join(self.args.output_path,
+                                           '02_ref_sketch')
+
+    def sketch_sequences(self, seqs):
+        """
+        Sketch sequences by keeping the hashes of their canonical k-mers
+        below max_hash
+        :param seqs: iterable of sequence strings
+        :return: sorted array of unique hashes
+        """
+        hashes = []
+        num_hashes = 0
+        with np.errstate(over='ignore'):
+            for chunk in chunk_by_bases(seqs, len):
+                codes, _ = encode_sequences(chunk)
+                kmers, valid = canonical_kmers(codes, self.k)
+                chunk_hashes = hash_kmers(kmers[valid])
+                hashes.append(chunk_hashes[chunk_hashes < self.max_hash])
+                num_hashes += hashes[-1].size
+                if num_hashes > MERGE_HASHES:
+                    hashes = [np.unique(np.concatenate(hashes))]
+                    num_hashes = hashes[0].size
+        return np.unique(np.concatenate(hashes + [np.zeros(0, np.uint64)]))
+
+    def get_reference_sketch(self, species, records):
+        """
+        Sketch of a reference species, which is cached in 02_ref_sketch and
+        re-computed once the reference DNA file of the species is newer
+        :param species: reference species
+        :param records: DNA records of the reference species
+        :return: sorted array of unique hashes
+        """
+        sketch_file = os.path.join(self._sketch_folder,
+                                   '{}_k{}_s{}.npy'.format(species, self.k,
+                                                           self.scaled))
+        ref_file = os.path.join(self.args.output_path, '02_ref_dna',
+                                species + '_OGs.fa')
+        if os.path.exists(sketch_file) and \
+                (not os.path.exists(ref_file) or
+                 os.path.getmtime(sketch_file) >= os.path.getmtime(ref_file)):
+            return np.load(sketch_file)
+
+        sketch = self.sketch_sequences(str(record.seq) for record in records)
+        os.makedirs(self._sketch_folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self._sketch_folder,
+                                         suffix='.npy', delete=False) as f:
+            np.save(f, sketch)
+        os.replace(f.name, sketch_file)
+        return sketch
+
+    def get_reads_sketch(self, reads):
+        """
+        Sketch of all the reads of the sample
+        :param reads: read file or list of two paired read files
+        :return: sorted array of unique hashes
+        """
+        files = reads if isinstance(reads, list) else [reads]
+
+        def read_seqs():
+            for file in files:
+                fastx_reader = FastxReader(file)
+                with fastx_reader.open_fastx() as f:
+                    for _, seq, _ in tqdm(fastx_reader.readfx(f),
+                                          desc='Sketching reads',
+                                          unit=' reads'):
+                        yield seq
+
+        return self.sketch_sequences(read_seqs())
+
+    def select_species(self, ref, references, reads, max_species):
+        """
+        Rank the reference species by the fraction of their sketch contained
+        in the sketch of the reads
+        :param ref: dictionary with all reference species
+        :param references: reference species to choose from
+        :param reads: read file or list of two paired read files
+        :param max_species: number of reference species to select
+        :return: list of the closest reference species
+        """
+        start = time.time()
+        print('--- Selecting {} closest reference species ---'
+              .format(max_species))
+        reads_sketch = self.get_reads_sketch(reads)
+        containment = {}
+        for species in tqdm(references, desc='Sketching references',
+                            unit=' species'):
+            sketch = self.get_reference_sketch(species, ref[species].dna)
+            shared = np.intersect1d(sketch, reads_sketch,
+                                    assume_unique=True).size
+            containment[species] = shared / max(1, sketch.size)
+        ranked = sorted(references, key=lambda x: (-containment[x], x))
+        for species in ranked:
+            self.logger.debug('{}: Containment of {} in reads is {:.4f}.'
+                              .format(self._species_name, species,
+                                      containment[species]))
+
+        self.elapsed_time = time.time() - start
+        self.logger.info('{}: Selected reference species {} out of {}.'
+                         .format(self._species_name,
+                                 ', '.join(ranked[:max_species]),
+                                 len(references)))
+        self.logger.info('{}: Selection of reference species took {}.'
+                         .format(self._species_name, self.elapsed_time))
+        return ranked[:max_species]
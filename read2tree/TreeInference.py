@@ -26,10 +26,12 @@ class TreeInference(object):
         if self.args.reads:
             if len(self.args.reads) == 2:
                 self._reads = self.args.reads
-                self._species_name = self._reads[0].split("/")[-1].split(".")[0]
+                self._species_name = self._reads[0].split(",")[0] \
+                    .split("/")[-1].split(".")[0]
             else:
                 self._reads = self.args.reads[0]
-                self._species_name = self._reads.split("/")[-1].split(".")[0]
+                self._species_name = self._reads.split(",")[0] \
+                    .split("/")[-1].split(".")[0]
 
         if self.args.species_name:
             self._species_name = self.args.species_name
@@ -8,6 +8,7 @@ import bz2
 import gzip
 import os
 import sys
+import numpy as np
 
 
 # File opening. This is based on the example on SO here:
@@ -133,3 +134,69 @@ def check_array_ids(args):
         raise RuntimeError('User requested HOGPROP to run as job array.'
                            'Can\'t find job ID ({}) or array ID ({}).'
                            .format(args.job_id, args.worker_id))
+
+
+class HashSet(object):
+    '''
+        Compact set of 64 bit hashes stored in a numpy array with open
+        addressing and linear probing. Hashes are added in batches, such that
+        the probing is vectorised over the batch.
+    '''
+    def __init__(self, capacity=1 << 16):
+        self.size = 0
+        self._table = np.zeros(1 << max(4, int(capacity - 1).bit_length()),
+                               dtype=np.uint64)
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hashes):
+        '''
+            Add a batch of hashes to the set.
+            :param hashes: array of uint64 hashes (0 is stored as 1)
+            :return: boolean array which is True for the hashes that were not
+                     in the set yet and for their first occurrence in the
+                     batch
+        '''
+        hashes = np.maximum(np.asarray(hashes, dtype=np.uint64),
+                            np.uint64(1))
+        keys, first = np.unique(hashes, return_index=True)
+        while 2 * (self.size + len(keys)) > len(self._table):
+            self._grow()
+        new = np.zeros(len(hashes), dtype=bool)
+        new[first[self._insert(keys)]] = True
+        return new
+
+    def _grow(self):
+        keys = self._table[self._table != 0]
+        self._table = np.zeros(2 * len(self._table), dtype=np.uint64)
+        self.size = 0
+        self._insert(keys)
+
+    def _insert(self, keys):
+        '''
+            Insert unique non-zero keys into the table.
+            :param keys: array of unique uint64 keys
+            :return: boolean array which is True for the inserted keys
+        '''
+        mask = np.uint64(len(self._table) - 1)
+        inserted = np.zeros(len(keys), dtype=bool)
+        slots = keys & mask
+        pending = np.arange(len(keys))
+        while pending.size:
+            current = self._table[slots[pending]]
+            empty = current == 0
+            # of several keys probing the same empty slot the first one is
+            # stored, the others probe the slot again in the next round
+            _, claim = np.unique(slots[pending[empty]], return_index=True)
+            winners = pending[empty][claim]
+            self._table[slots[winners]] = keys[winners]
+            inserted[winners] = True
+            self.size += len(winners)
+            collided = ~empty & (current != keys[pending])
+            slots[pending[collided]] = (slots[pending[collided]] +
+                                        np.uint64(1)) & mask
+            retry = np.ones(len(pending), dtype=bool)
+            retry[np.flatnonzero(empty)[claim]] = False
+            pending = pending[(collided | empty) & retry]
+        return inserted
@@ -14,13 +14,17 @@
     -- David V Dylus, July--XX 2017
 '''
 import os
+import copy
+import glob
 import logging
+from multiprocessing import Pool
 from datetime import date
 from timeit import default_timer as timer
 import read2tree
 from read2tree.OGSet import OGSet
 from read2tree.ReferenceSet import ReferenceSet
 from read2tree.Mapper import Mapper
+from read2tree.Reads import Reads
 from read2tree.Aligner import Aligner
 from read2tree.Progress import Progress
 from read2tree.TreeInference import TreeInference
@@ -53,13 +57,59 @@ def parse_args(argv, exe_name, desc):
                             help='[Default is 1] Number of threads for the mapping '
                                  'using ngm / ngmlr!')
 
+    arg_parser.add_argument('--mapping_jobs', type=int, default=1,
+                            help='[Default is 1] Number of reference species '
+                                 'that are mapped concurrently. The number of '
+                                 '--threads is shared among these jobs.')
+
+    arg_parser.add_argument('--combined_mapping', action='store_true',
+                            help='[Default is off] Map the reads in a single '
+                                 'pass against a reference combining all '
+                                 'reference species instead of once per '
+                                 'species. This approximates the mapping per '
+                                 'species: short reads are reported with '
+                                 'their n best alignments across all species '
+                                 '(ngm --topn, n the number of species) and '
+                                 'keep the best of them within each species, '
+                                 'but hits to paralogs or closely related '
+                                 'species can push out the alignment to '
+                                 'another species. ngmlr reports no '
+                                 'additional alignments, long reads are only '
+                                 'assigned to their best hit across all '
+                                 'species. Coverage and consensus can '
+                                 'therefore be lower than with the mapping '
+                                 'per species.')
+
+    arg_parser.add_argument('--index_cache', action='store_true',
+                            help='[Default is off] Keep the ngm / ngmlr '
+                                 'index of each reference in a cache such '
+                                 'that it is built only once and re-used '
+                                 'across samples and runs.')
+
+    arg_parser.add_argument('--index_cache_dir', default=None,
+                            help='[Default is ngm_index_cache in output '
+                                 'directory] Folder of the reference index '
+                                 'cache.')
+
+    arg_parser.add_argument('--index_cache_size', type=int, default=200,
+                            help='[Default is 200] Maximum number of '
+                                 'references kept in the index cache. The '
+                                 'least recently used ones are removed.')
+
     arg_parser.add_argument('--standalone_path', default='.',
                             help='[Default is current directory] Path to '
                                  'oma standalone directory.')
 
     arg_parser.add_argument('--reads', nargs='+', default=None,
                             help='[Default is none] Reads to be mapped to reference. If paired '
-                            'end add separated by space.')
+                            'end add separated by space. Reads of several '
+                            'lanes can be given as comma separated files, '
+                            'which are read one after the other.')
+
+    arg_parser.add_argument('--interleaved', action='store_true',
+                            help='[Default is off] The reads are paired end '
+                            'reads with both mates interleaved in a single '
+                            'file.')
 
     arg_parser.add_argument('--read_type', default='short',
                             help='[Default is short reads] Type of reads to '
@@ -84,10 +134,67 @@ def parse_args(argv, exe_name, desc):
                             'value are cut into smaller values as defined '
                             'by --split_len. ')
 
+    arg_parser.add_argument('--compress_tmp_reads', action='store_true',
+                            help='[Default is off] Write the reads produced '
+                            'by --split_reads, --sample_reads, '
+                            '--dedup_reads and --check_mate_pairing gzip '
+                            'compressed (with pigz if available) to save '
+                            'temporary disk space.')
+
+    arg_parser.add_argument('--stream_reads', action='store_true',
+                            help='[Default is off] Do not write the reads '
+                            'selected by --check_mate_pairing or split by '
+                            '--split_reads to disk but produce them into '
+                            'named pipes read by the following single pass '
+                            'steps (--dedup_reads, --sample_reads, '
+                            '--max_ref_species, --kmer_filter). As ngm and '
+                            'ngmlr open their input several times, the reads '
+                            'are written once before mapping, unless '
+                            '--dedup_reads, --sample_reads or --kmer_filter '
+                            'already wrote them.')
+
+    arg_parser.add_argument('--dedup_reads', action='store_true',
+                            help='[Default is off] Before mapping, remove '
+                            'duplicate reads (read pairs), e.g. of PCR '
+                            'amplified libraries, and keep only their first '
+                            'occurrence.')
+
+    arg_parser.add_argument('--dedup_prefix_len', type=int, default=0,
+                            help='[Default is 0] Reads are duplicates if '
+                            'their first bases up to this length are '
+                            'identical. If 0, the whole reads are compared.')
+
     arg_parser.add_argument('--sample_reads', action='store_true',
                             help='[Default is off] Splits reads as defined by split_len (200) '
                             'and split_overlap (0) parameters. ')
 
+    arg_parser.add_argument('--kmer_filter', action='store_true',
+                            help='[Default is off] Before mapping, discard '
+                                 'the reads that share less than '
+                                 '--min_shared_kmers k-mers with the '
+                                 'reference DNA sequences.')
+
+    arg_parser.add_argument('--kmer_size', type=int, default=19,
+                            help='[Default is 19] Length of the k-mers used '
+                                 'by --kmer_filter (at most 31).')
+
+    arg_parser.add_argument('--min_shared_kmers', type=int, default=2,
+                            help='[Default is 2] Minimum number of k-mers a '
+                                 'read has to share with the reference to '
+                                 'be kept by --kmer_filter. Paired reads '
+                                 'are kept if one of the mates passes.')
+
+    arg_parser.add_argument('--max_ref_species', type=int, default=0,
+                            help='[Default is 0, all species] Map the reads '
+                                 'only to this number of reference species, '
+                                 'which are the closest to the reads by '
+                                 'MinHash sketch containment.')
+
+    arg_parser.add_argument('--sketch_scaled', type=int, default=100,
+                            help='[Default is 100] On average one out of '
+                                 'this number of k-mers is kept in the '
+                                 'sketches used by --max_ref_species.')
+
     arg_parser.add_argument('--coverage', type=float, default=10,
                             help='[Default is 10] coverage in X.')
 
@@ -103,11 +210,21 @@ def parse_args(argv, exe_name, desc):
 
     arg_parser.add_argument('--dna_reference', default='',
                             help='[Default is None] Reference file that contains nucleotide '
-                            'sequences (fasta, hdf5). If not given it will use'
+                            'sequences (fasta, hdf5). A fasta file is indexed '
+                            'once, a gzip compressed one is first '
+                            're-compressed with bgzip next to it (or in the '
+                            'output path). If not given it will use'
                             'the RESTapi and retrieve sequences '
                             'from http://omabrowser.org directly. '
                             'NOTE: internet connection required!')
 
+    arg_parser.add_argument('--rest_cache', default='',
+                            help='[Default is ~/.cache/read2tree/'
+                            'oma_rest_cache.sqlite] File caching the '
+                            'nucleotide sequences retrieved from the RESTapi '
+                            'across runs, separately for every api url and '
+                            'OMA release.')
+
     arg_parser.add_argument('--ignore_species', default=None,
                             help='[Default is none] Ignores species part of '
                             'the OMA standalone pipeline. Input is comma '
@@ -185,13 +302,27 @@ def parse_args(argv, exe_name, desc):
     arg_parser.add_argument('--min_species', type=int, default=None,
                             help='Min number of species in selected '
                             'orthologous groups. If not selected it will be '
-                            'estimated such that around 1000 OGs '
+                            'estimated such that around --target_ogs OGs '
                             'are available.')
 
+    arg_parser.add_argument('--target_ogs', type=int, default=1000,
+                            help='[Default is 1000] Number of OGs that '
+                            'should be selected if --min_species is '
+                            'estimated. The histogram of the number of '
+                            'species per OG is stored in the output '
+                            'folder and reused by later runs.')
+
     arg_parser.add_argument('--single_mapping', default=None,
                             help='[Default is none] Single species file allowing to map in a '
                             'job array.')
 
+    arg_parser.add_argument('--parallel_mapping', type=int, default=0,
+                            help='[Default is 0, off] Run the mapping to each '
+                            'reference species as a --single_mapping job in '
+                            'this number of local processes and merge the '
+                            'mappings once all jobs are finished. The '
+                            'number of --threads is shared among the jobs.')
+
     # Arguments to map the reads
     arg_parser.add_argument('--ref_folder', default=None,
                             help='[Default is none] Folder containing reference files with '
@@ -206,14 +337,26 @@ def parse_args(argv, exe_name, desc):
     _reads = ""
     _species_name = ""
 
+    if args.interleaved:
+        if not args.reads or len(args.reads) != 1:
+            arg_parser.error(
+                'Argument --interleaved requires a single read file.')
+        if args.read_type != 'short':
+            arg_parser.error(
+                'Argument --interleaved only works for short reads.')
+        # both mates are read from the same file
+        args.reads = args.reads * 2
+
     if args.reads:
         print(args.reads)
         if len(args.reads) == 2:
             _reads = args.reads
-            _species_name = _reads[0].split("/")[-1].split(".")[0]
+            _species_name = _reads[0].split(",")[0] \
+                .split("/")[-1].split(".")[0]
         else:
             _reads = args.reads[0]
-            _species_name = _reads.split("/")[-1].split(".")[0]
+            _species_name = _reads.split(",")[0] \
+                .split("/")[-1].split(".")[0]
 
     if args.species_name:
         _species_name = args.species_name
@@ -235,6 +378,48 @@ def parse_args(argv, exe_name, desc):
         arg_parser.error(
             'Splitting reads does not work for paired end reads.')
 
+    if args.combined_mapping and args.single_mapping:
+        arg_parser.error(
+            'Arguments --combined_mapping and --single_mapping can not be '
+            'combined.')
+
+    if not args.kmer_filter and (args.kmer_size != 19 or
+                                 args.min_shared_kmers != 2):
+        arg_parser.error(
+            'Arguments --kmer_size and --min_shared_kmers '
+            'can only be set if --kmer_filter is set.')
+
+    if not 0 < args.kmer_size < 32:
+        arg_parser.error('Argument --kmer_size has to be between 1 and 31.')
+
+    if args.dedup_prefix_len and not args.dedup_reads:
+        arg_parser.error(
+            'Argument --dedup_prefix_len can only be set if --dedup_reads is '
+            'set.')
+
+    if args.dedup_prefix_len < 0:
+        arg_parser.error('Argument --dedup_prefix_len has to be positive.')
+
+    if args.target_ogs < 1:
+        arg_parser.error('Argument --target_ogs has to be positive.')
+
+    if args.max_ref_species < 0 or args.sketch_scaled < 1:
+        arg_parser.error(
+            'Arguments --max_ref_species and --sketch_scaled have to be '
+            'positive.')
+
+    if args.parallel_mapping and args.stream_reads:
+        arg_parser.error(
+            'Arguments --parallel_mapping and --stream_reads can not be '
+            'combined.')
+
+    if args.parallel_mapping and (args.single_mapping or
+                                  args.combined_mapping or
+                                  args.max_ref_species):
+        arg_parser.error(
+            'Argument --parallel_mapping can not be combined with '
+            '--single_mapping, --combined_mapping or --max_ref_species.')
+
     if args.read_type == 'short' and args.ngmlr_parameters:
         arg_parser.error(
             'Arguments for --ngmlr_parameters only work if --read_type is set '
@@ -254,6 +439,71 @@ def parse_args(argv, exe_name, desc):
     return args
 
 
+def _map_single_species(job):
+    """
+    Worker of --parallel_mapping running the mapping to a single reference
+    species as done by --single_mapping
+    :param job: tuple of arguments and reference of the species
+    """
+    args, ref = job
+    Mapper(args, ref_set=ref)
+
+
+def map_parallel(args, reference):
+    """
+    Map the reads to all reference species as --single_mapping jobs run in
+    --parallel_mapping local processes. The reads are pre-processed only
+    once and shared by all jobs.
+    :param args: list of arguments from command line
+    :param reference: dictionary with all reference species
+    """
+    logger.info('{}: --- Mapping reads in {} parallel single species jobs '
+                '---'.format(args.species_name, args.parallel_mapping))
+    read_container = Reads(args)
+    job_args = copy.copy(args)
+    # merged lanes or interleaved reads are written once for all the jobs,
+    # as the read mappers can not read them from a stream
+    job_args.reads = read_container.write_stream(read_container.reads)
+    job_args.interleaved = False
+    job_args.split_reads = False
+    job_args.sample_reads = False
+    job_args.check_mate_pairing = False
+    job_args.dedup_reads = False
+    job_args.threads = max(1, args.threads // args.parallel_mapping)
+    job_args.parallel_mapping = 0
+
+    jobs = []
+    for ref_file in sorted(glob.glob(os.path.join(args.output_path,
+                                                  '02_ref_dna', '*_OGs.fa'))):
+        species = os.path.basename(ref_file).split('_')[0]
+        single_args = copy.copy(job_args)
+        single_args.single_mapping = ref_file
+        jobs.append((single_args,
+                     {key: reference[key] for key in
+                      (species, args.remove_species_ogs) if key in reference}))
+
+    with Pool(min(args.parallel_mapping, max(1, len(jobs)))) as pool:
+        for _ in pool.imap_unordered(_map_single_species, jobs):
+            pass
+    read_container.cleanup()
+
+
+def get_mapper(args, ogset, reference, progress):
+    """
+    Map the reads to the reference species, either in this process or with
+    --parallel_mapping in single species jobs that are merged afterwards
+    :return: Mapper object
+    """
+    if args.parallel_mapping:
+        map_parallel(args, reference.ref)
+        # the jobs write to the mapping folder of the species name
+        return Mapper(args, og_set=ogset.ogs, ref_set=reference.ref,
+                      load=False, progress=progress,
+                      mapping_name=args.species_name)
+    return Mapper(args, og_set=ogset.ogs, ref_set=reference.ref,
+                  progress=progress)
+
+
 def main(argv, exe_name, desc=''):
     '''
         Main function.
@@ -286,7 +536,7 @@ def main(argv, exe_name, desc=''):
         reference = ReferenceSet(args, og_set=ogset.ogs, load=True, progress=progress)
         alignments = Aligner(args, ogset.ogs, load=True)
         if not args.reference:
-            mapper = Mapper(args, og_set=ogset.ogs, ref_set=reference.ref, progress=progress)
+            mapper = get_mapper(args, ogset, reference, progress)
             alignments.remove_species_from_alignments()
             ogset.remove_species_from_ogs()
             ogset.add_mapped_seq(mapper)
@@ -307,7 +557,7 @@ def main(argv, exe_name, desc=''):
         reference = ReferenceSet(args, og_set=ogset.ogs, load=True, progress=progress)  # Generate the reference
         alignments = Aligner(args, ogset.ogs, load=True)
         if not args.reference:  # just generate reference
-            mapper = Mapper(args, og_set=ogset.ogs, ref_set=reference.ref, progress=progress)
+            mapper = get_mapper(args, ogset, reference, progress)
             alignments.remove_species_from_alignments()
             ogset.remove_species_from_ogs()
             ogset.add_mapped_seq(mapper)
@@ -327,7 +577,7 @@ def main(argv, exe_name, desc=''):
         reference = ReferenceSet(args, load=False, progress=progress)
         alignments = Aligner(args, ogset.ogs, load=True)
         if not args.reference:  # just generate reference
-            mapper = Mapper(args, og_set=ogset.ogs, ref_set=reference.ref, progress=progress)
+            mapper = get_mapper(args, ogset, reference, progress)
             alignments.remove_species_from_alignments()
             ogset.remove_species_from_ogs()
             ogset.add_mapped_seq(mapper)
@@ -350,7 +600,7 @@ def main(argv, exe_name, desc=''):
             ogset = OGSet(args, load=False, progress=progress)
             reference = ReferenceSet(args, load=False, progress=progress)
             alignments = Aligner(args, load=False)
-            mapper = Mapper(args, og_set=ogset.ogs, ref_set=reference.ref, progress=progress)  # Run the mapping
+            mapper = get_mapper(args, ogset, reference, progress)  # Run the mapping
             alignments.remove_species_from_alignments()
             ogset.remove_species_from_ogs()
             ogset.add_mapped_seq(mapper)
@@ -1,6 +1,12 @@
 import glob
 import os
+import json
+import hashlib
+import tempfile
 
+from collections import Counter
+from contextlib import contextmanager
+from multiprocessing import Pool
 from tqdm import tqdm
 from Bio import SeqIO, Seq, SeqRecord
 #from tables import *
@@ -9,6 +15,82 @@ from Bio import SeqIO, Seq, SeqRecord
 OMA_STANDALONE_OUTPUT = 'Output'
 OMA_MARKER_GENE_EXPORT = 'marker_genes'
 
+# file in the output folder storing the number of species per OG
+OG_SPECIES_HISTOGRAM = 'og_species_histogram.json'
+
+# number of OG files handed to a worker process at once
+FILES_CHUNK_SIZE = 64
+
+
+def get_species_id(description, record_id):
+    '''
+    :param description: description of a fasta record, i.e. its full header
+    :param record_id: id of the fasta record
+    :return: species given in [] in the description or the first five
+             characters of the id
+    '''
+    if '[' in description and ']' in description:
+        return description[description.find("[")+1:description.find("]")]
+    else:
+        return record_id[0:5]
+
+
+def estimate_min_species(histogram, target_ogs):
+    '''
+    Pick the min number of species such that the number of selected OGs is
+    closest to the target, preferring the larger threshold on ties
+    :param histogram: Counter of the number of OGs by number of species
+    :param target_ogs: number of OGs that should be selected
+    :return: min number of species
+    '''
+    best = 0
+    best_diff = None
+    num_ogs = 0
+    for num_species in sorted(histogram, reverse=True):
+        num_ogs += histogram[num_species]
+        if best_diff is None or abs(num_ogs - target_ogs) < best_diff:
+            best, best_diff = num_species, abs(num_ogs - target_ogs)
+    return best
+
+
+def _scan_og_headers(task):
+    '''
+    Count the records of an OG file and collect their species from the
+    headers only, without parsing the sequences
+    :param task: tuple of the OG file and the species to ignore
+    :return: number of records that are not ignored and set of their species
+    '''
+    file, ignore_species = task
+    num_records = 0
+    species = set()
+    with open(file) as f:
+        for line in f:
+            if line[0] != '>':
+                continue
+            description = line[1:].rstrip()
+            record_id = description.split(None, 1)[0] if description else ''
+            species_id = get_species_id(description, record_id)
+            if species_id not in ignore_species:
+                num_records += 1
+                species.add(species_id)
+    return num_records, species
+
+
+def _load_og_records(task):
+    '''
+    Parse the records of an OG file whose species are not ignored
+    :param task: tuple of the OG file, the name of the OG and the species to
+                 ignore
+    :return: list of records with the name of the OG appended to their ids
+    '''
+    file, name, ignore_species = task
+    records = []
+    for record in SeqIO.parse(file, 'fasta'):
+        if get_species_id(record.description, record.id) not in ignore_species:
+            record.id = record.id + "_" + name
+            records.append(record)
+    return records
+
 
 class OMAOutputParser(object):
 
@@ -21,13 +103,14 @@ class OMAOutputParser(object):
         self.oma_output_path = self._check_oma_output_path()
         self.num_selected_ogs = 0
         self.num_species = 0
-
-        self.min_species = self._estimate_best_number_species()
+        self._og_headers = None
 
         if self.args.ignore_species:
             self.ignore_species = self.args.ignore_species.split(",")
         else:
             self.ignore_species = []
+
+        self.min_species = self._estimate_best_number_species()
         self.ogs = self._load_ogs_from_path()
 
     def _check_oma_output_path(self):
@@ -69,84 +152,181 @@ class OMAOutputParser(object):
 
     def _filter_ogs_min_species(self):
         """
-
-        :return:
+        Load the OGs of the oma standalone output with at least min_species
+        records
+        :return: dictionary with the name of the OG as key and its records
+                 as value
         """
-        names_og = {}
-        unique_species = []
-        orthologous_groups_fasta = os.path.join(self.oma_output_path,
-                                                "OrthologousGroupsFasta")
         print('--- Load OGs with min {} species from oma '
               'standalone! ---'.format(self.min_species))
-        files = (glob.glob(os.path.join(orthologous_groups_fasta, "*.fa")) or
-                 glob.glob(os.path.join(orthologous_groups_fasta, "*.fasta")))
-        for file in tqdm(files, desc='Pre-filter files',
-                         unit=' OGs'):
-            name = file.split("/")[-1].split(".")[0]
-            records = list(SeqIO.parse(file, 'fasta'))
-            new_records = []
-            for record in records:
-                species = self._get_species_id(record)
-                if species not in self.ignore_species:
-                    new_records.append(record)
-                    if species not in unique_species:
-                        unique_species.append(species)
-                        self.num_species += 1
-                new_id = record.id + "_" + name
-                record.id = new_id
-
-            if len(new_records) >= self.min_species:
-                names_og[name] = new_records
-                self.num_selected_ogs += 1
-        return names_og
-
-    def _get_species_id(self, record):
-        if '[' in record.description and ']' in record.description:
-            return record.description[record.description.find(
-                "[")+1:record.description.find("]")]
-        else:
-            return record.id[0:5]
+        return self._filter_ogs()
 
     def _filter_ogs_min_species_marker(self):
         """
-
-        :return:
+        Load the OGs of the oma marker gene export with at least min_species
+        records
+        :return: dictionary with the name of the OG as key and its records
+                 as value
         """
-        names_og = {}
-        unique_species = []
-        orthologous_groups_fasta = os.path.join(self.oma_output_path,
-                                                "marker_genes")
         print('--- Load OGs with min {} species from oma '
               'marker gene export! ---'.format(self.min_species))
+        return self._filter_ogs()
+
+    def _get_og_files(self):
+        """
+        :return: list of OG files and list of the names of the OGs
+        """
+        if self.mode == "marker_genes":
+            orthologous_groups_fasta = os.path.join(self.oma_output_path,
+                                                    "marker_genes")
+        else:
+            orthologous_groups_fasta = os.path.join(self.oma_output_path,
+                                                    "OrthologousGroupsFasta")
         files = (glob.glob(os.path.join(orthologous_groups_fasta, "*.fa")) or
                  glob.glob(os.path.join(orthologous_groups_fasta, "*.fasta")))
-        for file in tqdm(files, desc='Loading files for pre-filter',
-                         unit=' OGs'):
-            name = file.split("/")[-1].split(".")[0].replace('OMAGroup_', 'OG')
-            records = list(SeqIO.parse(file, 'fasta'))
-            new_records = []
-            for record in records:
-                species = self._get_species_id(record)
-                if species not in self.ignore_species:
-                    new_records.append(record)
-                    if species not in unique_species:
-                        unique_species.append(species)
-                        self.num_species += 1
-                    new_id = record.id + "_" + name
-                    record.id = new_id
-
-            if len(new_records) >= self.min_species:
-                names_og[name] = new_records
-                self.num_selected_ogs += 1
+        names = [file.split("/")[-1].split(".")[0] for file in files]
+        if self.mode == "marker_genes":
+            names = [name.replace('OMAGroup_', 'OG') for name in names]
+        return files, names
+
+    def _filter_ogs(self):
+        """
+        Parse the records of the OGs with at least min_species records, which
+        is run by --threads worker processes
+        :return: dictionary with the name of the OG as key and its records
+                 as value
+        """
+        files, names, num_records, species = self._get_og_headers()
+        ignore_species = frozenset(self.ignore_species)
+        selected = [(file, name, ignore_species) for file, name, num in
+                    zip(files, names, num_records) if num >= self.min_species]
+        names_og = {}
+        with self._get_pool() as imap:
+            for (_, name, _), records in zip(
+                    selected, tqdm(imap(_load_og_records, selected),
+                                   total=len(selected), desc='Loading OGs',
+                                   unit=' OGs')):
+                names_og[name] = records
+        self.num_species = len(species)
+        self.num_selected_ogs = len(names_og)
         return names_og
 
+    def _get_og_headers(self):
+        """
+        Count the records of all OG files and collect their species from the
+        headers, which is run by --threads worker processes. The counts are
+        stored in the output folder and reused as long as the OG files and
+        the ignored species are unchanged.
+        :return: list of OG files, list of the names of the OGs, list of the
+                 number of records per OG that are not ignored and set of
+                 their species
+        """
+        if self._og_headers is not None:
+            return self._og_headers
+        files, names = self._get_og_files()
+        key = self._get_og_files_key(files)
+        cached = self._get_cached_og_headers(key)
+        if cached is not None:
+            num_records, species = cached['num_records'], set(cached['species'])
+        else:
+            num_records = []
+            species = set()
+            ignore_species = frozenset(self.ignore_species)
+            with self._get_pool() as imap:
+                for num, og_species in tqdm(
+                        imap(_scan_og_headers,
+                             [(file, ignore_species) for file in files]),
+                        total=len(files), desc='Pre-filter files',
+                        unit=' OGs'):
+                    num_records.append(num)
+                    species |= og_species
+            self._record_og_headers(key, num_records, species)
+        self._og_headers = (files, names, num_records, species)
+        return self._og_headers
+
+    def _get_og_files_key(self, files):
+        """
+        Key of the OG files and the ignored species the counts are valid for
+        :param files: list of OG files
+        :return: sha1 hex digest of the paths, sizes and modification times of
+                 the OG files and the ignored species
+        """
+        digest = hashlib.sha1()
+        digest.update(json.dumps(sorted(self.ignore_species)).encode())
+        for file in files:
+            file_stat = os.stat(file)
+            digest.update('{}\t{}\t{}\n'.format(
+                os.path.abspath(file), file_stat.st_size,
+                file_stat.st_mtime_ns).encode())
+        return digest.hexdigest()
+
+    def _get_histogram_file(self):
+        return os.path.join(self.args.output_path, OG_SPECIES_HISTOGRAM)
+
+    def _get_cached_og_headers(self, key):
+        """
+        :param key: key of the OG files and the ignored species
+        :return: dictionary of the stored counts or None if they are missing
+                 or were computed for other OG files
+        """
+        try:
+            with open(self._get_histogram_file(), 'r') as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if cached.get('key') != key:
+            return None
+        return cached
+
+    def _record_og_headers(self, key, num_records, species):
+        """
+        Store the histogram of the number of species per OG together with the
+        counts of every OG file in the output folder
+        :param key: key of the OG files and the ignored species
+        :param num_records: list of the number of records per OG
+        :param species: set of species
+        """
+        histogram = Counter(num_records)
+        cached = {'key': key,
+                  'histogram': {str(k): histogram[k]
+                                for k in sorted(histogram)},
+                  'num_records': num_records, 'species': sorted(species)}
+        folder = os.path.dirname(os.path.abspath(self._get_histogram_file()))
+        os.makedirs(folder, exist_ok=True)
+        with tempfile.NamedTemporaryFile(mode='w', dir=folder,
+                                         suffix='.json', delete=False) as f:
+            json.dump(cached, f)
+        os.replace(f.name, self._get_histogram_file())
+
+    @contextmanager
+    def _get_pool(self):
+        """
+        :return: imap function of a pool of --threads worker processes or map
+                 if a single thread is used
+        """
+        if self.args.threads > 1:
+            pool = Pool(self.args.threads)
+            try:
+                yield lambda func, tasks: pool.imap(
+                    func, tasks, chunksize=FILES_CHUNK_SIZE)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            yield map
+
     def _estimate_best_number_species(self):
         """
-        Estimate min number of species such that around 1000 OGs are selected
-        :return:
+        Estimate min number of species such that around --target_ogs OGs are
+        selected from the histogram of the number of species per OG
+        :return: min number of species
         """
-        min_species = 0
-        if self.args.min_species != None:
-            min_species = self.args.min_species
+        if self.args.min_species is not None:
+            return self.args.min_species
 
+        num_records = self._get_og_headers()[2]
+        min_species = estimate_min_species(Counter(num_records),
+                                           self.args.target_ogs)
+        print('--- Estimated min {} species to select around {} '
+              'OGs! ---'.format(min_species, self.args.target_ogs))
         return min_species
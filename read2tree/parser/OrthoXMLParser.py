@@ -0,0 +1,56 @@
+from lxml import etree
+
+
+class OrthoXMLParser(object):
+
+    def __init__(self, orthoxml, og_ids=None):
+        '''
+        Initialise the OrthoXMLParser, which streams the orthoXML file once
+        and keeps only the protein IDs of the genes and the members of the
+        selected groups. The parsed elements are freed as the file is read.
+        :param orthoxml: orthoXML file, e.g. OrthologousGroups.orthoxml of
+                         the OMA standalone output
+        :param og_ids: IDs of the top level groups to keep, all groups are
+                       kept if None
+        '''
+        self.orthoxml = orthoxml
+        self._og_ids = None if og_ids is None else set(og_ids)
+        self.prot_ids = {}
+        self.groups = {}
+        self._parse()
+
+    def _parse(self):
+        for _, elem in etree.iterparse(
+                self.orthoxml, events=('end',),
+                tag=('{*}gene', '{*}species', '{*}orthologGroup',
+                     '{*}paralogGroup')):
+            tag = etree.QName(elem).localname
+            parent = elem.getparent()
+            if tag == 'gene':
+                self.prot_ids[elem.get('id')] = \
+                    elem.get('protId').split(' | ')[0]
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del parent[0]
+                continue
+            if tag != 'species' and etree.QName(parent).localname != 'groups':
+                continue  # nested groups are part of their top level group
+            if tag != 'species' and (self._og_ids is None or
+                                     elem.get('id') in self._og_ids):
+                self.groups[elem.get('id')] = [
+                    gene_ref.get('id') for gene_ref in elem.iter('{*}geneRef')]
+            elem.clear()
+            while elem.getprevious() is not None:
+                del parent[0]
+        # only the genes of the kept groups are needed
+        self.prot_ids = {gene_id: self.prot_ids[gene_id]
+                         for gene_ids in self.groups.values()
+                         for gene_id in gene_ids}
+
+    def get_prot_ids(self, og_id):
+        '''
+        Get the protein IDs of all genes of a top level group
+        :param og_id: ID of the group
+        :return: list of protein IDs in the order of the orthoXML file
+        '''
+        return [self.prot_ids[gene_id] for gene_id in self.groups[og_id]]
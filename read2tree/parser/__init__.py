@@ -1 +1,2 @@
-from .OMAOutputParser import *
\ No newline at end of file
+from .OMAOutputParser import *
+from .OrthoXMLParser import *
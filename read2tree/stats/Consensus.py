@@ -0,0 +1,440 @@
+import heapq
+import pysam
+import numpy as np
+
+# nucleotide alphabet of the 4 bit encoding used in bam files
+BAM_BASES = '=ACMGRSVTWYHKDBN'
+BASE_CODE = np.full(256, BAM_BASES.index('N'), dtype=np.uint8)
+for i, b in enumerate(BAM_BASES):
+    BASE_CODE[ord(b)] = i
+    BASE_CODE[ord(b.lower())] = i
+BASE_CHAR = np.frombuffer(BAM_BASES.encode(), dtype=np.uint8)
+N_CHAR = ord('N')
+
+# defaults of pysam.AlignmentFile.pileup() that are reproduced here
+PILEUP_FLAG_FILTER = 0x4 | 0x100 | 0x200 | 0x400
+PILEUP_MIN_BASE_QUALITY = 13
+PILEUP_MAX_DEPTH = 8000
+
+# number of retired reads whose bases are added to the counts at once
+COUNTS_CHUNK_SIZE = 10000
+
+CMATCH, CINS, CDEL, CREF_SKIP, CSOFT_CLIP, CHARD_CLIP, CPAD, CEQUAL, CDIFF = \
+    range(9)
+ALIGNED_OPS = (CMATCH, CEQUAL, CDIFF)
+REF_OPS = (CMATCH, CDEL, CREF_SKIP, CEQUAL, CDIFF)
+
+
+class Consensus(object):
+    """
+    Majority rule consensus of a sorted bam file computed from per reference
+    count matrices. The reads are processed once, the bases that pass the
+    same filters as a pysam pileup with default parameters (flag filter,
+    orphan reads, base quality, maximum depth and mate overlap correction) are accumulated
+    with numpy, and the consensus is called with vectorized operations.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.consensus = {}
+        self.depth = {}
+        self.missing = {}
+
+    def get_consensus_bam(self, file_name):
+        """
+        Build the consensus sequence of all references with mapped reads and
+        keep the read depth of all references as well as the number of
+        positions without a call of each consensus
+        :param file_name: sorted bam file
+        """
+        with pysam.AlignmentFile(file_name, 'rb') as bam:
+            for name, length in zip(bam.references, bam.lengths):
+                self.depth[name] = np.zeros(length, dtype=np.int64)
+            ref = None
+            for read in bam.fetch(until_eof=True):
+                if read.is_unmapped or read.reference_id < 0:
+                    continue
+                if ref is None or read.reference_id != ref.tid:
+                    if ref is not None:
+                        self._add_reference(ref)
+                    ref = _ReferencePileup(
+                        read.reference_id, read.reference_name,
+                        bam.get_reference_length(read.reference_name))
+                ref.push(read)
+            if ref is not None:
+                self._add_reference(ref)
+
+    def _add_reference(self, ref):
+        counts, depth = ref.get_counts()
+        self.depth[ref.name] = depth
+        seq = self._call_consensus(counts, depth)
+        # make sure that mapped sequence contains not only N
+        if np.unique(seq).size > 1:
+            self.consensus[ref.name] = seq.tobytes().decode()
+            self.missing[ref.name] = int(np.count_nonzero(seq == N_CHAR))
+
+    def _call_consensus(self, counts, depth):
+        """
+        Majority rule call of every column with enough coverage, ties are
+        resolved by the order of BAM_BASES
+        :param counts: matrix with the base counts of every column
+        :param depth: number of reads covering every column
+        :return: numpy array with the characters of the consensus sequence
+        """
+        seq = np.full(len(depth), N_CHAR, dtype=np.uint8)
+        called = (depth >= self.args.min_cons_coverage) & \
+            (counts.sum(axis=1) > 0)
+        seq[called] = BASE_CHAR[counts[called].argmax(axis=1)]
+        return seq
+
+
+class _AlignedRead(object):
+
+    __slots__ = ('qname', 'flag', 'pos', 'end', 'mtid', 'mpos', 'isize',
+                 'l_qseq', 'cigar', 'codes', 'qual', 'ref_pos', 'query_pos')
+
+    def __init__(self, read):
+        self.qname = read.query_name
+        self.flag = read.flag
+        self.pos = read.reference_start
+        self.mtid = read.next_reference_id
+        self.mpos = read.next_reference_start
+        self.isize = read.template_length
+        self.l_qseq = read.query_length
+        self.end = self.pos + sum(l for op, l in read.cigartuples
+                                  if op in REF_OPS)
+        self.cigar = read.cigartuples
+        seq = read.query_sequence
+        if seq:
+            self.codes = BASE_CODE[np.frombuffer(seq.encode(), np.uint8)]
+            qual = read.query_qualities
+            if qual is None:  # missing qualities are stored as 0xff
+                self.qual = np.full(len(seq), 0xff, dtype=np.uint8)
+            else:
+                self.qual = np.frombuffer(qual, dtype=np.uint8).copy()
+        else:
+            self.codes = None
+            self.qual = None
+        self.ref_pos, self.query_pos = self._get_aligned_pairs()
+
+    def _get_aligned_pairs(self):
+        """
+        :return: reference and query positions of all aligned bases
+        """
+        ref_starts, query_starts, lengths = [], [], []
+        ref_pos, query_pos = self.pos, 0
+        for op, l in self.cigar:
+            if op in ALIGNED_OPS:
+                ref_starts.append(ref_pos)
+                query_starts.append(query_pos)
+                lengths.append(l)
+                ref_pos += l
+                query_pos += l
+            elif op in (CINS, CSOFT_CLIP):
+                query_pos += l
+            elif op in (CDEL, CREF_SKIP):
+                ref_pos += l
+        if not lengths:
+            return np.zeros(0, np.int64), np.zeros(0, np.int64)
+        if len(lengths) == 1:
+            offsets = np.arange(lengths[0])
+            return ref_starts[0] + offsets, query_starts[0] + offsets
+        lengths = np.array(lengths, np.int64)
+        offsets = np.arange(lengths.sum()) - np.repeat(
+            np.cumsum(lengths) - lengths, lengths)
+        return (np.repeat(ref_starts, lengths) + offsets,
+                np.repeat(query_starts, lengths) + offsets)
+
+    def has_gaps(self):
+        return any(op in (CDEL, CREF_SKIP) for op, _ in self.cigar)
+
+
+class _ReferencePileup(object):
+    """
+    Reads of a single reference in the order they are pushed into the
+    htslib pileup buffer. Only the reads in the live window are kept, the
+    bases of a read are added to the count matrix as soon as it leaves the
+    window, since no later read can overlap it anymore.
+    """
+
+    def __init__(self, tid, name, length):
+        self.tid = tid
+        self.name = name
+        self.length = length
+        self._live = []  # heap of (end, number, read) of reads in buffer
+        self._num_reads = 0
+        self._overlaps = {}  # read name -> read waiting for mate
+        self._max_pos = -1
+        self._finished = []  # reads that left the buffer, not yet counted
+        self._depth = np.zeros(length + 1, dtype=np.int64)
+        self._counts = np.zeros(length * len(BAM_BASES), dtype=np.int64)
+
+    def push(self, read):
+        if read.flag & PILEUP_FLAG_FILTER:
+            return
+        # orphans (paired but not in proper pair) are ignored
+        if read.flag & 0x1 and not read.flag & 0x2:
+            return
+        pos = read.reference_start
+        # reads that ended before the last pileup column are retired
+        while self._live and self._live[0][0] <= self._max_pos - 1:
+            self._retire(heapq.heappop(self._live)[2])
+        # reads beyond the maximum depth are skipped at an already filled
+        # position (the buffer holds an additional empty node)
+        if pos == self._max_pos and \
+                len(self._live) + 1 > PILEUP_MAX_DEPTH:
+            self._remove_overlap(read)
+            return
+        self._max_pos = pos
+        aligned = _AlignedRead(read)
+        if aligned.end <= pos:
+            return
+        heapq.heappush(self._live, (aligned.end, self._num_reads, aligned))
+        self._num_reads += 1
+        self._depth[aligned.pos] += 1
+        self._depth[min(aligned.end, self.length)] -= 1
+        self._push_overlap(aligned)
+
+    def _retire(self, read):
+        self._remove_overlap(read)
+        self._finished.append(read)
+        if len(self._finished) >= COUNTS_CHUNK_SIZE:
+            self._add_counts()
+
+    def _remove_overlap(self, read):
+        if read.flag & 0x4 or not read.flag & 0x2:
+            return
+        self._overlaps.pop(read.query_name if isinstance(
+            read, pysam.AlignedSegment) else read.qname, None)
+
+    def _push_overlap(self, read):
+        """
+        Register a read of a properly paired template and correct the
+        qualities of the overlapping part once its mate arrives
+        """
+        if read.flag & 0x8 or not read.flag & 0x2:
+            return
+        if (read.mtid >= 0 and read.mtid != self.tid) or \
+                (abs(read.isize) >= 2 * read.l_qseq and
+                 read.mpos >= read.end):
+            return
+        mate = self._overlaps.pop(read.qname, None)
+        if mate is None:
+            if read.mpos >= read.pos or (read.flag & 0x1 and read.mpos == -1):
+                self._overlaps[read.qname] = read
+        else:
+            _tweak_overlap_quality(mate, read)
+
+    def _add_counts(self):
+        """
+        Add the bases of the retired reads to the count matrix
+        """
+        reads = [read for read in self._finished
+                 if read.codes is not None and read.ref_pos.size]
+        self._finished = []
+        if not reads:
+            return
+        positions = np.concatenate([read.ref_pos for read in reads])
+        codes = np.concatenate([read.codes[read.query_pos]
+                                for read in reads]).astype(np.int64)
+        qual = np.concatenate([read.qual[read.query_pos] for read in reads])
+        inside = (positions < self.length) & \
+            (qual >= PILEUP_MIN_BASE_QUALITY)
+        self._counts += np.bincount(positions[inside] * len(BAM_BASES) +
+                                    codes[inside],
+                                    minlength=self.length * len(BAM_BASES))
+
+    def get_counts(self):
+        """
+        :return: matrix with the counts of every base of BAM_BASES and
+                 array with the number of reads covering every column
+        """
+        while self._live:
+            self._retire(heapq.heappop(self._live)[2])
+        self._add_counts()
+        depth = np.cumsum(self._depth[:-1])
+        return self._counts.reshape(self.length, len(BAM_BASES)), depth
+
+
+def _qname_hash(name):
+    """
+    Hash of a read name as used by htslib to decide which mate keeps the
+    quality of an overlapping base
+    """
+    h = 0
+    for c in name.encode():
+        if c >= 128:  # char is signed
+            c -= 256
+        h = (h * 31 + c) & 0xffffffff if h else c & 0xffffffff
+    h = (h + ~(h << 15)) & 0xffffffff
+    h ^= h >> 10
+    h = (h + (h << 3)) & 0xffffffff
+    h ^= h >> 6
+    h = (h + ~(h << 11)) & 0xffffffff
+    h ^= h >> 16
+    return h
+
+
+def _tweak_overlap_quality(a, b):
+    """
+    Set the quality of one of the two bases in the overlap of the mates a
+    (left) and b (right) to zero, such that a template contributes only one
+    base to a column, the same way the htslib pileup does
+    :param a: _AlignedRead of the left mate
+    :param b: _AlignedRead of the right mate
+    """
+    if a.codes is None or b.codes is None or a.end <= b.pos:
+        return
+    amul = _qname_hash(a.qname) & 1
+    if not a.has_gaps() and not b.has_gaps():
+        # both mates are aligned without gaps, the overlapping bases are
+        # at the same offset in both reads
+        start = np.searchsorted(a.ref_pos, b.pos)
+        n = min(len(a.ref_pos) - start, len(b.ref_pos))
+        qa_pos = a.query_pos[start:start + n]
+        qb_pos = b.query_pos[:n]
+        qa = a.qual[qa_pos].astype(np.int64)
+        qb = b.qual[qb_pos].astype(np.int64)
+        same = a.codes[qa_pos] == b.codes[qb_pos]
+        total = np.minimum(qa + qb, 200)
+        a_down = (0.8 * qa).astype(np.int64)
+        b_down = (0.8 * qb).astype(np.int64)
+        a.qual[qa_pos] = np.where(
+            same, total * amul, np.where(
+                qa > qb, a_down, np.where(qa < qb, 0, a_down * amul)))
+        b.qual[qb_pos] = np.where(
+            same, total * (1 - amul), np.where(
+                qa > qb, 0, np.where(qa < qb, b_down,
+                                     b_down * (1 - amul))))
+    else:
+        _tweak_overlap_quality_gapped(a, b, amul, 1 - amul)
+
+
+class _CigarCursor(object):
+    """
+    Walk over the aligned bases of a read (cigar_iref2iseq_set / _next of
+    htslib)
+    """
+
+    __slots__ = ('cigar', 'i', 'icig', 'iseq', 'iref')
+
+    def __init__(self, cigar):
+        self.cigar = cigar
+        self.i = self.icig = self.iseq = self.iref = 0
+
+    def set(self, pos):
+        if pos < 0:
+            return -1
+        self.i = self.icig = self.iseq = self.iref = 0
+        while self.i < len(self.cigar):
+            op, l = self.cigar[self.i]
+            if op in ALIGNED_OPS:
+                pos -= l
+                if pos < 0:
+                    self.icig = l + pos
+                    self.iseq += self.icig
+                    self.iref += self.icig
+                    return CMATCH
+                self.iseq += l
+                self.iref += l
+            elif op in (CINS, CSOFT_CLIP):
+                self.iseq += l
+            elif op in (CDEL, CREF_SKIP):
+                pos = max(pos - l, 0)
+                self.iref += l
+            self.i += 1
+            self.icig = 0
+        self.iseq = -1
+        return -1
+
+    def next(self):
+        while self.i < len(self.cigar):
+            op, l = self.cigar[self.i]
+            if op in ALIGNED_OPS:
+                if self.icig >= l - 1:
+                    self.icig = -1
+                    self.i += 1
+                    continue
+                self.iseq += 1
+                self.icig += 1
+                self.iref += 1
+                return CMATCH
+            if op in (CDEL, CREF_SKIP):
+                self.iref += l
+            elif op in (CINS, CSOFT_CLIP):
+                self.iseq += l
+            self.i += 1
+            self.icig = -1
+        self.iseq = -1
+        self.iref = -1
+        return -1
+
+    def after_deletion(self):
+        return self.i > 0 and self.cigar[self.i - 1][0] == CDEL
+
+
+def _tweak_overlap_quality_gapped(a, b, amul, bmul):
+    """
+    Overlap correction of mates containing deletions or reference skips,
+    follows tweak_overlap_quality of htslib step by step
+    """
+    iref = b.pos
+    ca, cb = _CigarCursor(a.cigar), _CigarCursor(b.cigar)
+    a_ret = ca.set(iref - a.pos)
+    if a_ret < 0:
+        return
+    b_ret = cb.set(iref - b.pos)
+    if b_ret < 0:
+        return
+    a_qual, b_qual = a.qual, b.qual
+    while True:
+        while a_ret >= 0 and ca.iref >= 0 and ca.iref < iref - a.pos:
+            a_ret = ca.next()
+        if a_ret < 0:
+            return
+        while b_ret >= 0 and cb.iref >= 0 and cb.iref < iref - b.pos:
+            b_ret = cb.next()
+        if b_ret < 0:
+            return
+        iref = max(iref, ca.iref + a.pos, cb.iref + b.pos) + 1
+
+        if ca.iref + a.pos != cb.iref + b.pos:
+            if ca.iref + a.pos < cb.iref + b.pos and cb.after_deletion():
+                # deletion in b, a is behind
+                while True:
+                    a_qual[ca.iseq] = int(a_qual[ca.iseq] * 0.8) if amul \
+                        else 0
+                    a_ret = ca.next()
+                    if a_ret < 0:
+                        return
+                    if ca.iref + a.pos >= cb.iref + b.pos:
+                        break
+            elif ca.after_deletion():
+                # deletion in a, b is behind
+                while True:
+                    b_qual[cb.iseq] = int(b_qual[cb.iseq] * 0.8) if bmul \
+                        else 0
+                    b_ret = cb.next()
+                    if b_ret < 0:
+                        return
+                    if cb.iref + b.pos >= ca.iref + a.pos:
+                        break
+            else:
+                continue
+
+        if ca.iseq >= a.l_qseq or cb.iseq >= b.l_qseq:
+            return
+        qa, qb = int(a_qual[ca.iseq]), int(b_qual[cb.iseq])
+        if a.codes[ca.iseq] == b.codes[cb.iseq]:
+            total = min(qa + qb, 200)
+            a_qual[ca.iseq] = amul * total
+            b_qual[cb.iseq] = bmul * total
+        elif qa > qb:
+            a_qual[ca.iseq] = int(0.8 * qa)
+            b_qual[cb.iseq] = 0
+        elif qa < qb:
+            b_qual[cb.iseq] = int(0.8 * qb)
+            a_qual[ca.iseq] = 0
+        else:
+            a_qual[ca.iseq] = int(amul * 0.8 * qa)
+            b_qual[cb.iseq] = int(bmul * 0.8 * qb)
@@ -14,6 +14,16 @@ class Coverage(object):
             self.coverage[self._get_clean_id(ref)] \
                 = self._get_gene_coverage(mybam, ref)
 
+    def get_coverage_consensus(self, consensus):
+        """
+        Get the coverage from the read depth collected while building the
+        consensus, such that the bam file does not have to be read again
+        :param consensus: Consensus object the bam file was processed with
+        """
+        for ref, depth in consensus.depth.items():
+            self.coverage[self._get_clean_id(ref)] \
+                = self._get_depth_coverage(depth)
+
     def _get_clean_id(self, id):
         id = id.split(" ")[0]
         id = id.split("_")
@@ -54,3 +64,15 @@ class Coverage(object):
                 column_coverage.append(pileupcolumn.n)
         np_column_coverage = np.array(column_coverage)
         return [np.mean(np_column_coverage), np.std(np_column_coverage)]
+
+    def _get_depth_coverage(self, depth):
+        """
+
+        :param depth: numpy array with the number of reads per column
+        :return: average coverage per gene
+        """
+        np_column_coverage = depth[(depth > 0) &
+                                   (depth >= self.args.min_cons_coverage)]
+        if not np_column_coverage.size:
+            return [np.float64(np.nan), np.float64(np.nan)]
+        return [np.mean(np_column_coverage), np.std(np_column_coverage)]
@@ -17,18 +17,26 @@ class SeqCompleteness(object):
         else:
             self.ref_records = None
 
-    def get_seq_completeness(self, records):
+    def get_seq_completeness(self, records, missing=None):
+        """
+        :param records: list of mapped sequence records
+        :param missing: optional dictionary with the number of N positions of
+                        the records, as counted while building the consensus
+        """
         for record in records:
             self.seq_completeness[
-                record.id] = self._get_single_seq_completeness(record)
+                record.id] = self._get_single_seq_completeness(
+                record, num_n=missing.get(record.id) if missing else None)
 
-    def _get_single_seq_completeness(self, mapped_record, gene_code='dna'):
+    def _get_single_seq_completeness(self, mapped_record, gene_code='dna',
+                                     num_n=None):
         """
         Calculate single sequence completeness using the number of dna or aa
         positions that are not n/X divided by either
         length of sequence or full length or reference
         :param mapped_record: sequence record that was produced by mapping
         :param gene_code: dna or aa
+        :param num_n: number of N positions of mapped_record if already known
         :return: tuple with partial seq completeness computed using just the
             mapped_record itself and ref_seq_completeness computed
             using also t
@@ -46,7 +54,9 @@ class SeqCompleteness(object):
         if gene_code == 'dna':
             ref_seq_len = len(ref_seq)
             map_seq_len = len(map_ref_seq)
-            non_n_len = len(map_ref_seq) - str(map_seq).count('N')
+            if num_n is None:
+                num_n = str(map_seq).count('N')
+            non_n_len = len(map_ref_seq) - num_n
             map_seq_completeness = non_n_len / map_seq_len
             ref_seq_completeness = non_n_len / ref_seq_len
         elif gene_code == 'aa':
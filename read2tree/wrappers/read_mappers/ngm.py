@@ -136,5 +136,9 @@ def get_default_options():
         IntegerOption('-t', 1, active=True),
 
         # makes sure that unmapped reads are not saved in bam file
-        FlagOption('--no-unal', True, active=True)
+        FlagOption('--no-unal', True, active=True),
+
+        # number of best alignments reported per read, the additional ones
+        # are flagged as secondary alignments
+        IntegerOption('--topn', 1, active=False)
     ])
@@ -125,10 +125,10 @@ def _get_vector_random_reads(file, genome_len, coverage):
 
 def _get_num_reads(file):
     fastq_reader = FastxReader(file)
-    num_lines = 0
+    num_records = 0
     with fastq_reader.open_fastx() as f:
-        for l in f: num_lines += 1
-    return int(num_lines / 4)
+        for _ in fastq_reader.readfx_bytes(f): num_records += 1
+    return num_records
         
 
 def _get_read_len(file, num_records):
@@ -8,7 +8,7 @@ with open('{:s}/__init__.py'.format(name), 'rt') as fp:
             exec(line.rstrip())
 
 requirements = ['biopython', 'numpy', 'Cython', 'ete3', 'dendropy', 'lxml',
-                'tqdm', 'scipy', 'pysam', 'pyham', 'pyparsing', 'requests',
+                'tqdm', 'scipy', 'pysam', 'pyparsing', 'requests',
                 'filelock', 'natsort', 'pyyaml']
 
 # requirements = [line.strip() for line in open("requirements.txt", 'r')]
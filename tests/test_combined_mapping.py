@@ -0,0 +1,172 @@
+import unittest
+import os
+import shutil
+import tempfile
+import pysam
+from Bio import SeqIO
+from read2tree.Mapper import Mapper, COMBINED_REF_SEP
+from read2tree.main import parse_args
+from read2tree.stats.Consensus import Consensus
+from read2tree.stats.Coverage import Coverage
+from read2tree._utils import exe_name
+
+dirname = os.path.dirname(__file__)
+
+READ_LEN = 60
+
+
+class CombinedMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        records = list(SeqIO.parse(os.path.join(dirname, 'data', 'dna.fa'),
+                                   'fasta'))[:2]
+        mouse = {'OG{}'.format(i + 1): str(record.seq)
+                 for i, record in enumerate(records)}
+        # related species differing at every 10th position
+        ratno = {name: ''.join('T' if i % 10 == 5 and b != 'T' else
+                               'C' if i % 10 == 5 else b
+                               for i, b in enumerate(seq))
+                 for name, seq in mouse.items()}
+        self.refs = {'MOUSE': mouse, 'RATNO': ratno}
+        self.reads = self.get_reads()
+        argv = ['--output_path', os.path.join(self.tmp_dir, 'output'),
+                '--reads', os.path.join(dirname, 'data/reads/test.fq.gz')]
+        self.mapper = Mapper(parse_args(argv, exe_name(), ''), load=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_reads(self):
+        """
+        Single end reads and pairs of reads sampled from both species, each
+        aligned without gaps to the same position of both species
+        """
+        reads = []
+        for species, ref in sorted(self.refs.items()):
+            for og, seq in sorted(ref.items()):
+                for pos in range(0, len(seq) - READ_LEN, 23):
+                    reads.append({'name': '{}_{}_{}'.format(species, og, pos),
+                                  'species': species, 'og': og, 'pos': pos,
+                                  'seq': seq[pos:pos + READ_LEN], 'flag': 0})
+                for pos in range(0, len(seq) - 2 * READ_LEN - 20, 41):
+                    name = '{}_{}_pair{}'.format(species, og, pos)
+                    mate_pos = pos + READ_LEN + 20
+                    for flag, start, end in ((0x1 | 0x40, pos, mate_pos),
+                                             (0x1 | 0x80 | 0x10, mate_pos,
+                                              pos)):
+                        reads.append({'name': name, 'species': species,
+                                      'og': og, 'pos': start, 'mpos': end,
+                                      'seq': seq[start:start + READ_LEN],
+                                      'flag': flag})
+        return reads
+
+    def get_contig(self, species, og):
+        return '{}00001_{}'.format(species, og)
+
+    def get_score(self, read, species):
+        ref = self.refs[species][read['og']][read['pos']:
+                                             read['pos'] + READ_LEN]
+        return sum(a == b for a, b in zip(ref, read['seq']))
+
+    def get_segment(self, read, tid, mate_tid, flag, seq=True):
+        segment = pysam.AlignedSegment()
+        segment.query_name = read['name']
+        segment.reference_id = tid
+        segment.reference_start = read['pos']
+        segment.cigarstring = '{}M'.format(READ_LEN)
+        if seq:
+            segment.query_sequence = read['seq']
+            segment.query_qualities = pysam.qualitystring_to_array(
+                'I' * READ_LEN)
+        segment.flag = flag
+        segment.mapping_quality = 60
+        if 'mpos' in read and mate_tid is not None:
+            segment.next_reference_id = mate_tid
+            segment.next_reference_start = read['mpos']
+            if mate_tid == tid:
+                length = abs(read['mpos'] - read['pos']) + READ_LEN
+                segment.template_length = length \
+                    if read['pos'] < read['mpos'] else -length
+        return segment
+
+    def write_bam(self, file_name, contigs, segments):
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+                  'SQ': [{'SN': name, 'LN': len(seq)}
+                         for name, seq in contigs]}
+        bam_file = os.path.join(self.tmp_dir, file_name)
+        segments.sort(key=lambda s: (s.reference_id, s.reference_start))
+        with pysam.AlignmentFile(bam_file, 'wb', header=header) as out:
+            for segment in segments:
+                out.write(segment)
+        pysam.index(bam_file)
+        return bam_file
+
+    def get_species_bam(self, species):
+        """ mapping of all reads to a single species """
+        contigs = [(self.get_contig(species, og), seq)
+                   for og, seq in sorted(self.refs[species].items())]
+        names = [name for name, _ in contigs]
+        segments = []
+        for read in self.reads:
+            tid = names.index(self.get_contig(species, read['og']))
+            flag = read['flag'] | (0x2 if 'mpos' in read else 0) | \
+                (0x20 if read['flag'] & 0x40 else 0)
+            segment = self.get_segment(read, tid, tid, flag)
+            segment.set_tag('AS', self.get_score(read, species))
+            segments.append(segment)
+        return self.write_bam(species + '.bam', contigs, segments)
+
+    def get_combined_bam(self):
+        """
+        mapping to the combined reference reporting the best alignment as
+        primary and the other one as secondary, stored without sequence for
+        every other read. Every read has an alignment to both species, in
+        which case the split matches the mapping per species.
+        """
+        contigs = [(species + COMBINED_REF_SEP + self.get_contig(species, og),
+                    seq) for species in sorted(self.refs)
+                   for og, seq in sorted(self.refs[species].items())]
+        names = [name for name, _ in contigs]
+        segments = []
+        for i, read in enumerate(self.reads):
+            for species in self.refs:
+                tid = names.index(species + COMBINED_REF_SEP +
+                                  self.get_contig(species, read['og']))
+                if species == read['species']:
+                    flag = read['flag'] | (0x2 if 'mpos' in read else 0) | \
+                        (0x20 if read['flag'] & 0x40 else 0)
+                    segment = self.get_segment(read, tid, tid, flag)
+                else:
+                    segment = self.get_segment(
+                        read, tid, None, (read['flag'] & ~0x10) | 0x100 |
+                        (read['flag'] & 0x10), seq=i % 2 == 0)
+                segment.set_tag('AS', self.get_score(read, species))
+                segments.append(segment)
+        return self.write_bam('combined.bam', contigs, segments)
+
+    def get_statistics(self, bam_file):
+        consensus = Consensus(self.mapper.args)
+        consensus.get_consensus_bam(bam_file)
+        cov = Coverage(self.mapper.args)
+        cov.get_coverage_consensus(consensus)
+        return consensus, cov.coverage
+
+    def test_split_equals_species_mapping(self):
+        species_bams = self.mapper._split_bam_by_species(
+            self.get_combined_bam(), sorted(self.refs))
+        for species in self.refs:
+            combined, combined_cov = self.get_statistics(species_bams[species])
+            single, single_cov = self.get_statistics(
+                self.get_species_bam(species))
+            self.assertEqual(combined.consensus, single.consensus)
+            self.assertEqual(combined.missing, single.missing)
+            self.assertEqual(combined_cov, single_cov)
+            self.assertEqual(sorted(combined.depth), sorted(single.depth))
+            for name in single.depth:
+                self.assertEqual(combined.depth[name].tolist(),
+                                 single.depth[name].tolist())
+
+
+if __name__ == "__main__":
+    unittest.main()
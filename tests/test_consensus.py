@@ -0,0 +1,196 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import argparse
+import collections
+import pysam
+from read2tree.stats.Consensus import Consensus, BAM_BASES, \
+    COUNTS_CHUNK_SIZE, _ReferencePileup
+from read2tree.stats.Coverage import Coverage
+
+dirname = os.path.dirname(__file__)
+
+
+class ConsensusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_bam(self, references, reads):
+        header = {'HD': {'VN': '1.0', 'SO': 'coordinate'},
+                  'SQ': [{'SN': name, 'LN': length}
+                         for name, length in references]}
+        bam_file = os.path.join(self.tmp_dir, 'test.bam')
+        names = [name for name, _ in references]
+        segments = []
+        for read in reads:
+            segment = pysam.AlignedSegment()
+            segment.query_name = read['name']
+            segment.reference_id = names.index(read['ref'])
+            segment.reference_start = read['pos']
+            segment.cigarstring = read['cigar']
+            segment.query_sequence = read['seq']
+            segment.query_qualities = pysam.qualitystring_to_array(
+                read.get('qual', 'I' * len(read['seq'])))
+            segment.flag = read.get('flag', 0)
+            if 'mpos' in read:
+                segment.next_reference_id = segment.reference_id
+                segment.next_reference_start = read['mpos']
+                segment.template_length = read['isize']
+            segment.mapping_quality = 60
+            segments.append(segment)
+        segments.sort(key=lambda s: (s.reference_id, s.reference_start))
+        with pysam.AlignmentFile(bam_file, 'wb', header=header) as out:
+            for segment in segments:
+                out.write(segment)
+        pysam.index(bam_file)
+        return bam_file
+
+    def get_consensus(self, bam_file, min_cons_coverage=1):
+        consensus = Consensus(
+            argparse.Namespace(min_cons_coverage=min_cons_coverage))
+        consensus.get_consensus_bam(bam_file)
+        return consensus
+
+    def pileup_consensus(self, bam_file, min_cons_coverage=1):
+        """ majority rule consensus using the pysam pileup """
+        new_records = {}
+        with pysam.AlignmentFile(bam_file) as bam:
+            for ref, length in zip(bam.references, bam.lengths):
+                seq = list('N' * length)
+                for column in bam.pileup(ref, 0, 10000000):
+                    bases = [read.alignment.query_sequence[read.query_position]
+                             for read in column.pileups
+                             if not read.is_del and not read.is_refskip and
+                             column.n >= min_cons_coverage]
+                    if bases:
+                        counts = collections.Counter(bases)
+                        best = max(counts.values())
+                        seq[column.pos] = [b for b in BAM_BASES
+                                           if counts.get(b) == best][0]
+                if len(set(seq)) > 1:
+                    new_records[ref] = ''.join(seq)
+        return new_records
+
+    def test_majority(self):
+        reads = [{'name': 'r1', 'ref': 'g1', 'pos': 2, 'cigar': '4M',
+                  'seq': 'ACGT'},
+                 {'name': 'r2', 'ref': 'g1', 'pos': 3, 'cigar': '4M',
+                  'seq': 'CGAA'},
+                 {'name': 'r3', 'ref': 'g1', 'pos': 3, 'cigar': '2M1D2M',
+                  'seq': 'CTAA'}]
+        bam_file = self.write_bam([('g1', 10), ('g2', 10)], reads)
+        consensus = self.get_consensus(bam_file)
+        self.assertEqual(consensus.consensus, {'g1': 'NNACGAAANN'})
+        self.assertEqual(list(consensus.depth['g1']),
+                         [0, 0, 1, 3, 3, 3, 2, 1, 0, 0])
+        self.assertNotIn('g2', consensus.consensus)
+
+    def test_min_coverage(self):
+        reads = [{'name': 'r1', 'ref': 'g1', 'pos': 0, 'cigar': '4M',
+                  'seq': 'ACGT'},
+                 {'name': 'r2', 'ref': 'g1', 'pos': 2, 'cigar': '4M',
+                  'seq': 'GTAC'}]
+        bam_file = self.write_bam([('g1', 8)], reads)
+        consensus = self.get_consensus(bam_file, min_cons_coverage=2)
+        self.assertEqual(consensus.consensus, {'g1': 'NNGTNNNN'})
+
+    def test_filters(self):
+        reads = [{'name': 'r1', 'ref': 'g1', 'pos': 0, 'cigar': '4M',
+                  'seq': 'ACGT', 'qual': 'II+I'},
+                 {'name': 'r2', 'ref': 'g1', 'pos': 0, 'cigar': '4M',
+                  'seq': 'TTTT', 'flag': 0x400},
+                 {'name': 'r3', 'ref': 'g1', 'pos': 0, 'cigar': '4M',
+                  'seq': 'TTTT', 'flag': 0x1}]
+        bam_file = self.write_bam([('g1', 4)], reads)
+        consensus = self.get_consensus(bam_file)
+        self.assertEqual(consensus.consensus, {'g1': 'ACNT'})
+
+    def test_overlapping_mates(self):
+        # mates of one template contribute a single base to a column
+        reads = [{'name': 'p1', 'ref': 'g1', 'pos': 0, 'cigar': '4M',
+                  'seq': 'AAAA', 'flag': 0x1 | 0x2 | 0x40, 'mpos': 2,
+                  'isize': 6},
+                 {'name': 'p1', 'ref': 'g1', 'pos': 2, 'cigar': '4M',
+                  'seq': 'AAAA', 'flag': 0x1 | 0x2 | 0x80, 'mpos': 0,
+                  'isize': -6},
+                 {'name': 'r1', 'ref': 'g1', 'pos': 2, 'cigar': '2M',
+                  'seq': 'CC'}]
+        bam_file = self.write_bam([('g1', 6)], reads)
+        self.assertEqual(self.get_consensus(bam_file).consensus,
+                         self.pileup_consensus(bam_file))
+
+    def test_coverage_from_depth(self):
+        reads = [{'name': 'r{}'.format(i), 'ref': 'HUMAN1_OG1', 'pos': i,
+                  'cigar': '2M1D2M', 'seq': 'ACGT'} for i in range(5)]
+        bam_file = self.write_bam([('HUMAN1_OG1', 12), ('HUMAN2_OG2', 12)],
+                                  reads)
+        args = argparse.Namespace(min_cons_coverage=2)
+        pileup_cov = Coverage(args)
+        pileup_cov.get_coverage_bam(bam_file)
+        consensus = Consensus(args)
+        consensus.get_consensus_bam(bam_file)
+        depth_cov = Coverage(args)
+        depth_cov.get_coverage_consensus(consensus)
+        self.assertEqual(str(depth_cov.coverage), str(pileup_cov.coverage))
+        self.assertEqual(consensus.missing, {'HUMAN1_OG1': 5})
+
+    def test_live_window(self):
+        # only the reads overlapping the current position are kept
+        reads = [{'name': 'r{}'.format(i), 'ref': 'g1', 'pos': i,
+                  'cigar': '4M', 'seq': 'ACGT'[i % 4:] + 'ACGT'[:i % 4]}
+                 for i in range(2 * COUNTS_CHUNK_SIZE)]
+        bam_file = self.write_bam([('g1', 2 * COUNTS_CHUNK_SIZE + 3)], reads)
+        ref = _ReferencePileup(0, 'g1', 2 * COUNTS_CHUNK_SIZE + 3)
+        max_reads = 0
+        with pysam.AlignmentFile(bam_file) as bam:
+            for read in bam.fetch():
+                ref.push(read)
+                max_reads = max(max_reads, len(ref._live))
+                self.assertLess(len(ref._finished), COUNTS_CHUNK_SIZE)
+        self.assertLess(max_reads, 10)
+        counts, depth = ref.get_counts()
+        self.assertEqual(int(counts.sum()), 4 * 2 * COUNTS_CHUNK_SIZE)
+        self.assertEqual(int(depth.max()), 4)
+
+    def test_random_against_pileup(self):
+        rng = random.Random(42)
+        references = [('g{}'.format(i), rng.randint(200, 300))
+                      for i in range(3)]
+        reads = []
+        for name, length in references:
+            for i in range(300):
+                ops = ['{}{}'.format(rng.randint(10, 40),
+                                     rng.choice('M=X'))]
+                for _ in range(rng.randint(0, 2)):
+                    ops.append('{}{}'.format(rng.randint(1, 4),
+                                             rng.choice('IDN')))
+                    ops.append('{}M'.format(rng.randint(10, 40)))
+                ref_len = sum(int(op[:-1]) for op in ops if op[-1] in 'M=XDN')
+                seq_len = sum(int(op[:-1]) for op in ops if op[-1] in 'M=XI')
+                pos = rng.randint(0, length - ref_len)
+                read = {'name': '{}_{}'.format(name, i // 2), 'ref': name,
+                        'pos': pos, 'cigar': ''.join(ops),
+                        'seq': ''.join(rng.choice('ACGTN')
+                                       for _ in range(seq_len)),
+                        'qual': ''.join(chr(33 + rng.randint(0, 40))
+                                        for _ in range(seq_len))}
+                if rng.random() < 0.7:
+                    read['flag'] = 0x1 | 0x2
+                    read['mpos'] = max(0, pos + rng.randint(-30, 30))
+                    read['isize'] = rng.randint(-200, 200)
+                reads.append(read)
+        bam_file = self.write_bam(references, reads)
+        for min_cons_coverage in (1, 5):
+            self.assertEqual(
+                self.get_consensus(bam_file, min_cons_coverage).consensus,
+                self.pileup_consensus(bam_file, min_cons_coverage))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+import os
+import gzip
+import shutil
+import tempfile
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from read2tree.OGSet import OGSet
+from read2tree.main import parse_args
+from read2tree._utils import exe_name
+
+dirname = os.path.dirname(__file__)
+
+
+class DnaReferenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.fasta = '>HUMAN1 desc\nATGACG\nTGA\n>MOUSE2\nATGCCCTAA\n'
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_og_set(self, dna_reference):
+        argv = ['--output_path', os.path.join(self.tmp_dir, 'output'),
+                '--reads', 'data/reads/test.fq.gz',
+                '--dna_reference', dna_reference]
+        return OGSet(parse_args(argv, exe_name(), ''))
+
+    def get_dna(self, dna_reference):
+        og_set = self.get_og_set(dna_reference)
+        db, source = og_set._load_dna_db()
+        self.assertEqual(source, 'fa')
+        record = og_set._get_dna_from_fasta(
+            SeqRecord(Seq('MT'), id='HUMAN1_OG1'), db)
+        db.close()
+        return str(record.seq)
+
+    def test_fasta(self):
+        dna_reference = os.path.join(self.tmp_dir, 'cdna.fa')
+        with open(dna_reference, 'w') as f:
+            f.write(self.fasta)
+        self.assertEqual(self.get_dna(dna_reference), 'ATGACG')
+        self.assertTrue(os.path.exists(dna_reference + '.fai'))
+        # the index is reused
+        mtime = os.path.getmtime(dna_reference + '.fai')
+        self.assertEqual(self.get_dna(dna_reference), 'ATGACG')
+        self.assertEqual(os.path.getmtime(dna_reference + '.fai'), mtime)
+
+    def test_gzip(self):
+        dna_reference = os.path.join(self.tmp_dir, 'cdna.fa.gz')
+        with gzip.open(dna_reference, 'wt') as f:
+            f.write(self.fasta)
+        self.assertEqual(self.get_dna(dna_reference), 'ATGACG')
+        store = os.path.join(self.tmp_dir, 'cdna.fa.bgz')
+        self.assertTrue(os.path.exists(store))
+        self.assertTrue(os.path.exists(store + '.gzi'))
+
+
+if __name__ == "__main__":
+    unittest.main()
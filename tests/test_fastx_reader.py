@@ -0,0 +1,101 @@
+import unittest
+import os
+import gzip
+import shutil
+import tempfile
+from read2tree import FastxReader as fastx_reader_module
+from read2tree.FastxReader import FastxReader, open_gzip_writer, \
+    _ProcessWriter
+
+dirname = os.path.dirname(__file__)
+
+
+class FastxReaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.block_size = fastx_reader_module.BLOCK_SIZE
+        self.decompressors = fastx_reader_module.DECOMPRESSORS
+
+    def tearDown(self):
+        fastx_reader_module.BLOCK_SIZE = self.block_size
+        fastx_reader_module.DECOMPRESSORS = self.decompressors
+        shutil.rmtree(self.tmp_dir)
+
+    def write(self, name, content):
+        file = os.path.join(self.tmp_dir, name)
+        with open(file, 'w', newline='') as f:
+            f.write(content)
+        return file
+
+    def read(self, file):
+        fastx_reader = FastxReader(file)
+        with fastx_reader.open_fastx() as f:
+            return list(fastx_reader.readfx(f))
+
+    def test_wrapped_fasta(self):
+        file = self.write('test.fa', '>s1 first\nACGT\nAC\n>s2\nGG\n>s3\n\n'
+                                     '>s4\nTT\nTT\n')
+        expected = [('>s1 first', 'ACGTAC', None), ('>s2', 'GG', None),
+                    ('>s3', '', None), ('>s4', 'TTTT', None)]
+        for block_size in (1 << 20, 3):
+            fastx_reader_module.BLOCK_SIZE = block_size
+            self.assertEqual(self.read(file), expected)
+
+    def test_fastq(self):
+        # quality lines may start with @ and records can span lines
+        file = self.write('test.fq', '@r1\nACGT\n+\n@III\n@r2\nAC\nGT\n+r2\n'
+                                     'II\nII\r\n@r3\nAA\n+\nI')
+        expected = [('@r1', 'ACGT', '@III'), ('@r2', 'ACGT', 'IIII'),
+                    ('@r3', 'AA', None)]
+        for block_size in (1 << 20, 5):
+            fastx_reader_module.BLOCK_SIZE = block_size
+            self.assertEqual(self.read(file), expected)
+
+    def test_gzip(self):
+        file = os.path.join(self.tmp_dir, 'test.fq.gz')
+        with gzip.open(file, 'wt') as f:
+            f.write('@r1 1\nACGT\n+\nIIII\n@r2 2\nAC\n+\nII\n')
+        fastx_reader = FastxReader(file)
+        with fastx_reader.open_fastx() as f:
+            self.assertEqual(list(fastx_reader.readfq_id(f)), ['@r1', '@r2'])
+        with fastx_reader.open_fastx() as f:
+            self.assertEqual(list(fastx_reader.readfx_bytes(f)),
+                             [(b'@r1 1', b'ACGT', b'IIII'),
+                              (b'@r2 2', b'AC', b'II')])
+
+    def test_gzip_process(self):
+        # the gzip command line accepts the same arguments as pigz / igzip
+        fastx_reader_module.DECOMPRESSORS = ('gzip',)
+        file = os.path.join(self.tmp_dir, 'test.fq.gz')
+        with open_gzip_writer(file) as f:
+            f.write('@r1 1\nACGT\n+\nIIII\n')
+        self.assertEqual(self.read(file), [('@r1 1', 'ACGT', 'IIII')])
+        writer = _ProcessWriter(['gzip', '-c'], file)
+        writer.write(b'@r2\nAC\n+\nII\n')
+        writer.close()
+        self.assertEqual(self.read(file), [('@r2', 'AC', 'II')])
+        broken = self.write('broken.fq.gz', 'not compressed')
+        with self.assertRaises(OSError):
+            self.read(broken)
+
+    def test_lanes(self):
+        # the last record of a lane does not need a line break
+        lane_1 = os.path.join(self.tmp_dir, 'lane_1.fq.gz')
+        with gzip.open(lane_1, 'wt') as f:
+            f.write('@r1/1\nACGT\n+\nIIII\n@r1/2\nTT\n+\nII')
+        lane_2 = self.write('lane_2.fq', '@r2/1\nAC\n+\nII\n'
+                                         '@r2/2\nGG\n+\nII\n')
+        lanes = '{},{}'.format(lane_1, lane_2)
+        self.assertEqual([name for name, _, _ in self.read(lanes)],
+                         ['@r1/1', '@r1/2', '@r2/1', '@r2/2'])
+        for mate in (1, 2):
+            fastx_reader = FastxReader(lanes, mate=mate)
+            with fastx_reader.open_fastx() as f:
+                self.assertEqual(list(fastx_reader.readfq_id(f)),
+                                 ['@r1/{}'.format(mate),
+                                  '@r2/{}'.format(mate)])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+import os
+import glob
+import shutil
+import tempfile
+from filelock import FileLock
+from read2tree.IndexCache import IndexCache, COMPLETE_MARKER
+
+dirname = os.path.dirname(__file__)
+
+
+def build_index(ref_file):
+    open(ref_file + '-enc.2.ngm', 'w').close()
+    return True
+
+
+class IndexCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache = IndexCache(os.path.join(self.tmp_dir, 'cache'),
+                                max_entries=1)
+        self.refs = []
+        for species in ['HUMAN', 'MOUSE']:
+            ref_file = os.path.join(self.tmp_dir, species + '_OGs.fa')
+            with open(ref_file, 'w') as f:
+                f.write('>{}1_OG1\nATGACG\n'.format(species))
+            self.refs.append(ref_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_lock_released_after_build(self):
+        with self.cache.reference(self.refs[0], 'ngm',
+                                  build_index=build_index) as cached_ref:
+            self.assertTrue(os.path.exists(cached_ref + '-enc.2.ngm'))
+            entry = os.path.dirname(cached_ref)
+            self.assertTrue(os.path.exists(
+                os.path.join(entry, COMPLETE_MARKER)))
+            # other jobs using the reference do not wait for this mapping
+            with FileLock(entry + '.lock', timeout=0):
+                pass
+
+    def test_entry_in_use_is_not_evicted(self):
+        with self.cache.reference(self.refs[0], 'ngm',
+                                  build_index=build_index):
+            pass
+        # the cached entry is re-used while another one is built
+        with self.cache.reference(self.refs[0], 'ngm',
+                                  build_index=build_index) as human_ref:
+            with self.cache.reference(self.refs[1], 'ngm',
+                                      build_index=build_index) as mouse_ref:
+                pass
+            self.assertTrue(os.path.exists(human_ref))
+            self.assertTrue(os.path.exists(mouse_ref))
+        # once released the entries exceeding the maximum are evicted
+        self.assertEqual(len(glob.glob(os.path.join(
+            self.cache.cache_dir, '*', COMPLETE_MARKER))), 1)
+
+    def test_built_by_mapping(self):
+        with self.cache.reference(self.refs[0], 'ngm') as cached_ref:
+            entry = os.path.dirname(cached_ref)
+            self.assertFalse(os.path.exists(
+                os.path.join(entry, COMPLETE_MARKER)))
+        self.assertTrue(os.path.exists(os.path.join(entry, COMPLETE_MARKER)))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,113 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import argparse
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from read2tree.KmerFilter import KmerFilter, canonical_kmers, \
+    encode_sequences
+from read2tree.FastxReader import FastxReader
+from read2tree.Reads import Reads
+from read2tree.main import parse_args
+from read2tree._utils import exe_name
+
+dirname = os.path.dirname(__file__)
+
+
+class KmerFilterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = random.Random(1)
+        self.ref_seq = ''.join(rng.choice('ACGT') for _ in range(300))
+        self.other_seq = ''.join(rng.choice('ACGT') for _ in range(300))
+        args = argparse.Namespace(kmer_size=11, min_shared_kmers=2,
+                                  species_name='TEST')
+        self.kmer_filter = KmerFilter(
+            args, [SeqRecord(Seq(self.ref_seq), id='HUMAN1')])
+
+    def get_read_container(self, reads, *options):
+        argv = ['--output_path', os.path.join(self.tmp_dir, 'output'),
+                '--reads'] + (reads if isinstance(reads, list) else [reads])
+        return Reads(parse_args(argv + list(options), exe_name(), ''),
+                     load=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_fastq(self, name, reads):
+        file = os.path.join(self.tmp_dir, name)
+        with open(file, 'w') as f:
+            for read_id, seq in reads:
+                f.write('@{}\n{}\n+\n{}\n'.format(read_id, seq, 'I' * len(seq)))
+        return file
+
+    def read_ids(self, file):
+        reader = FastxReader(file)
+        with reader.open_fastx() as f:
+            return [name[1:] for name, _, _ in reader.readfx(f)]
+
+    def reverse_complement(self, seq):
+        return str(Seq(seq).reverse_complement())
+
+    def test_canonical_kmers(self):
+        codes, starts = encode_sequences(['ACGTA', 'TACGN'])
+        self.assertEqual(list(starts), [0, 6])
+        kmers, valid = canonical_kmers(codes, 3)
+        # ACG and its reverse complement CGT share the canonical k-mer
+        self.assertEqual(kmers[0], kmers[1])
+        self.assertEqual(list(valid), [True, True, True, False, False,
+                                       False, True, True, False, False])
+
+    def test_count_shared_kmers(self):
+        seqs = [self.ref_seq[50:150],
+                self.reverse_complement(self.ref_seq[100:200]),
+                self.other_seq[:100],
+                self.ref_seq[:12] + 'N' + self.other_seq[:20],
+                '']
+        self.assertEqual(list(self.kmer_filter.count_shared_kmers(seqs)),
+                         [90, 90, 0, 2, 0])
+
+    def test_filter_single(self):
+        reads = self.write_fastq('reads.fq', [
+            ('r1', self.ref_seq[:100]), ('r2', self.other_seq[:100]),
+            ('r3', self.reverse_complement(self.ref_seq[150:250]))])
+        read_container = self.get_read_container(reads)
+        filtered = self.kmer_filter.filter_reads(reads, read_container)
+        self.assertEqual(self.read_ids(filtered), ['r1', 'r3'])
+        read_container.cleanup()
+        self.assertFalse(os.path.exists(filtered))
+
+    def test_filter_paired(self):
+        left = self.write_fastq('reads_1.fq', [
+            ('p1/1', self.ref_seq[:100]), ('p2/1', self.other_seq[:100]),
+            ('p3/1', self.other_seq[100:200])])
+        right = self.write_fastq('reads_2.fq', [
+            ('p1/2', self.other_seq[:100]), ('p2/2', self.other_seq[100:200]),
+            ('p3/2', self.reverse_complement(self.ref_seq[200:300]))])
+        read_container = self.get_read_container([left, right])
+        filtered = self.kmer_filter.filter_reads([left, right],
+                                                 read_container)
+        self.assertEqual(self.read_ids(filtered[0]), ['p1/1', 'p3/1'])
+        self.assertEqual(self.read_ids(filtered[1]), ['p1/2', 'p3/2'])
+        read_container.cleanup()
+        for file in filtered:
+            self.assertFalse(os.path.exists(file))
+
+    def test_filter_compressed(self):
+        reads = self.write_fastq('reads.fq', [
+            ('r1', self.ref_seq[:100]), ('r2', self.other_seq[:100])])
+        read_container = self.get_read_container(reads, '--compress_tmp_reads')
+        filtered = self.kmer_filter.filter_reads(reads, read_container)
+        self.assertTrue(filtered.endswith('.gz'))
+        with open(filtered, 'rb') as f:
+            self.assertEqual(f.read(2), b'\x1f\x8b')
+        self.assertEqual(self.read_ids(filtered), ['r1'])
+        read_container.cleanup()
+        self.assertFalse(os.path.exists(filtered))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,151 @@
+import unittest
+import os
+import stat
+import time
+import shutil
+import tempfile
+from unittest import mock
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from read2tree.Mapper import Mapper
+from read2tree.MappingManifest import MappingManifest
+from read2tree.ReferenceSet import Reference
+from read2tree.Reads import Reads
+from read2tree.main import parse_args
+from read2tree._utils import exe_name
+
+dirname = os.path.dirname(__file__)
+
+SPECIES = ['HUMAN', 'MOUSE', 'RATNO']
+
+
+def map_species_stub(self, species, ref, reads, tmp_folder):
+    """
+    Per species mapping that finishes in reverse order of submission and
+    reports the threads and process it was run with
+    """
+    time.sleep(0.4 * (len(SPECIES) - SPECIES.index(species)))
+    with open(os.path.join(self.args.output_path,
+                           '04_mapping_' + self._species_name,
+                           species + '_OGs_cov.txt'), 'w') as f:
+        f.write('#species,og,gene_id,coverage,std\n')
+    records = [SeqRecord(Seq(str(record.seq)), id=record.id)
+               for record in ref[species].dna]
+    cov = {species + '00001_OG1': [self._threads_per_job, os.getpid()]}
+    sc = {species + '00001_OG1': [1.0]}
+    return species, records, cov, sc
+
+
+def call_wrapper_stub(self, ref_file_handle, reads, tmp_output_folder,
+                      references=None):
+    """
+    Read mapper opening its read input twice, as ngm and ngmlr do, which
+    records the reads it got
+    """
+    species = os.path.basename(ref_file_handle).split('_')[0]
+    contents = []
+    for _ in range(2):
+        assert stat.S_ISREG(os.stat(reads).st_mode)
+        with open(reads) as f:
+            contents.append(f.read())
+    assert contents[0] == contents[1]
+    with open(os.path.join(self.args.output_path, species + '_reads.txt'),
+              'w') as f:
+        f.write(reads + '\n' + contents[0])
+    return None
+
+
+class MappingJobsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.tmp_dir, 'output')
+        self.ref = {}
+        for i, species in enumerate(SPECIES):
+            self.ref[species] = Reference()
+            self.ref[species].dna = [SeqRecord(Seq('ACGT' * (i + 1)),
+                                               id=species + '00001_OG1')]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def map_reads(self, *options):
+        argv = ['--output_path', self.output_path,
+                '--reads', os.path.join(dirname, 'data/reads/test.fq.gz')]
+        mapper = Mapper(parse_args(argv + list(options), exe_name(), ''),
+                        load=False)
+        with mock.patch.object(Mapper, '_map_species_worker',
+                               map_species_stub):
+            mapped_reads = mapper._map_reads_to_references(self.ref)
+        return mapper, mapped_reads
+
+    def test_concurrent_jobs(self):
+        mapper, mapped_reads = self.map_reads('--threads', '7',
+                                              '--mapping_jobs', '3')
+        self.assertEqual(sorted(mapped_reads), SPECIES)
+        for species in SPECIES:
+            self.assertEqual([str(record.seq) for record
+                              in mapped_reads[species].dna],
+                             [str(record.seq) for record
+                              in self.ref[species].dna])
+            self.assertEqual(mapper.all_sc[species + '00001_OG1'], [1.0])
+        threads, pids = zip(*mapper.all_cov.values())
+        self.assertEqual(set(threads), {2})
+        self.assertEqual(len(set(pids)), len(SPECIES))
+        self.assertNotIn(os.getpid(), pids)
+        # the species are recorded in the manifest in order of completion
+        manifest = MappingManifest(os.path.join(self.output_path,
+                                                '04_mapping_test'))
+        with open(manifest.manifest_file) as f:
+            self.assertEqual([line.split('\t')[0].rstrip('\n')
+                              for line in f], SPECIES[::-1])
+        self.assertEqual(manifest.completed(), set(SPECIES))
+
+    def test_threads_of_running_jobs(self):
+        # only as many jobs run as there are species to map
+        mapper, mapped_reads = self.map_reads('--threads', '9',
+                                              '--mapping_jobs', '5')
+        self.assertEqual(sorted(mapped_reads), SPECIES)
+        threads, _ = zip(*mapper.all_cov.values())
+        self.assertEqual(set(threads), {3})
+
+    def test_stream_reads(self):
+        reference_path = os.path.join(self.output_path, '02_ref_dna')
+        os.makedirs(reference_path)
+        for species in SPECIES:
+            with open(os.path.join(reference_path, species + '_OGs.fa'),
+                      'w') as f:
+                f.write('>{}00001_OG1\nACGT\n'.format(species))
+        argv = ['--output_path', self.output_path,
+                '--reads', os.path.join(dirname, 'data/reads/test.fq.gz'),
+                '--split_reads', '--split_overlap', '50', '--split_len',
+                '400', '--threads', '3', '--mapping_jobs', '3']
+        expected = Reads(parse_args(argv, exe_name(), ''))
+        with open(expected.reads) as f:
+            expected_reads = f.read()
+        expected.cleanup()
+        mapper = Mapper(parse_args(argv + ['--stream_reads'], exe_name(),
+                                   ''), load=False)
+        with mock.patch.object(Mapper, '_call_wrapper', call_wrapper_stub):
+            mapper._map_reads_to_references(self.ref)
+        read_files = set()
+        for species in SPECIES:
+            with open(os.path.join(self.output_path,
+                                   species + '_reads.txt')) as f:
+                read_file, reads = f.read().split('\n', 1)
+            read_files.add(read_file)
+            self.assertEqual(reads, expected_reads)
+        # the reads are written once for all the jobs and removed after
+        self.assertEqual(len(read_files), 1)
+        self.assertFalse(os.path.exists(read_files.pop()))
+
+    def test_sequential_jobs(self):
+        mapper, mapped_reads = self.map_reads('--threads', '4')
+        self.assertEqual(sorted(mapped_reads), SPECIES)
+        threads, pids = zip(*mapper.all_cov.values())
+        self.assertEqual(set(threads), {4})
+        self.assertEqual(set(pids), {os.getpid()})
+
+
+if __name__ == "__main__":
+    unittest.main()
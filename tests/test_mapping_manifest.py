@@ -0,0 +1,52 @@
+import unittest
+import os
+import shutil
+import tempfile
+from read2tree.MappingManifest import MappingManifest, MANIFEST_FILE
+
+dirname = os.path.dirname(__file__)
+
+
+class MappingManifestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        for species in ('HUMAN', 'MOUSE'):
+            for end in ('_OGs_consensus.fa', '_OGs_cov.txt'):
+                with open(os.path.join(self.tmp_dir, species + end), 'w') as f:
+                    f.write(species + end)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_files(self, species):
+        return [species + '_OGs_consensus.fa', species + '_OGs_cov.txt',
+                species + '_OGs_sc.txt']
+
+    def test_completed(self):
+        manifest = MappingManifest(self.tmp_dir)
+        self.assertEqual(manifest.completed(), set())
+        manifest.record('HUMAN', self.get_files('HUMAN'))
+        manifest.record('MOUSE', self.get_files('MOUSE'))
+        self.assertEqual(MappingManifest(self.tmp_dir).completed(),
+                         {'HUMAN', 'MOUSE'})
+
+    def test_changed_files(self):
+        manifest = MappingManifest(self.tmp_dir)
+        manifest.record('HUMAN', self.get_files('HUMAN'))
+        manifest.record('MOUSE', self.get_files('MOUSE'))
+        with open(os.path.join(self.tmp_dir, 'HUMAN_OGs_cov.txt'), 'a') as f:
+            f.write('changed')
+        os.remove(os.path.join(self.tmp_dir, 'MOUSE_OGs_consensus.fa'))
+        self.assertEqual(manifest.completed(), set())
+
+    def test_interrupted_write(self):
+        manifest = MappingManifest(self.tmp_dir)
+        manifest.record('HUMAN', self.get_files('HUMAN'))
+        with open(os.path.join(self.tmp_dir, MANIFEST_FILE), 'a') as f:
+            f.write('MOUSE\tMOUSE_OGs_consensus.fa:0123')
+        self.assertEqual(manifest.completed(), {'HUMAN'})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,8 @@
 import os
 import unittest
+from types import SimpleNamespace
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
 from read2tree import OGSet
 
 API_URL = 'http://omabrowser.org/api'
@@ -49,5 +52,24 @@ class OGSetTest(unittest.TestCase):
         raise NotImplementedError
 
 
+class ProtIdIndexTest(unittest.TestCase):
+
+    def test_get_aa_records(self):
+        args = SimpleNamespace(reads=None, species_name='TEST',
+                               remove_species_mapping=None,
+                               remove_species_ogs=None)
+        og_set = OGSet.OGSet(args)
+        og_set.oma = SimpleNamespace(mode='standalone')
+        og_set._prot_id_index = {'OG1': og_set._get_prot_id_index(
+            ['HUMAN1', 'MOUSE3', 'HUMAN2', 'YEA3'])}
+        records = [SeqRecord(Seq('MKX'), id='x', description='x [MOUSE]'),
+                   SeqRecord(Seq('MK'), id='y', description='y [HUMAN]'),
+                   SeqRecord(Seq('MK'), id='z', description='z [YEA]')]
+        records = og_set._get_aa_records('OG1', records)
+        self.assertEqual([r.id for r in records],
+                         ['MOUSE3_OG1', 'HUMAN1_OG1', 'YEA3_OG1'])
+        self.assertEqual(str(records[0].seq), 'MK')
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,93 @@
+import unittest
+import os
+import shutil
+import argparse
+import tempfile
+from collections import Counter
+from read2tree.parser import OMAOutputParser, estimate_min_species
+
+dirname = os.path.dirname(__file__)
+
+OGS = {'OG1': ['HUMAN1 | OMA1 | [Homo sapiens]', 'MOUSE1 | OMA1 | [Mus musculus]',
+               'RATNO1 | OMA1 | [Rattus norvegicus]'],
+       'OG2': ['HUMAN2 | OMA2 | [Homo sapiens]', 'MOUSE2 | OMA2 | [Mus musculus]'],
+       'OG3': ['HUMAN3 | OMA3 | [Homo sapiens]', 'PANTR3 | OMA3 | [Pan troglodytes]',
+               'MOUSE3 | OMA3 | [Mus musculus]']}
+
+
+class OMAOutputParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        og_path = os.path.join(self.tmp_dir, 'Output', 'OrthologousGroupsFasta')
+        os.makedirs(og_path)
+        for name, headers in OGS.items():
+            with open(os.path.join(og_path, name + '.fa'), 'w') as f:
+                for header in headers:
+                    f.write('>{}\nMKV\nLLA\n'.format(header))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def get_parser(self, min_species, ignore_species=None, threads=1,
+                   target_ogs=1000):
+        args = argparse.Namespace(standalone_path=self.tmp_dir,
+                                  min_species=min_species,
+                                  ignore_species=ignore_species,
+                                  threads=threads,
+                                  output_path=os.path.join(self.tmp_dir,
+                                                           'output'),
+                                  target_ogs=target_ogs)
+        return OMAOutputParser(args)
+
+    def test_min_species(self):
+        for threads in [1, 2]:
+            oma_output = self.get_parser(3, threads=threads)
+            self.assertEqual(sorted(oma_output.ogs), ['OG1', 'OG3'])
+            self.assertEqual(oma_output.num_selected_ogs, 2)
+            self.assertEqual(oma_output.num_species, 4)
+            self.assertEqual([r.id for r in oma_output.ogs['OG1']],
+                             ['HUMAN1_OG1', 'MOUSE1_OG1', 'RATNO1_OG1'])
+            self.assertEqual(str(oma_output.ogs['OG1'][0].seq), 'MKVLLA')
+
+    def test_ignore_species(self):
+        oma_output = self.get_parser(2, ignore_species='Mus musculus',
+                                     threads=2)
+        self.assertEqual(sorted(oma_output.ogs), ['OG1', 'OG3'])
+        self.assertEqual(oma_output.num_species, 3)
+        self.assertEqual([r.id for r in oma_output.ogs['OG3']],
+                         ['HUMAN3_OG3', 'PANTR3_OG3'])
+
+    def test_estimate_min_species(self):
+        histogram = Counter({2: 1130, 3: 564, 4: 623, 5: 802, 6: 1346,
+                             7: 963})
+        self.assertEqual(estimate_min_species(histogram, 1000), 7)
+        self.assertEqual(estimate_min_species(histogram, 2000), 6)
+        self.assertEqual(estimate_min_species(histogram, 10000), 2)
+        self.assertEqual(estimate_min_species(Counter(), 1000), 0)
+
+    def test_estimated_min_species(self):
+        oma_output = self.get_parser(None, target_ogs=1)
+        self.assertEqual(oma_output.min_species, 3)
+        self.assertEqual(sorted(oma_output.ogs), ['OG1', 'OG3'])
+        histogram_file = os.path.join(self.tmp_dir, 'output',
+                                      'og_species_histogram.json')
+        self.assertTrue(os.path.exists(histogram_file))
+        # the stored histogram is reused as long as the OGs are unchanged
+        with open(histogram_file) as f:
+            content = f.read()
+        with open(histogram_file, 'w') as f:
+            f.write(content.replace('"species": [', '"species": ["CACHE", '))
+        oma_output = self.get_parser(None, target_ogs=3)
+        self.assertEqual(oma_output.min_species, 2)
+        self.assertEqual(oma_output.num_species, 5)
+        with open(os.path.join(self.tmp_dir, 'Output',
+                               'OrthologousGroupsFasta', 'OG2.fa'), 'a') as f:
+            f.write('>RATNO2 | OMA2 | [Rattus norvegicus]\nMKV\n')
+        oma_output = self.get_parser(None, target_ogs=3)
+        self.assertEqual(oma_output.min_species, 3)
+        self.assertEqual(oma_output.num_species, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+import os
+import json
+import shutil
+import tempfile
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from read2tree import OMARestClient as rest_client_module
+from read2tree.OMARestClient import OMARestClient, get_protein_id
+
+dirname = os.path.dirname(__file__)
+
+CDNA = {'HUMAN{}'.format(i): 'ATG' * i for i in range(1, 251)}
+
+
+class BulkRetrieveHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/api/version/':
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_json({'oma_version': self.server.release})
+
+    def send_json(self, reply):
+        body = json.dumps(reply).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.failures > 0
+            server.failures -= 1
+        ids = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))['ids']
+        if fail or self.path != '/api/protein/bulk_retrieve/' or \
+                len(ids) > rest_client_module.BULK_SIZE:
+            self.send_response(503 if fail else 400)
+            self.end_headers()
+            return
+        self.send_json([{'query_id': x,
+                         'target': {'omaid': x, 'cdna': CDNA[x]}
+                         if x in CDNA else None} for x in ids
+                        if x not in server.dropped])
+
+    def log_message(self, *args):
+        pass
+
+
+class OMARestClientTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0),
+                                          BulkRetrieveHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.failures = 0
+        self.server.release = 'All.Jul2023'
+        self.server.dropped = set()
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.api_url = 'http://127.0.0.1:{}/api'.format(
+            self.server.server_address[1])
+        self.args = argparse.Namespace(
+            species_name='TEST',
+            rest_cache=os.path.join(self.tmp_dir, 'cache.sqlite'))
+        self.backoff_factor = rest_client_module.BACKOFF_FACTOR
+        rest_client_module.BACKOFF_FACTOR = 0
+        self.negative_cache_ttl = rest_client_module.NEGATIVE_CACHE_TTL
+
+    def tearDown(self):
+        rest_client_module.BACKOFF_FACTOR = self.backoff_factor
+        rest_client_module.NEGATIVE_CACHE_TTL = self.negative_cache_ttl
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_get_protein_id(self):
+        self.assertEqual(get_protein_id('HUMAN12.1_OG1'), 'HUMAN12')
+
+    def test_bulk_and_cache(self):
+        client = OMARestClient(self.args, api_url=self.api_url)
+        ids = sorted(CDNA) + ['MOUSE1']
+        cdna = client.get_cdna(ids)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(cdna['HUMAN7'], ('HUMAN7', 'ATG' * 7))
+        self.assertNotIn('MOUSE1', cdna)
+        client.close()
+        # the replies, including the unknown IDs, are cached across runs
+        client = OMARestClient(self.args, api_url=self.api_url)
+        self.assertEqual(client.get_cdna(ids), cdna)
+        self.assertEqual(self.server.requests, 3)
+        client.close()
+
+    def test_release(self):
+        client = OMARestClient(self.args, api_url=self.api_url)
+        client.get_cdna(['HUMAN1'])
+        client.close()
+        self.assertEqual(self.server.requests, 1)
+        # the replies of another release are not reused
+        self.server.release = 'All.Jul2024'
+        client = OMARestClient(self.args, api_url=self.api_url)
+        client.get_cdna(['HUMAN1'])
+        client.close()
+        self.assertEqual(self.server.requests, 2)
+
+    def test_unknown_ids(self):
+        self.server.dropped = {'HUMAN2'}
+        client = OMARestClient(self.args, api_url=self.api_url)
+        ids = ['HUMAN1', 'HUMAN2', 'MOUSE1']
+        self.assertEqual(list(client.get_cdna(ids)), ['HUMAN1'])
+        self.assertEqual(self.server.requests, 1)
+        # IDs missing from a partial reply are queried again, the unknown
+        # ones only once they expired
+        self.server.dropped = set()
+        self.assertEqual(sorted(client.get_cdna(ids)), ['HUMAN1', 'HUMAN2'])
+        self.assertEqual(self.server.requests, 2)
+        self.assertEqual(sorted(client.get_cdna(ids)), ['HUMAN1', 'HUMAN2'])
+        self.assertEqual(self.server.requests, 2)
+        rest_client_module.NEGATIVE_CACHE_TTL = -1
+        client.get_cdna(ids)
+        self.assertEqual(self.server.requests, 3)
+        client.close()
+
+    def test_retry(self):
+        self.server.failures = 2
+        client = OMARestClient(self.args, api_url=self.api_url)
+        self.assertEqual(client.get_cdna(['HUMAN1']),
+                         {'HUMAN1': ('HUMAN1', 'ATG')})
+        self.assertEqual(self.server.requests, 3)
+        client.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import os
+import shutil
+import tempfile
+from read2tree.parser import OrthoXMLParser
+
+dirname = os.path.dirname(__file__)
+
+ORTHOXML = '''<?xml version="1.0" encoding="UTF-8"?>
+<orthoXML xmlns="http://orthoXML.org/2011/" version="0.3" origin="OMA">
+  <species name="HUMAN" NCBITaxId="9606">
+    <database name="OMA" version="1">
+      <genes>
+        <gene id="1" protId="HUMAN1 | HUMAN1" geneId="HUMAN1"/>
+        <gene id="2" protId="HUMAN2 | HUMAN2" geneId="HUMAN2"/>
+      </genes>
+    </database>
+  </species>
+  <species name="MOUSE" NCBITaxId="10090">
+    <database name="OMA" version="1">
+      <genes>
+        <gene id="3" protId="MOUSE3 | MOUSE3" geneId="MOUSE3"/>
+        <gene id="4" protId="MOUSE4" geneId="MOUSE4"/>
+      </genes>
+    </database>
+  </species>
+  <groups>
+    <orthologGroup id="1">
+      <geneRef id="1"/>
+      <paralogGroup>
+        <geneRef id="3"/>
+        <geneRef id="4"/>
+      </paralogGroup>
+    </orthologGroup>
+    <orthologGroup id="2">
+      <geneRef id="2"/>
+      <geneRef id="4"/>
+    </orthologGroup>
+  </groups>
+</orthoXML>
+'''
+
+
+class OrthoXMLParserTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.orthoxml = os.path.join(self.tmp_dir,
+                                     'OrthologousGroups.orthoxml')
+        with open(self.orthoxml, 'w') as f:
+            f.write(ORTHOXML)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_all_groups(self):
+        orthoxml = OrthoXMLParser(self.orthoxml)
+        self.assertEqual(orthoxml.get_prot_ids('1'),
+                         ['HUMAN1', 'MOUSE3', 'MOUSE4'])
+        self.assertEqual(orthoxml.get_prot_ids('2'), ['HUMAN2', 'MOUSE4'])
+
+    def test_selected_groups(self):
+        orthoxml = OrthoXMLParser(self.orthoxml, og_ids=['2'])
+        self.assertEqual(list(orthoxml.groups), ['2'])
+        self.assertEqual(orthoxml.get_prot_ids('2'), ['HUMAN2', 'MOUSE4'])
+        # only the genes of the selected groups are kept
+        self.assertEqual(sorted(orthoxml.prot_ids), ['2', '4'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+import os
+import gzip
+import json
+import stat
+import shutil
+import tempfile
+from types import SimpleNamespace
+from unittest import mock
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from read2tree import main as read2tree_main
+from read2tree.main import parse_args, get_mapper, map_parallel
+from read2tree.FastxReader import FastxReader
+from read2tree.ReferenceSet import Reference
+from read2tree.Reads import Reads
+from read2tree._utils import exe_name
+
+dirname = os.path.dirname(__file__)
+
+
+class SingleMappingStub(object):
+    """
+    Mapper run by the --parallel_mapping jobs, which records its arguments
+    and the reads it got
+    """
+
+    def __init__(self, args, ref_set=None):
+        species = os.path.basename(args.single_mapping).split('_')[0]
+        files = args.reads if isinstance(args.reads, list) else [args.reads]
+        reads = []
+        for file in files:
+            assert stat.S_ISREG(os.stat(file).st_mode)
+            fastx_reader = FastxReader(file)
+            with fastx_reader.open_fastx() as f:
+                reads.append([seq for _, seq in fastx_reader.readfa(f)])
+        with open(os.path.join(args.output_path, species + '_job.json'),
+                  'w') as f:
+            json.dump({'reads': args.reads, 'seqs': reads,
+                       'threads': args.threads,
+                       'interleaved': args.interleaved,
+                       'split_reads': args.split_reads,
+                       'parallel_mapping': args.parallel_mapping,
+                       'pid': os.getpid(), 'ref': sorted(ref_set)}, f)
+
+
+class ParallelMappingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.tmp_dir, 'output')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_single_mapping(self, args, reference):
+        """ output of the --single_mapping jobs run by map_parallel """
+        folder = os.path.join(args.output_path,
+                              '04_mapping_' + args.species_name)
+        os.makedirs(folder, exist_ok=True)
+        with open(os.path.join(folder, 'MOUSE_OGs_consensus.fa'), 'w') as f:
+            f.write('>MOUSE00001_OG1\nATGACGTGA\n')
+        with open(os.path.join(folder, 'MOUSE_OGs_cov.txt'), 'w') as f:
+            f.write('#species,og,gene_id,coverage,std\n'
+                    'MOUSE,OG1,MOUSE00001,0.9,3.0\n')
+        with open(os.path.join(folder, 'MOUSE_OGs_sc.txt'), 'w') as f:
+            f.write('#species,og,gene_id,map_seq_completeness,'
+                    'ref_seq_completeness,inferred_len,given_len,ref_len\n'
+                    'MOUSE,OG1,MOUSE00001,1.0,1.0,9,9,9\n')
+
+    def run_map_parallel(self, argv, species=('MOUSE', 'RATNO')):
+        """
+        Run map_parallel with stubbed single species mappings
+        :return: dictionary with the recorded job of every species
+        """
+        args = parse_args(['--output_path', self.output_path] + argv,
+                          exe_name(), '')
+        reference_path = os.path.join(self.output_path, '02_ref_dna')
+        os.makedirs(reference_path, exist_ok=True)
+        for name in species:
+            with open(os.path.join(reference_path, name + '_OGs.fa'),
+                      'w') as f:
+                f.write('>{}00001_OG1\nACGT\n'.format(name))
+        with mock.patch.object(read2tree_main, 'Mapper', SingleMappingStub):
+            map_parallel(args, {name: name.lower() for name in species})
+        jobs = {}
+        for name in species:
+            with open(os.path.join(self.output_path,
+                                   name + '_job.json')) as f:
+                jobs[name] = json.load(f)
+        return jobs
+
+    def read_seqs(self, file):
+        fastx_reader = FastxReader(file)
+        with fastx_reader.open_fastx() as f:
+            return [seq for _, seq in fastx_reader.readfa(f)]
+
+    def test_map_parallel(self):
+        reads = os.path.join(dirname, 'data/reads/test.fq.gz')
+        jobs = self.run_map_parallel(['--reads', reads, '--threads', '5',
+                                      '--parallel_mapping', '2',
+                                      '--split_reads', '--split_len', '400',
+                                      '--split_overlap', '50'])
+        split = Reads(parse_args(['--output_path', self.output_path,
+                                  '--reads', reads, '--split_reads',
+                                  '--split_len', '400', '--split_overlap',
+                                  '50'], exe_name(), ''))
+        expected = self.read_seqs(split.reads)
+        split.cleanup()
+        for species, job in jobs.items():
+            self.assertEqual(job['ref'], [species])
+            self.assertEqual(job['threads'], 2)
+            self.assertEqual(job['parallel_mapping'], 0)
+            self.assertFalse(job['split_reads'])
+            # the reads are split once and shared by the jobs
+            self.assertEqual(job['seqs'], [expected])
+            self.assertEqual(job['reads'], jobs['MOUSE']['reads'])
+        self.assertNotEqual(jobs['MOUSE']['pid'], os.getpid())
+        self.assertFalse(os.path.exists(jobs['MOUSE']['reads']))
+
+    def test_map_parallel_merged_reads(self):
+        mates = [self.read_seqs(os.path.join(dirname, 'data/reads', file))
+                 for file in ('test_1a.fq.gz', 'test_2a.fq.gz')]
+        lanes = [os.path.join(self.tmp_dir, 'lane_1.fa.gz'),
+                 os.path.join(self.tmp_dir, 'lane_2.fa')]
+        for lane, (start, end) in zip(lanes, ((0, 600), (600, None))):
+            with (gzip.open if lane.endswith('.gz') else open)(lane,
+                                                                 'wt') as f:
+                for i, (left, right) in enumerate(zip(mates[0][start:end],
+                                                      mates[1][start:end])):
+                    f.write('>r{0}/1\n{1}\n>r{0}/2\n{2}\n'
+                            .format(i, left, right))
+        jobs = self.run_map_parallel(['--reads', ','.join(lanes),
+                                      '--interleaved',
+                                      '--parallel_mapping', '2'])
+        for job in jobs.values():
+            # the merged lanes are written once as separate mate files
+            self.assertFalse(job['interleaved'])
+            self.assertEqual(len(job['reads']), 2)
+            self.assertEqual(job['reads'], jobs['MOUSE']['reads'])
+            self.assertEqual(job['seqs'], mates)
+        for file in jobs['MOUSE']['reads']:
+            self.assertFalse(os.path.exists(file))
+
+    def test_stream_reads(self):
+        argv = ['--output_path', self.output_path,
+                '--reads', os.path.join(dirname, 'data/reads/test.fq.gz'),
+                '--parallel_mapping', '2', '--stream_reads']
+        with self.assertRaises(SystemExit):
+            parse_args(argv, exe_name(), '')
+
+    def test_species_name(self):
+        argv = ['--output_path', self.output_path,
+                '--reads', os.path.join(dirname, 'data/reads/test.fq.gz'),
+                '--parallel_mapping', '2', '-s', 'SAMPLE']
+        args = parse_args(argv, exe_name(), '')
+        reference = Reference()
+        reference.dna = [SeqRecord(Seq('ATGACGTGA'), id='MOUSE00001_OG1')]
+        ref_set = SimpleNamespace(ref={'MOUSE': reference})
+        ogset = SimpleNamespace(ogs={'OG1': None})
+        with mock.patch.object(read2tree_main, 'map_parallel',
+                               self.write_single_mapping):
+            mapper = get_mapper(args, ogset, ref_set, None)
+        self.assertEqual(list(mapper.mapped_records), ['MOUSE'])
+        self.assertEqual(str(mapper.mapped_records['MOUSE'].dna[0].seq),
+                         'ATGACGTGA')
+        self.assertEqual(list(mapper.og_records), ['OG1'])
+        self.assertEqual(mapper.all_cov, {'MOUSE00001_OG1': [0.9, 3.0]})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+import os
+import shutil
+import tempfile
+import argparse
+from collections import Counter
+from read2tree.ReadStats import ReadStats, summarize_histogram
+
+dirname = os.path.dirname(__file__)
+
+
+class ReadStatsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.args = argparse.Namespace(species_name='TEST',
+                                       output_path=self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_reads(self, lens):
+        reads = os.path.join(self.tmp_dir, 'reads.fq')
+        with open(reads, 'w') as f:
+            for i, l in enumerate(lens):
+                f.write('@r{}\n{}\n+\n{}\n'.format(i, 'A' * l, 'I' * l))
+        return reads
+
+    def test_summarize_histogram(self):
+        stats = summarize_histogram(Counter({100: 3, 1000: 1, 50: 2}))
+        self.assertEqual(stats['num_reads'], 6)
+        self.assertEqual(stats['num_bases'], 1400)
+        self.assertEqual(stats['median_len'], 100)
+        self.assertEqual(stats['n50'], 1000)
+        self.assertEqual(stats['length_histogram'],
+                         [[50, 2], [100, 3], [1000, 1]])
+
+    def test_sidecar(self):
+        read_stats = ReadStats(self.args)
+        reads = self.write_reads([10, 20, 30])
+        self.assertIsNone(read_stats.get_cached(reads))
+        stats = read_stats.get(reads)
+        self.assertEqual(stats['num_reads'], 3)
+        self.assertEqual(stats['mean_len'], 20)
+        self.assertEqual(read_stats.get_cached(reads), stats)
+        # the sidecar is invalidated once the read file changes
+        reads = self.write_reads([10, 20])
+        self.assertIsNone(read_stats.get_cached(reads))
+        self.assertEqual(read_stats.get(reads)['num_reads'], 2)
+
+    def test_gzip_reads(self):
+        read_stats = ReadStats(self.args)
+        stats = read_stats.get(os.path.join(dirname, 'data', 'reads',
+                                            'test_1a.996.fq.gz'))
+        self.assertEqual(stats['num_reads'], 249)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,11 @@
 import unittest
 import os
 import gzip
+import shutil
+import tempfile
 import argparse
 from Bio import SeqIO
-from read2tree.Reads import Reads
+from read2tree.Reads import Reads, ReadStream, open_reads
 from read2tree.FastxReader import FastxReader
 from read2tree.main import parse_args
 from read2tree._utils import exe_name
@@ -12,13 +14,20 @@ dirname = os.path.dirname(__file__)
 
 class ReadTest(unittest.TestCase):
 
+    def setUp(self):
+        # the read statistics are written to the output folder
+        self.output_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output_path)
+
     def setup_long_reads(self, split=False):
         if split:
-            argv = ['--output_path', 'data/output', '--reads', 'data/reads/test.fq.gz', '--split_reads',
+            argv = ['--output_path', self.output_path, '--reads', 'data/reads/test.fq.gz', '--split_reads',
                     '--split_overlap', '50', '--split_len', '400', '--sample_reads', '--coverage', '10',
                     '--genome_len', '1000']
         else:
-            argv = ['--output_path', 'data/output', '--reads', 'data/reads/test.fq.gz']
+            argv = ['--output_path', self.output_path, '--reads', 'data/reads/test.fq.gz']
 
         args = parse_args(argv, exe_name(), '')
         # args = arg_parser.parse_args(argv)
@@ -27,10 +36,10 @@ class ReadTest(unittest.TestCase):
     def setup_reads_paired(self, sampling=False):
 
         if sampling:
-            argv = ['--output_path', 'data/output', '--reads', 'data/reads/test_1a.fq.gz',
+            argv = ['--output_path', self.output_path, '--reads', 'data/reads/test_1a.fq.gz',
                     'data/reads/test_2a.fq.gz', '--sample_reads', '--coverage', '10', '--genome_len', '1000']
         else:
-            argv = ['--output_path', 'data/output', '--reads', 'data/reads/test_1a.fq.gz',
+            argv = ['--output_path', self.output_path, '--reads', 'data/reads/test_1a.fq.gz',
                     'data/reads/test_2a.fq.gz']
         args = parse_args(argv, exe_name(), '')
         return Reads(args)
@@ -100,6 +109,193 @@ class ReadTest(unittest.TestCase):
             'data/reads/test_1a.fq.gz')
         self.assertEqual(len(num_reads), 34)
 
+    def test_sample_from_reads_paired(self):
+        reads = self.setup_reads_paired(sampling=True)
+        sampled = reads.sample_from_reads(['data/reads/test_1a.fq.gz',
+                                           'data/reads/test_2a.fq.gz'])
+        names = []
+        for file in sampled:
+            fasta_reader = FastxReader(file)
+            with fasta_reader.open_fastx() as f:
+                names.append([name.split(' ')[0].split('/')[0]
+                              for name, _ in fasta_reader.readfa(f)])
+            os.remove(file)
+        self.assertEqual(len(names[0]), 34)
+        self.assertEqual(names[0], names[1])
+        fasta_reader = FastxReader('data/reads/test_1a.fq.gz')
+        with fasta_reader.open_fastx() as f:
+            all_names = ['>' + name.split(' ')[0].split('/')[0]
+                         for name in fasta_reader.readfq_id(f)]
+        selected = set(names[0])
+        self.assertEqual(names[0], [x for x in all_names if x in selected])
+
+    def test_check_read_consistency(self):
+        reads = self.setup_reads_paired()
+        self.assertIsNone(reads.check_read_consistency(
+            ['data/reads/test_1a.fq.gz', 'data/reads/test_2a.fq.gz']))
+        # test_1a.996.fq.gz holds only the first 249 reads of test_1a.fq.gz
+        mates = reads.check_read_consistency(
+            ['data/reads/test_1a.996.fq.gz', 'data/reads/test_2a.fq.gz'])
+        self.assertEqual(len(mates), 249)
+        selected = reads.select_mates_from_reads(
+            ['data/reads/test_1a.996.fq.gz', 'data/reads/test_2a.fq.gz'],
+            mates)
+        names = []
+        for file in selected:
+            fasta_reader = FastxReader(file)
+            with fasta_reader.open_fastx() as f:
+                names.append([name.split(' ')[0]
+                              for name, _ in fasta_reader.readfa(f)])
+            os.remove(file)
+        self.assertEqual(len(names[0]), 249)
+        self.assertEqual(names[0], names[1])
+
+    def test_process_reads_parallel(self):
+        argv = ['--output_path', self.output_path, '--reads',
+                'data/reads/test.fq.gz', '--split_reads', '--split_overlap',
+                '50', '--split_len', '400']
+        expected = Reads(parse_args(argv, exe_name(), ''))
+        obtained = Reads(parse_args(argv + ['--threads', '2',
+                                            '--compress_tmp_reads'],
+                                    exe_name(), ''))
+        with open(expected.reads) as f:
+            expected_reads = f.read()
+        with gzip.open(obtained.reads, 'rt') as f:
+            self.assertEqual(f.read(), expected_reads)
+        self.assertEqual(obtained.total_reads, expected.total_reads)
+        os.remove(expected.reads)
+        os.remove(obtained.reads)
+
+    def test_stream_reads(self):
+        argv = ['--output_path', self.output_path, '--reads',
+                'data/reads/test.fq.gz', '--split_reads', '--split_overlap',
+                '50', '--split_len', '400']
+        expected = Reads(parse_args(argv, exe_name(), ''))
+        streamed = Reads(parse_args(argv + ['--stream_reads'], exe_name(),
+                                    ''))
+        self.assertIsInstance(streamed.reads, ReadStream)
+        with open(expected.reads) as f:
+            expected_reads = f.read()
+        for _ in range(2):  # every opening produces the reads anew
+            with open_reads(streamed.reads) as fifo:
+                with open(fifo) as f:
+                    self.assertEqual(f.read(), expected_reads)
+        # the producer is stopped if the reader does not read all reads
+        with open_reads(streamed.reads) as fifo:
+            with open(fifo) as f:
+                f.readline()
+        with open_reads(streamed.reads) as fifo:
+            pass
+        # the read mappers get a file they can open several times
+        written = streamed.write_stream(streamed.reads)
+        for _ in range(2):
+            with open(written) as f:
+                self.assertEqual(f.read(), expected_reads)
+        expected.cleanup()
+        streamed.cleanup()
+        self.assertFalse(os.path.exists(expected.reads))
+        self.assertFalse(os.path.exists(written))
+
+    def test_stream_reads_paired(self):
+        argv = ['--output_path', self.output_path, '--reads',
+                'data/reads/test_1a.996.fq.gz', 'data/reads/test_2a.fq.gz',
+                '--check_mate_pairing']
+        expected = Reads(parse_args(argv, exe_name(), ''))
+        streamed = Reads(parse_args(argv + ['--stream_reads'], exe_name(),
+                                    ''))
+        written = streamed.write_stream(streamed.reads)
+        self.assertEqual(len(written), 2)
+        for file, expected_file in zip(written, expected.reads):
+            with open(file) as f, open(expected_file) as g:
+                self.assertEqual(f.read(), g.read())
+        streamed.cleanup()
+        with open_reads(streamed.reads) as fifos:
+            self.assertEqual(len(fifos), 2)
+            fasta_readers = [FastxReader(fifo) for fifo in fifos]
+            handles = [fasta_reader.open_fastx()
+                       for fasta_reader in fasta_readers]
+            obtained = list(zip(*[fasta_reader.readfa(handle)
+                                  for fasta_reader, handle
+                                  in zip(fasta_readers, handles)]))
+            for handle in handles:
+                handle.close()
+        for i, file in enumerate(expected.reads):
+            fasta_reader = FastxReader(file)
+            with fasta_reader.open_fastx() as f:
+                self.assertEqual([x[i] for x in obtained],
+                                 list(fasta_reader.readfa(f)))
+        self.assertEqual(len(obtained), 249)
+        expected.cleanup()
+
+    def test_merged_reads(self):
+        tmp_dir = tempfile.mkdtemp()
+        mates = []
+        for file in ('data/reads/test_1a.fq.gz', 'data/reads/test_2a.fq.gz'):
+            fastx_reader = FastxReader(file)
+            with fastx_reader.open_fastx() as f:
+                mates.append(list(fastx_reader.readfa(f)))
+        # interleaved reads of two lanes
+        lanes = [os.path.join(tmp_dir, 'lane_1.fq.gz'),
+                 os.path.join(tmp_dir, 'lane_2.fa')]
+        with gzip.open(lanes[0], 'wt') as f:
+            for left, right in zip(mates[0][:600], mates[1][:600]):
+                f.write('>{}\n{}\n>{}\n{}\n'.format(left[0][1:], left[1],
+                                                    right[0][1:], right[1]))
+        with open(lanes[1], 'w') as f:
+            for left, right in zip(mates[0][600:], mates[1][600:]):
+                f.write('>{}\n{}\n>{}\n{}\n'.format(left[0][1:], left[1],
+                                                    right[0][1:], right[1]))
+        argv = ['--output_path', self.output_path, '--reads', ','.join(lanes),
+                '--interleaved', '--check_mate_pairing']
+        reads = Reads(parse_args(argv, exe_name(), ''))
+        self.assertIsInstance(reads.reads, ReadStream)
+        with open_reads(reads.reads) as fifos:
+            self.assertEqual(len(fifos), 2)
+            for fifo, expected in zip(fifos, mates):
+                fasta_reader = FastxReader(fifo)
+                with fasta_reader.open_fastx() as f:
+                    self.assertEqual([seq for _, seq in
+                                      fasta_reader.readfa(f)],
+                                     [seq for _, seq in expected])
+        reads = Reads(parse_args(argv + ['--sample_reads', '--coverage', '10',
+                                         '--genome_len', '1000'],
+                                 exe_name(), ''))
+        read_ids = []
+        for file in reads.reads:
+            fasta_reader = FastxReader(file)
+            with fasta_reader.open_fastx() as f:
+                read_ids.append([reads._get_mate_id(read_id) for read_id
+                                 in fasta_reader.readfq_id(f)])
+        self.assertEqual(len(read_ids[0]), 34)
+        self.assertEqual(read_ids[0], read_ids[1])
+        reads.cleanup()
+        shutil.rmtree(tmp_dir)
+
+    def test_dedup_reads(self):
+        tmp_dir = tempfile.mkdtemp()
+        pairs = [('ACGTACGTAA', 'TTGGCCAA'), ('ACGTACGTAA', 'TTGGCCAA'),
+                 ('ACGTACGTAA', 'TTGGCCAT'), ('ACGTACGTCC', 'TTGGCCAA')]
+        files = [os.path.join(tmp_dir, 'reads_{}.fq'.format(i))
+                 for i in (1, 2)]
+        for i, file in enumerate(files):
+            with open(file, 'w') as f:
+                for j, pair in enumerate(pairs):
+                    f.write('@r{}/{}\n{}\n+\n{}\n'.format(
+                        j, i + 1, pair[i], 'I' * len(pair[i])))
+        argv = ['--output_path', self.output_path, '--reads'] + files + \
+               ['--dedup_reads']
+        expected = {(): [0, 2, 3], ('--dedup_prefix_len', '8'): [0, 2]}
+        for options, kept in expected.items():
+            reads = Reads(parse_args(argv + list(options), exe_name(), ''))
+            for i, file in enumerate(reads.reads):
+                fasta_reader = FastxReader(file)
+                with fasta_reader.open_fastx() as f:
+                    self.assertEqual(
+                        [seq for _, seq in fasta_reader.readfa(f)],
+                        [pairs[j][i] for j in kept])
+            reads.cleanup()
+        shutil.rmtree(tmp_dir)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+import os
+import random
+import shutil
+import tempfile
+import argparse
+import numpy as np
+from Bio.Seq import Seq
+from Bio.SeqRecord import SeqRecord
+from read2tree.ReferenceSet import Reference
+from read2tree.Sketch import Sketch
+
+dirname = os.path.dirname(__file__)
+
+
+class SketchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.args = argparse.Namespace(sketch_scaled=2, species_name='TEST',
+                                       output_path=self.tmp_dir)
+        rng = random.Random(3)
+        self.genome = ''.join(rng.choice('ACGT') for _ in range(4000))
+        self.ref = {}
+        # references sharing a decreasing part of their genes with the sample
+        for species, shared in (('FAR', 0), ('NEAR', 3000), ('MID', 1500)):
+            seq = self.genome[:shared] + ''.join(
+                rng.choice('ACGT') for _ in range(3000 - shared))
+            self.ref[species] = Reference()
+            self.ref[species].dna = [SeqRecord(Seq(seq[i:i + 1000]),
+                                               id='{}{}'.format(species, i))
+                                     for i in range(0, 3000, 1000)]
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_reads(self):
+        reads = os.path.join(self.tmp_dir, 'reads.fa')
+        with open(reads, 'w') as f:
+            for i in range(0, len(self.genome) - 100, 50):
+                f.write('>r{}\n{}\n'.format(i, self.genome[i:i + 100]))
+        return reads
+
+    def test_select_species(self):
+        sketch = Sketch(self.args)
+        selected = sketch.select_species(self.ref, sorted(self.ref),
+                                         self.write_reads(), 2)
+        self.assertEqual(selected, ['NEAR', 'MID'])
+
+    def test_reference_sketch_cache(self):
+        sketch = Sketch(self.args)
+        expected = sketch.get_reference_sketch('NEAR', self.ref['NEAR'].dna)
+        self.assertTrue(expected.size > 0)
+        self.assertTrue(np.all(np.diff(expected.astype(float)) > 0))
+        sketch_file = os.path.join(self.tmp_dir, '02_ref_sketch',
+                                   'NEAR_k21_s2.npy')
+        self.assertTrue(os.path.exists(sketch_file))
+        # cached sketch is used as long as the reference is not newer
+        cached = sketch.get_reference_sketch('NEAR', [])
+        self.assertTrue(np.array_equal(cached, expected))
+        ref_dna = os.path.join(self.tmp_dir, '02_ref_dna')
+        os.makedirs(ref_dna)
+        open(os.path.join(ref_dna, 'NEAR_OGs.fa'), 'w').close()
+        mtime = os.path.getmtime(sketch_file) + 10
+        os.utime(os.path.join(ref_dna, 'NEAR_OGs.fa'), (mtime, mtime))
+        self.assertEqual(sketch.get_reference_sketch('NEAR', []).size, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,101 @@
+import unittest
+import os
+import glob
+import random
+import shutil
+import tempfile
+import pysam
+from read2tree.Mapper import Mapper
+from read2tree.main import parse_args
+from read2tree._utils import exe_name
+
+dirname = os.path.dirname(__file__)
+
+READ_LEN = 50
+REF_LEN = 1000
+
+
+class SortAndIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.output_path = os.path.join(self.tmp_dir, 'output')
+        argv = ['--output_path', self.output_path,
+                '--reads', os.path.join(dirname, 'data/reads/test.fq.gz')]
+        self.mapper = Mapper(parse_args(argv, exe_name(), ''), load=False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_unsorted(self, file_name, mode):
+        """
+        Write mapped and unmapped reads in random order
+        :return: list of (contig, start) of the mapped reads
+        """
+        header = {'HD': {'VN': '1.0'},
+                  'SQ': [{'SN': 'MOUSE00001_OG{}'.format(i), 'LN': REF_LEN}
+                         for i in range(3)]}
+        rng = random.Random(1)
+        mapped = []
+        with pysam.AlignmentFile(file_name, mode, header=header) as out:
+            for i in range(300):
+                segment = pysam.AlignedSegment()
+                segment.query_name = 'read{}'.format(i)
+                segment.query_sequence = 'A' * READ_LEN
+                if i % 10 == 0:
+                    segment.flag = 4
+                else:
+                    segment.reference_id = rng.randrange(3)
+                    segment.reference_start = rng.randrange(
+                        REF_LEN - READ_LEN)
+                    segment.cigarstring = '{}M'.format(READ_LEN)
+                    mapped.append((segment.reference_id,
+                                   segment.reference_start))
+                out.write(segment)
+        return mapped
+
+    def check_sorted(self, sorted_bam, expected):
+        self.assertTrue(os.path.exists(sorted_bam + '.bai'))
+        with pysam.AlignmentFile(sorted_bam, 'rb') as bam:
+            self.assertEqual(bam.header.to_dict()['HD']['SO'], 'coordinate')
+            positions = [(read.reference_id, read.reference_start)
+                         for read in bam.fetch()]
+        self.assertEqual(positions, sorted(positions))
+        self.assertEqual(sorted(positions), sorted(expected))
+        # the temporary chunks stay in the tmp folder and are removed
+        self.assertEqual(glob.glob(os.path.join(self.tmp_dir, '*.tmp*')), [])
+        self.assertFalse(os.path.exists(self.output_path) and
+                         os.listdir(self.output_path))
+
+    def test_sort_bam(self):
+        bam_file = os.path.join(self.tmp_dir, 'MOUSE_OGs.bam')
+        mapped = self.write_unsorted(bam_file, 'wb')
+        sorted_bam = os.path.join(self.tmp_dir, 'MOUSE_OGs_post_sorted.bam')
+        self.mapper._sort_and_index_bam(bam_file, sorted_bam)
+        # unmapped reads of ngm are kept in the sorted bam
+        with pysam.AlignmentFile(sorted_bam, 'rb') as bam:
+            self.assertEqual(bam.unmapped, 30)
+        self.check_sorted(sorted_bam, mapped)
+
+    @unittest.skipIf(shutil.which('samtools') is None,
+                     'samtools is not installed')
+    def test_sort_sam(self):
+        sam_file = os.path.join(self.tmp_dir, 'MOUSE_OGs.sam')
+        mapped = self.write_unsorted(sam_file, 'w')
+        sorted_bam = os.path.join(self.tmp_dir, 'MOUSE_OGs_post_sorted.bam')
+        self.mapper._sort_and_index_bam(sam_file, sorted_bam)
+        with pysam.AlignmentFile(sorted_bam, 'rb') as bam:
+            self.assertEqual(bam.unmapped, 0)
+        self.check_sorted(sorted_bam, mapped)
+
+    def test_sort_error(self):
+        bam_file = os.path.join(self.tmp_dir, 'MOUSE_OGs.bam')
+        with open(bam_file, 'w') as f:
+            f.write('not a bam file\n')
+        with self.assertRaises(pysam.utils.SamtoolsError):
+            self.mapper._sort_and_index_bam(
+                bam_file, os.path.join(self.tmp_dir, 'sorted.bam'))
+
+
+if __name__ == "__main__":
+    unittest.main()